@@ -1,9 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session, jsonify
+from flask import Flask, render_template, stream_template, make_response, request, redirect, url_for, flash, send_file, session, jsonify, g, has_request_context, Response
+from markupsafe import Markup, escape
 import pandas as pd
+import numpy as np
 import os
 from werkzeug.utils import secure_filename
 import tempfile
+import io
+import codecs
+import copy
+import csv
+import gc
+import gzip
+import hashlib
+import pickle
+import shutil
+import sqlite3
 import json
+import logging
+import functools
+import math
+import threading
+import itertools
+import re
+import time
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 app = Flask(__name__)
@@ -12,125 +38,1499 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
+# CSVs comprimidos, descompactados em fluxo direto para o parser (sem cópia descompactada em disco)
+COMPRESSED_EXTENSIONS = {'csv.gz': 'gzip', 'zip': 'zip'}
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# Logs de depuração só são formatados quando LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+logger = logging.getLogger('check_planilhas')
+
+# Métricas no formato de texto do Prometheus (expostas em /metrics)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class MetricsRegistry:
+    """Contadores, gauges e histogramas em memória, protegidos por lock"""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+    
+    def inc(self, name, labels=None, value=1, help_text=''):
+        key = self._key(name, labels)
+        with self.lock:
+            self.help.setdefault(name, ('counter', help_text))
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set(self, name, value, labels=None, help_text=''):
+        key = self._key(name, labels)
+        with self.lock:
+            self.help.setdefault(name, ('gauge', help_text))
+            self.gauges[key] = value
+    
+    def observe(self, name, value, labels=None, help_text=''):
+        key = self._key(name, labels)
+        with self.lock:
+            self.help.setdefault(name, ('histogram', help_text))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+    
+    def render(self):
+        """Texto no formato de exposição do Prometheus (versão 0.0.4)"""
+        def format_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+        
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in sorted(self.help.items()):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                if kind == 'histogram':
+                    for (metric, labels), histogram in sorted(self.histograms.items()):
+                        if metric != name:
+                            continue
+                        for bound, count in zip(self.buckets, histogram['buckets']):
+                            lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {count}')
+                        lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+                        lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+                        lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+                else:
+                    values = self.counters if kind == 'counter' else self.gauges
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+def current_route():
+    """Endpoint da requisição atual (ou 'background' fora de requisições)"""
+    return (request.endpoint or 'unknown') if has_request_context() else 'background'
+
+# Perfil da requisição atual (somente quando o profiling foi solicitado por um admin)
+_active_profile = threading.local()
+
+@contextmanager
+def stage_timer(stage, rows=0, nbytes=0):
+    """Mede uma etapa da comparação; quem usa pode ajustar info['rows'] e info['bytes']"""
+    info = {'rows': rows, 'bytes': nbytes}
+    profile = getattr(_active_profile, 'profile', None)
+    if profile is not None:
+        profile.stage_started()
+    started = time.perf_counter()
+    try:
+        yield info
+    finally:
+        elapsed = time.perf_counter() - started
+        if profile is not None:
+            profile.stage_finished(stage, elapsed, info)
+        labels = {'route': current_route(), 'stage': stage}
+        metrics.observe('checkplanilhas_stage_duration_seconds', elapsed, labels,
+                        'Duração de cada etapa da comparação')
+        metrics.inc('checkplanilhas_stage_rows_total', labels, info['rows'] or 0,
+                    'Linhas processadas por etapa')
+        metrics.inc('checkplanilhas_stage_bytes_total', labels, info['bytes'] or 0,
+                    'Bytes processados por etapa')
+        logger.debug("Etapa %s: %.4fs, %s linhas, %s bytes", stage, elapsed, info['rows'], info['bytes'])
+
+def timed_stage(stage, rows=None, nbytes=None):
+    """Decorator de stage_timer; rows/nbytes calculam os volumes a partir de (resultado, args)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage) as info:
+                result = func(*args, **kwargs)
+                try:
+                    if rows:
+                        info['rows'] = rows(result, *args)
+                    if nbytes:
+                        info['bytes'] = nbytes(result, *args)
+                except Exception:
+                    pass
+                return result
+        return wrapper
+    return decorator
+
+# Profiling sob demanda: restrito a admins (ADMIN_TOKEN) e sem custo quando desligado
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+PROFILE_FOLDER = 'profiles'
+PROFILE_SAMPLE_INTERVAL = 0.005
+# tracemalloc é global ao processo: só uma requisição é perfilada por vez
+_profile_slot = threading.Lock()
+
+class RequestProfile:
+    """Perfil de uma requisição: pilhas amostradas (flame graph) ou cProfile, e pico de memória por etapa"""
+    
+    def __init__(self, route, mode='sampling'):
+        self.id = uuid.uuid4().hex[:12]
+        self.route = route
+        self.mode = mode
+        self.thread_id = threading.get_ident()
+        self.stacks = {}
+        self.samples = 0
+        self.stages = []
+        self.stage_stack = []
+        self.profiler = None
+        self.sampler = None
+        self.stop_event = threading.Event()
+        self.started_at = datetime.now()
+    
+    def start(self):
+        import tracemalloc
+        tracemalloc.start()
+        self.started = time.perf_counter()
+        if self.mode == 'deterministic':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+    
+    def _sample(self):
+        import sys
+        while not self.stop_event.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+    
+    def stage_started(self):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stage_stack:
+            self.stage_stack[-1]['peak'] = max(self.stage_stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        self.stage_stack.append({'base': current, 'peak': current})
+    
+    def stage_finished(self, stage, elapsed, info):
+        import tracemalloc
+        frame = self.stage_stack.pop()
+        peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        if self.stage_stack:
+            self.stage_stack[-1]['peak'] = max(self.stage_stack[-1]['peak'], peak)
+        self.stages.append({
+            'stage': stage,
+            'depth': len(self.stage_stack),
+            'seconds': round(elapsed, 6),
+            'rows': info['rows'],
+            'bytes': info['bytes'],
+            'peak_memory_bytes': int(peak - frame['base'])
+        })
+    
+    def stop(self):
+        import tracemalloc
+        duration = time.perf_counter() - self.started
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        top_functions = []
+        if self.profiler is not None:
+            import pstats
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler)
+            os.makedirs(PROFILE_FOLDER, exist_ok=True)
+            stats.dump_stats(os.path.join(PROFILE_FOLDER, f'{self.id}.prof'))
+            entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:40]
+            for (filename, line, name), (calls, _, own_time, cumulative, _) in entries:
+                top_functions.append({
+                    'function': f"{name} ({os.path.basename(filename)}:{line})",
+                    'calls': calls,
+                    'own_s': round(own_time, 6),
+                    'cumulative_s': round(cumulative, 6)
+                })
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {
+            'id': self.id,
+            'route': self.route,
+            'mode': self.mode,
+            'created_at': self.started_at.isoformat(timespec='seconds'),
+            'duration_s': round(duration, 6),
+            'peak_memory_bytes': int(peak),
+            'samples': self.samples,
+            'sample_interval_s': PROFILE_SAMPLE_INTERVAL,
+            'stages': self.stages,
+            'stacks': self.stacks,
+            'top_functions': top_functions
+        }
+
+def is_admin_request():
+    if not ADMIN_TOKEN:
+        return False
+    return request.headers.get('X-Admin-Token') == ADMIN_TOKEN or session.get('is_admin') is True
+
+def requested_profile_mode():
+    """Modo de profiling pedido (cabeçalho X-Profile, ?profile= ou opção do admin), ou None"""
+    flag = request.headers.get('X-Profile') or request.args.get('profile')
+    if not flag and has_request_context() and session.get('profile_requests'):
+        flag = session.get('profile_requests')
+    if not flag or flag in ('0', 'false') or not is_admin_request():
+        return None
+    return 'deterministic' if flag in ('deterministic', 'cprofile') else 'sampling'
+
+def save_profile_report(report):
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    with open(os.path.join(PROFILE_FOLDER, f"{report['id']}.json"), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False)
+
+def load_profile_report(profile_id):
+    path = os.path.join(PROFILE_FOLDER, f'{secure_filename(profile_id)}.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def build_flame_tree(stacks):
+    """Transforma pilhas colapsadas ('a;b;c' -> amostras) numa árvore para o flame graph"""
+    root = {'name': 'total', 'value': 0, 'children': {}}
+    for stack, count in stacks.items():
+        root['value'] += count
+        node = root
+        for name in stack.split(';'):
+            child = node['children'].setdefault(name, {'name': name, 'value': 0, 'children': {}})
+            child['value'] += count
+            node = child
+    
+    def to_list(node):
+        children = sorted(node['children'].values(), key=lambda child: child['value'], reverse=True)
+        return {'name': node['name'], 'value': node['value'], 'children': [to_list(child) for child in children]}
+    return to_list(root)
+
+def frame_rows(*frames):
+    return sum(len(df) for df in frames if isinstance(df, pd.DataFrame))
+
+def frame_bytes(*frames):
+    """Memória rasa dos DataFrames (sem inspecionar strings, para ser barato)"""
+    return int(sum(df.memory_usage(index=False).sum() for df in frames if isinstance(df, pd.DataFrame)))
+
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    name = filename.lower()
+    return '.' in name and (name.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
+                            or any(name.endswith('.' + ext) for ext in COMPRESSED_EXTENSIONS))
+
+def spreadsheet_format(file_path):
+    """(formato, compressão): ('csv', 'gzip') para .csv.gz, ('xlsx', None) para .xlsx etc."""
+    name = file_path.lower()
+    for ext, compression in COMPRESSED_EXTENSIONS.items():
+        if name.endswith('.' + ext):
+            return 'csv', compression
+    return name.rsplit('.', 1)[-1], None
+
+def zip_csv_member(archive):
+    """Único .csv dentro do .zip (ignorando pastas e metadados do macOS)"""
+    members = [info for info in archive.infolist()
+               if not info.is_dir() and not info.filename.startswith('__MACOSX/')
+               and not os.path.basename(info.filename).startswith('.')]
+    csv_members = [info for info in members if info.filename.lower().endswith('.csv')]
+    if len(csv_members) != 1:
+        raise ValueError('O arquivo .zip deve conter exatamente um .csv')
+    return csv_members[0]
+
+@contextmanager
+def open_spreadsheet_stream(file_path):
+    """Bytes do CSV, descompactados em fluxo quando o arquivo vier em .csv.gz ou .zip"""
+    _, compression = spreadsheet_format(file_path)
+    if compression == 'gzip':
+        with gzip.open(file_path, 'rb') as f:
+            yield f
+    elif compression == 'zip':
+        with zipfile.ZipFile(file_path) as archive:
+            with archive.open(zip_csv_member(archive)) as f:
+                yield f
+    else:
+        with open(file_path, 'rb') as f:
+            yield f
+
+def uncompressed_size(file_path):
+    """Tamanho do CSV descompactado, lido dos metadados do .gz/.zip sem descompactar"""
+    _, compression = spreadsheet_format(file_path)
+    if compression == 'gzip':
+        # Rodapé ISIZE do gzip: tamanho original módulo 2^32 (último membro)
+        with open(file_path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return int.from_bytes(f.read(4), 'little')
+    if compression == 'zip':
+        with zipfile.ZipFile(file_path) as archive:
+            return zip_csv_member(archive).file_size
+    return os.path.getsize(file_path)
+
+# Controle de admissão: cada tarefa reserva a memória estimada antes de carregar as planilhas
+class MemoryBudgetExceeded(Exception):
+    """Tarefa recusada: estimativa acima do orçamento, fila cheia ou espera longa demais"""
+
+def default_memory_budget():
+    """MEMORY_BUDGET_MB do ambiente (0 desliga) ou metade da memória física"""
+    configured = os.environ.get('MEMORY_BUDGET_MB')
+    if configured is not None:
+        return int(float(configured) * 1024 * 1024)
+    try:
+        return int(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 0.5)
+    except (ValueError, OSError, AttributeError):
+        return 2 * 1024 ** 3
+
+MEMORY_BUDGET_BYTES = default_memory_budget()
+ADMISSION_QUEUE_TIMEOUT = 60
+ADMISSION_MAX_QUEUE = 16
+# Amostra lida do início de cada arquivo para estimar linhas e bytes por linha
+MEMORY_ESTIMATE_SAMPLE_BYTES = 256 * 1024
+MEMORY_ESTIMATE_SAMPLE_ROWS = 200
+MEMORY_ESTIMATE_MEMO_ENTRIES = 256
+# Memória de trabalho do parser por célula (objetos intermediários do openpyxl/xlrd)
+PARSE_BYTES_PER_CELL = {'csv': 16, 'xlsx': 160, 'xls': 200}
+# Sem amostragem barata (xls): DataFrame estimado como múltiplo do tamanho do arquivo
+UNSAMPLED_EXPANSION = 8
+# Quantas vezes os DataFrames são copiados em cada tipo de tarefa (filtros, chaves compostas, .copy())
+PIPELINE_COPY_FACTOR = {'analyze': 1.5, 'preview': 1.2, 'compare': 3.0, 'plan': 1.2, 'precompute': 1.5}
+MEMORY_CALIBRATION_FILE = 'memory_calibration.json'
+MEMORY_CALIBRATION_ALPHA = 0.2
+MEMORY_CALIBRATION_HISTORY = 100
+RSS_SAMPLE_INTERVAL = 0.05
+
+_spreadsheet_shapes = OrderedDict()
+_spreadsheet_shapes_lock = threading.Lock()
+
+def estimate_spreadsheet_shape(file_path):
+    """Estima linhas, colunas e bytes por linha lendo apenas o começo do arquivo.
+    
+    Memorizada por caminho, tamanho e data de modificação: a admissão de memória e o
+    plano da comparação consultam o mesmo arquivo várias vezes na mesma sessão.
+    """
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _spreadsheet_shapes_lock:
+        if memo_key in _spreadsheet_shapes:
+            _spreadsheet_shapes.move_to_end(memo_key)
+            return dict(_spreadsheet_shapes[memo_key])
+    shape = sample_spreadsheet_shape(file_path)
+    with _spreadsheet_shapes_lock:
+        _spreadsheet_shapes[memo_key] = shape
+        while len(_spreadsheet_shapes) > MEMORY_ESTIMATE_MEMO_ENTRIES:
+            _spreadsheet_shapes.popitem(last=False)
+    return dict(shape)
+
+def sample_spreadsheet_shape(file_path):
+    """Leitura do começo do arquivo por trás de estimate_spreadsheet_shape"""
+    size = os.path.getsize(file_path)
+    fmt, compression = spreadsheet_format(file_path)
+    shape = {'path': os.path.basename(file_path), 'format': fmt, 'compression': compression, 'file_bytes': size,
+             'rows': None, 'columns': None, 'bytes_per_row': None, 'dtypes': {}}
+    sample = None
+    try:
+        if fmt == 'csv':
+            # Em .csv.gz/.zip as linhas são estimadas pelo tamanho descompactado
+            size = uncompressed_size(file_path) if compression else size
+            with open_spreadsheet_stream(file_path) as f:
+                head = f.read(MEMORY_ESTIMATE_SAMPLE_BYTES)
+            complete = head if len(head) == size else head[:head.rfind(b'\n') + 1]
+            sample = read_csv_sample(head, sniff_csv_dialect(head, len(head) == size), len(head) == size)
+            if len(head) == size or len(sample) == 0:
+                shape['rows'] = len(sample)
+            else:
+                header_bytes = complete.find(b'\n') + 1
+                bytes_per_line = (len(complete) - header_bytes) / len(sample)
+                shape['rows'] = int((size - header_bytes) / bytes_per_line)
+        elif fmt == 'xlsx':
+            from openpyxl import load_workbook
+            workbook = load_workbook(file_path, read_only=True)
+            try:
+                # Dimensão declarada no XML da planilha; pode faltar em arquivos gerados por terceiros
+                max_row = workbook.worksheets[0].max_row
+            finally:
+                workbook.close()
+            sample = pd.read_excel(file_path, nrows=MEMORY_ESTIMATE_SAMPLE_ROWS)
+            shape['rows'] = max(len(sample), (max_row or 1) - 1)
+    except Exception as e:
+        logger.debug("Estimativa por amostra falhou para %s: %s", file_path, e)
+        sample = None
+    
+    if sample is not None and len(sample):
+        shape['columns'] = len(sample.columns)
+        shape['bytes_per_row'] = float(sample.memory_usage(index=False, deep=True).sum()) / len(sample)
+        shape['dtypes'] = sample.dtypes.astype(str).value_counts().to_dict()
+        shape['frame_bytes'] = int(shape['rows'] * shape['bytes_per_row'])
+        shape['parse_bytes'] = int(shape['rows'] * shape['columns'] * PARSE_BYTES_PER_CELL.get(fmt, 200))
+    else:
+        shape['frame_bytes'] = size * UNSAMPLED_EXPANSION
+        shape['parse_bytes'] = size * UNSAMPLED_EXPANSION
+    return shape
+
+def estimate_job_memory(kind, file_paths):
+    """Pico de memória previsto para a tarefa, antes de carregar as planilhas.
+    
+    Os DataFrames ficam vivos juntos e são copiados PIPELINE_COPY_FACTOR vezes;
+    o parser de cada arquivo soma sua memória de trabalho enquanto lê. O fator
+    de calibração corrige a estimativa bruta com os picos medidos anteriormente.
+    """
+    shapes = [estimate_spreadsheet_shape(path) for path in file_paths]
+    frames = sum(shape['frame_bytes'] for shape in shapes)
+    parse = max((shape['parse_bytes'] for shape in shapes), default=0)
+    raw = int(frames * PIPELINE_COPY_FACTOR.get(kind, 2.0) + parse)
+    factor = memory_calibration.factor(kind)
+    return {'kind': kind, 'files': shapes, 'raw_bytes': raw, 'calibration_factor': factor,
+            'bytes': int(raw * factor)}
+
+class MemoryCalibration:
+    """Razão pico medido / estimativa por tipo de tarefa (média móvel), persistida em JSON"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.factors = {}
+        self.history = []
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.factors = data.get('factors', {})
+            self.history = data.get('history', [])
+        except (OSError, ValueError):
+            pass
+    
+    def factor(self, kind):
+        return self.factors.get(kind, 1.0)
+    
+    # Nunca subestimar por menos da metade nem superestimar além de 8x por causa de uma medição ruim
+    factor_bounds = (0.5, 8.0)
+    
+    def update(self, kind, ratio, entry):
+        """Incorpora uma medição (razão medido / estimativa bruta) e grava o arquivo; devolve o novo fator"""
+        with self.lock:
+            factor = (1 - MEMORY_CALIBRATION_ALPHA) * self.factor(kind) + MEMORY_CALIBRATION_ALPHA * ratio
+            self.factors[kind] = min(self.factor_bounds[1], max(self.factor_bounds[0], factor))
+            self.history.append({
+                'at': datetime.now().isoformat(timespec='seconds'),
+                'kind': kind,
+                **entry,
+                'ratio': round(ratio, 4)
+            })
+            del self.history[:-MEMORY_CALIBRATION_HISTORY]
+            try:
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    json.dump({'factors': self.factors, 'history': self.history}, f, indent=2)
+            except OSError as e:
+                logger.warning("Não foi possível gravar a calibração %s: %s", self.path, e)
+            return self.factors[kind]
+    
+    def record(self, kind, raw_bytes, estimated_bytes, peak_bytes):
+        if raw_bytes <= 0 or peak_bytes <= 0:
+            return
+        factor = self.update(kind, peak_bytes / raw_bytes,
+                             {'estimated_bytes': estimated_bytes, 'peak_bytes': peak_bytes})
+        metrics.observe('checkplanilhas_memory_estimate_ratio', peak_bytes / max(1, estimated_bytes), {'kind': kind},
+                        'Pico de memória medido / estimado')
+        metrics.set('checkplanilhas_memory_calibration_factor', factor, {'kind': kind},
+                    'Fator de calibração da estimativa de memória')
+
+memory_calibration = MemoryCalibration(MEMORY_CALIBRATION_FILE)
+
+class MemoryBudget:
+    """Orçamento global: admite se a estimativa cabe, enfileira (FIFO) ou recusa"""
+    
+    def __init__(self, budget_bytes, queue_timeout=ADMISSION_QUEUE_TIMEOUT, max_queue=ADMISSION_MAX_QUEUE):
+        self.budget_bytes = budget_bytes
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.reserved = 0
+        self.active = []
+        self.waiting = deque()
+        self.condition = threading.Condition()
+    
+    def acquire(self, kind, estimated_bytes, wait=True):
+        """Bloqueia até a reserva caber no orçamento; devolve a reserva ou lança MemoryBudgetExceeded.
+        
+        wait=False (trabalho especulativo) não entra na fila: sem espaço livre, recusa na hora.
+        """
+        labels = {'kind': kind}
+        if estimated_bytes > self.budget_bytes:
+            metrics.inc('checkplanilhas_admission_total', {**labels, 'decision': 'rejected'},
+                        help_text='Decisões do controle de admissão')
+            raise MemoryBudgetExceeded(
+                f'As planilhas precisam de aproximadamente {estimated_bytes / 1048576:.0f} MB, '
+                f'acima do limite de {self.budget_bytes / 1048576:.0f} MB do servidor. '
+                'Aplique filtros na exportação ou divida os arquivos.'
+            )
+        
+        reservation = {'bytes': estimated_bytes, 'overlapped': False}
+        with self.condition:
+            if self.waiting or self.reserved + estimated_bytes > self.budget_bytes:
+                if not wait:
+                    metrics.inc('checkplanilhas_admission_total', {**labels, 'decision': 'busy'},
+                                help_text='Decisões do controle de admissão')
+                    raise MemoryBudgetExceeded('Servidor ocupado com outras comparações.')
+                if len(self.waiting) >= self.max_queue:
+                    metrics.inc('checkplanilhas_admission_total', {**labels, 'decision': 'queue_full'},
+                                help_text='Decisões do controle de admissão')
+                    raise MemoryBudgetExceeded('Servidor ocupado com outras comparações. Tente novamente em instantes.')
+                metrics.inc('checkplanilhas_admission_total', {**labels, 'decision': 'queued'},
+                            help_text='Decisões do controle de admissão')
+                self.waiting.append(reservation)
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.waiting[0] is not reservation or self.reserved + estimated_bytes > self.budget_bytes:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            metrics.inc('checkplanilhas_admission_total', {**labels, 'decision': 'timeout'},
+                                        help_text='Decisões do controle de admissão')
+                            raise MemoryBudgetExceeded('Servidor ocupado com outras comparações. Tente novamente em instantes.')
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting.remove(reservation)
+                    self.condition.notify_all()
+            
+            # Picos de tarefas simultâneas se misturam no RSS: não servem para calibrar
+            if self.active:
+                reservation['overlapped'] = True
+                for other in self.active:
+                    other['overlapped'] = True
+            self.active.append(reservation)
+            self.reserved += estimated_bytes
+            metrics.inc('checkplanilhas_admission_total', {**labels, 'decision': 'admitted'},
+                        help_text='Decisões do controle de admissão')
+            metrics.set('checkplanilhas_memory_reserved_bytes', self.reserved,
+                        help_text='Memória reservada pelas tarefas em andamento')
+        return reservation
+    
+    def release(self, reservation):
+        with self.condition:
+            self.active.remove(reservation)
+            self.reserved -= reservation['bytes']
+            metrics.set('checkplanilhas_memory_reserved_bytes', self.reserved,
+                        help_text='Memória reservada pelas tarefas em andamento')
+            self.condition.notify_all()
+    
+    def resize(self, budget_bytes):
+        """Troca o limite (ex.: a fração de um worker do gunicorn) e publica o valor em vigor"""
+        with self.condition:
+            self.budget_bytes = budget_bytes
+            metrics.set('checkplanilhas_memory_budget_bytes', budget_bytes,
+                        help_text='Orçamento de memória deste processo (0 = desligado)')
+            self.condition.notify_all()
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES)
+memory_budget.resize(MEMORY_BUDGET_BYTES)
+
+def read_rss_bytes():
+    """RSS atual do processo (Linux); None quando indisponível"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class RssPeakMonitor:
+    """Amostra o RSS em segundo plano e devolve o crescimento máximo em relação ao início"""
+    
+    def __init__(self):
+        self.baseline = read_rss_bytes()
+        self.peak = self.baseline
+        self.stop_event = threading.Event()
+        self.thread = None
+        if self.baseline is not None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+    
+    def _run(self):
+        while not self.stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, read_rss_bytes() or 0)
+    
+    def stop(self):
+        if self.thread is None:
+            return None
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, read_rss_bytes() or 0)
+        return self.peak - self.baseline
+
+# Evita reservar duas vezes quando uma tarefa admitida chama outra (ex.: rota -> compare_spreadsheets)
+_admission_state = threading.local()
+
+@contextmanager
+def memory_admission(kind, *file_paths, wait=True):
+    """Reserva a memória estimada da tarefa durante o bloco e registra o pico medido para calibração"""
+    if not MEMORY_BUDGET_BYTES or getattr(_admission_state, 'active', False):
+        yield None
+        return
+    
+    estimate = estimate_job_memory(kind, file_paths)
+    started = time.perf_counter()
+    reservation = memory_budget.acquire(kind, estimate['bytes'], wait)
+    metrics.observe('checkplanilhas_admission_wait_seconds', time.perf_counter() - started, {'kind': kind},
+                    'Tempo de espera na fila de admissão')
+    monitor = RssPeakMonitor()
+    _admission_state.active = True
+    try:
+        yield estimate
+    finally:
+        _admission_state.active = False
+        peak = monitor.stop()
+        memory_budget.release(reservation)
+        # tracemalloc do profiling infla o RSS; só calibra tarefas que rodaram sozinhas
+        if peak and not reservation['overlapped'] and getattr(_active_profile, 'profile', None) is None:
+            memory_calibration.record(kind, estimate['raw_bytes'], estimate['bytes'], peak)
+        logger.info("Memória %s: estimada %.1f MB, crescimento medido %s",
+                    kind, estimate['bytes'] / 1048576,
+                    f"{peak / 1048576:.1f} MB" if peak is not None else 'indisponível')
+
+def admission_controlled(kind):
+    """Decorator de memory_admission para funções que recebem (file1_path, file2_path, ...)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(file1_path, file2_path, *args, **kwargs):
+            with memory_admission(kind, file1_path, file2_path):
+                return func(file1_path, file2_path, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# Leitura de CSV: separador, codificação e decimal detectados no primeiro bloco do arquivo
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_SNIFF_ROWS = 200
+CSV_DELIMITERS = (',', ';', '\t', '|')
+# Mesmos valores que o pandas trata como vazio, para o pyarrow produzir o mesmo resultado
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                 '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+COMMA_DECIMAL_PATTERN = re.compile(r'^-?(\d{1,3}(\.\d{3})+|\d+),\d+$')
+DOT_DECIMAL_PATTERN = re.compile(r'^-?(\d{1,3}(,\d{3})+|\d+)\.\d+$')
+DOT_THOUSANDS_PATTERN = re.compile(r'^-?\d{1,3}(\.\d{3})+,\d+$')
+
+# pyarrow é opcional: lê o CSV em várias threads; sem ele, usa o parser C do pandas
+try:
+    import pyarrow
+    import pyarrow.csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+CSV_ENGINE = os.environ.get('CSV_ENGINE') or ('pyarrow' if pyarrow is not None else 'c')
+
+def detect_encoding(head):
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        head.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # Caractere multibyte cortado no fim do bloco não invalida o UTF-8
+        if e.reason == 'unexpected end of data' and e.start >= len(head) - 3:
+            return 'utf-8'
+    # Exportações de ERP no Windows: cp1252 (superconjunto do latin-1 com € e aspas tipográficas)
+    try:
+        head.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+# A codificação sai do primeiro bloco: um latin-1 com o primeiro acento depois de 64 KB passa
+# por UTF-8. No UnicodeDecodeError a leitura é refeita com a próxima codificação, que fica
+# memorizada (por caminho, tamanho e data) para as demais leituras do mesmo arquivo
+CSV_FALLBACK_ENCODINGS = {'utf-8': 'cp1252', 'utf-8-sig': 'cp1252', 'cp1252': 'latin-1'}
+CSV_ENCODING_MEMO_ENTRIES = 256
+_csv_encodings = OrderedDict()
+_csv_encodings_lock = threading.Lock()
+
+def csv_encoding_memo_key(file_path):
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+def sniff_csv_file(file_path):
+    """Primeiro bloco do arquivo, se ele é o arquivo inteiro, e o dialeto (com a codificação memorizada)"""
+    with open_spreadsheet_stream(file_path) as f:
+        head = f.read(CSV_SNIFF_BYTES)
+    complete = len(head) < CSV_SNIFF_BYTES
+    dialect = sniff_csv_dialect(head, complete)
+    with _csv_encodings_lock:
+        encoding = _csv_encodings.get(csv_encoding_memo_key(file_path))
+    if encoding:
+        dialect['encoding'] = encoding
+    return head, complete, dialect
+
+def fall_back_csv_encoding(file_path, dialect, error):
+    """Dialeto com a próxima codificação de CSV_FALLBACK_ENCODINGS (None se não houver)"""
+    encoding = CSV_FALLBACK_ENCODINGS.get(dialect['encoding'])
+    if encoding is None:
+        return None
+    logger.info("%s não é %s (%s), lendo como %s", os.path.basename(file_path), dialect['encoding'], error, encoding)
+    with _csv_encodings_lock:
+        _csv_encodings[csv_encoding_memo_key(file_path)] = encoding
+        while len(_csv_encodings) > CSV_ENCODING_MEMO_ENTRIES:
+            _csv_encodings.popitem(last=False)
+    return {**dialect, 'encoding': encoding}
+
+def read_with_encoding_fallback(file_path, dialect, read):
+    """read(dialect), refeito com a próxima codificação a cada UnicodeDecodeError"""
+    while True:
+        try:
+            return read(dialect)
+        except UnicodeDecodeError as e:
+            fallback = fall_back_csv_encoding(file_path, dialect, e)
+            if fallback is None:
+                raise
+            dialect = fallback
+
+def sniff_csv_dialect(head, complete=False):
+    """Separador, codificação, decimal e milhar a partir do primeiro bloco do arquivo"""
+    encoding = detect_encoding(head)
+    text = head.decode(encoding, errors='ignore')
+    if not complete:
+        # A última linha pode estar cortada no meio
+        text = text[:text.rfind('\n') + 1] or text
+    
+    best = None
+    for delimiter in CSV_DELIMITERS:
+        counts = [len(row) for row in itertools.islice(csv.reader(io.StringIO(text), delimiter=delimiter), CSV_SNIFF_ROWS) if row]
+        if not counts:
+            continue
+        mode = max(set(counts), key=counts.count)
+        if mode < 2:
+            continue
+        # Preferir o separador que dá o mesmo número de campos em mais linhas, depois o que dá mais campos
+        score = (counts.count(mode) / len(counts), mode)
+        if best is None or score > best[0]:
+            best = (score, delimiter)
+    sep = best[1] if best else ','
+    
+    decimal, thousands = '.', None
+    if sep != ',':
+        comma = dot = grouped = 0
+        rows = itertools.islice(csv.reader(io.StringIO(text), delimiter=sep), 1, CSV_SNIFF_ROWS)
+        for row in rows:
+            for cell in row:
+                cell = cell.strip()
+                if COMMA_DECIMAL_PATTERN.match(cell):
+                    comma += 1
+                    grouped += bool(DOT_THOUSANDS_PATTERN.match(cell))
+                elif DOT_DECIMAL_PATTERN.match(cell):
+                    dot += 1
+        if comma > dot:
+            decimal = ','
+            # Só com "1.234,56" no arquivo o ponto é certamente separador de milhar
+            thousands = '.' if grouped else None
+    return {'encoding': encoding, 'sep': sep, 'decimal': decimal, 'thousands': thousands}
+
+def csv_read_options(dialect):
+    return {'sep': dialect['sep'], 'encoding': dialect['encoding'],
+            'decimal': dialect['decimal'], 'thousands': dialect['thousands']}
+
+def read_csv_sample(head, dialect, complete=False):
+    """Linhas completas do primeiro bloco, lidas com o dialeto detectado"""
+    text = head.decode(dialect['encoding'], errors='ignore')
+    if not complete:
+        text = text[:text.rfind('\n') + 1] or text
+    options = csv_read_options(dialect)
+    options.pop('encoding')
+    return pd.read_csv(io.StringIO(text), **options)
+
+def infer_csv_dtypes(sample):
+    """Mapa de tipos seguro a partir da amostra.
+    
+    Texto na amostra é texto no arquivo inteiro (object evita a tentativa de
+    conversão numérica). Float na amostra é forçado como float64; se o resto
+    do arquivo tiver texto nessa coluna, a leitura falha e é refeita sem o mapa.
+    Inteiros ficam com a inferência normal, porque podem virar float com vazios.
+    """
+    dtypes = {}
+    for col in sample.columns:
+        series = sample[col]
+        if series.dtype == object:
+            dtypes[col] = object
+        elif series.dtype.kind == 'f' and series.notna().any():
+            dtypes[col] = 'float64'
+    return dtypes
+
+def read_csv_pyarrow(file_path, dialect, columns, dtypes):
+    """Leitura multithread com pyarrow, equivalente à do pandas com o mesmo mapa de tipos"""
+    column_types = {col: pyarrow.string() if dtype is object else pyarrow.float64() for col, dtype in dtypes.items()}
+    with open_spreadsheet_stream(file_path) as f:
+        table = pyarrow_csv.read_csv(
+            f,
+            read_options=pyarrow_csv.ReadOptions(encoding=dialect['encoding'], column_names=columns, skip_rows=1),
+            parse_options=pyarrow_csv.ParseOptions(delimiter=dialect['sep'], newlines_in_values=True),
+            convert_options=pyarrow_csv.ConvertOptions(
+                column_types=column_types, null_values=CSV_NA_VALUES, strings_can_be_null=True,
+                true_values=['True', 'TRUE', 'true'], false_values=['False', 'FALSE', 'false'],
+                decimal_point=dialect['decimal']
+            )
+        )
+    # O pandas não converte datas sem parse_dates; o pyarrow sim (colunas vazias na amostra)
+    if any(pyarrow.types.is_temporal(field.type) for field in table.schema):
+        raise ValueError('coluna de data inferida pelo pyarrow')
+    df = table.to_pandas()
+    for position in range(df.shape[1]):
+        series = df.iloc[:, position]
+        if series.dtype == object:
+            # Vazios em texto: None no pyarrow, NaN no pandas
+            df.isetitem(position, series.where(series.notna(), np.nan))
+    return df
+
+def read_csv_file(file_path):
+    """Lê o CSV com o dialeto e o mapa de tipos detectados no primeiro bloco"""
+    head, complete, dialect = sniff_csv_file(file_path)
+    return read_with_encoding_fallback(
+        file_path, dialect, lambda dialect: read_csv_with_dialect(file_path, head, complete, dialect))
+
+def read_csv_with_dialect(file_path, head, complete, dialect):
+    sample = read_csv_sample(head, dialect, complete)
+    dtypes = infer_csv_dtypes(sample)
+    
+    # O pyarrow não tem separador de milhar
+    if CSV_ENGINE == 'pyarrow' and pyarrow is not None and dialect['thousands'] is None:
+        try:
+            df = read_csv_pyarrow(file_path, dialect, list(sample.columns), dtypes)
+            df.attrs['csv_dialect'] = {**dialect, 'engine': 'pyarrow'}
+            return df
+        except Exception as e:
+            logger.debug("Leitura com pyarrow falhou para %s, usando o parser do pandas: %s", file_path, e)
+    
+    options = csv_read_options(dialect)
+    try:
+        with open_spreadsheet_stream(file_path) as f:
+            df = pd.read_csv(f, dtype=dtypes or None, **options)
+    except UnicodeDecodeError:
+        raise
+    except (ValueError, TypeError) as e:
+        logger.debug("Mapa de tipos da amostra não vale para o arquivo inteiro (%s): %s", file_path, e)
+        with open_spreadsheet_stream(file_path) as f:
+            df = pd.read_csv(f, **options)
+    df.attrs['csv_dialect'] = {**dialect, 'engine': 'c'}
+    return df
+
+# Compactação de memória aplicada no carregamento (categorias + downcast numérico)
+COMPACT_ON_LOAD = True
+# Proporção máxima de valores distintos para converter texto em categoria
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
 
-def load_spreadsheet(file_path):
+@timed_stage('load', rows=lambda df, file_path, *args: frame_rows(df),
+             nbytes=lambda df, file_path, *args: os.path.getsize(file_path))
+def load_spreadsheet(file_path, compact=None):
+    if compact is None:
+        compact = COMPACT_ON_LOAD
+    
+    cache_key = None
+    if DATASET_CACHE_ENABLED:
+        try:
+            cache_key = dataset_cache_key(file_path, compact)
+        except OSError:
+            return None
+        df = load_cached_dataset(cache_key)
+        metrics.inc('checkplanilhas_dataset_cache_total', {'result': 'hit' if df is not None else 'miss'},
+                    help_text='Consultas ao cache de planilhas carregadas')
+        if df is not None:
+            logger.debug("Planilha %s lida do cache compartilhado", os.path.basename(file_path))
+            return df
+    
     try:
-        if file_path.endswith('.csv'):
-            df = pd.read_csv(file_path)
+        if spreadsheet_format(file_path)[0] == 'csv':
+            df = read_csv_file(file_path)
         else:
             df = pd.read_excel(file_path)
-        return df
     except Exception as e:
         return None
+    
+    return prepare_loaded_frame(df, file_path, compact, cache_key)
 
-def apply_filters(df, filters):
-    # Verificar se df é válido
-    if not isinstance(df, pd.DataFrame):
-        print(f"[ERROR] apply_filters recebeu {type(df)} ao invés de DataFrame!")
-        return pd.DataFrame()  # Retornar DataFrame vazio
+def prepare_loaded_frame(df, file_path, compact, cache_key=None):
+    """Etapas após a leitura: compactação, checksums das colunas e gravação no cache compartilhado"""
+    if compact:
+        df, report = compact_dataframe(df)
+        df.attrs['memory_report'] = report
+        logger.debug("Memória %s: %s -> %s bytes", os.path.basename(file_path), report['total_before'], report['total_after'])
     
-    if not filters:
-        print(f"[DEBUG] Nenhum filtro para aplicar. Retornando DF original com {len(df)} linhas.")
-        return df.copy()  # Retornar cópia para segurança
+    if COLUMN_CHECKSUMS_ENABLED:
+        column_checksums(df)
+    
+    if cache_key:
+        store_cached_dataset(cache_key, df, file_path)
+    return df
+
+def compact_dataframe(df, max_unique_ratio=None):
+    """Reduz a memória do DataFrame sem perder valores.
+    
+    Texto com poucos valores distintos vira categoria e colunas numéricas
+    são convertidas para o menor tipo que representa todos os valores.
+    Retorna o DataFrame compactado e um relatório de memória por coluna.
+    """
+    if max_unique_ratio is None:
+        max_unique_ratio = CATEGORY_MAX_UNIQUE_RATIO
+    
+    before = df.memory_usage(deep=True, index=False)
+    result = df.copy(deep=False)
+    
+    for col in (df.columns if df.columns.is_unique else []):
+        series = df[col]
+        try:
+            if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+                non_null = series.dropna()
+                # Só converter colunas de texto puro (tipos mistos mudariam a comparação)
+                if len(non_null) > 0 and non_null.map(type).eq(str).all():
+                    if non_null.nunique() / len(non_null) <= max_unique_ratio:
+                        series = series.astype('category')
+            elif pd.api.types.is_bool_dtype(series):
+                pass
+            elif pd.api.types.is_integer_dtype(series):
+                series = pd.to_numeric(series, downcast='integer')
+            elif pd.api.types.is_float_dtype(series):
+                downcast = pd.to_numeric(series, downcast='float')
+                # float32 só é aceito se todos os valores forem preservados
+                if downcast.dtype != series.dtype and downcast.astype(series.dtype).equals(series):
+                    series = downcast
+        except Exception as e:
+            logger.debug("Compactação ignorada para coluna %s: %s", col, e)
+            continue
+        result[col] = series
+    
+    after = result.memory_usage(deep=True, index=False)
+    
+    report = {
+        'columns': {
+            str(col): {
+                'before': int(before.iloc[i]),
+                'after': int(after.iloc[i]),
+                'dtype_before': str(df.dtypes.iloc[i]),
+                'dtype_after': str(result.dtypes.iloc[i])
+            }
+            for i, col in enumerate(df.columns)
+        },
+        'total_before': int(before.sum()),
+        'total_after': int(after.sum())
+    }
+    return result, report
+
+# Análise rápida de arquivos grandes: /analyze e /preview só mostram nomes, tipos, algumas
+# linhas e o total de linhas. Acima de ANALYSIS_SAMPLE_MIN_BYTES essas telas leem o cabeçalho
+# e as primeiras ANALYSIS_SAMPLE_ROWS linhas; o total vem dos metadados do xlsx ou da contagem
+# de quebras de linha do CSV. A leitura completa fica para a comparação e o preview de filtros
+ANALYSIS_SAMPLE_ROWS = int(os.environ.get('ANALYSIS_SAMPLE_ROWS', 5000))  # 0 desliga
+ANALYSIS_SAMPLE_MIN_BYTES = int(float(os.environ.get('ANALYSIS_SAMPLE_MIN_MB', 16)) * 1024 * 1024)
+ROW_COUNT_BLOCK = 4 * 1024 * 1024
+
+def count_csv_rows(file_path):
+    """Linhas de dados do CSV pelas quebras de linha (quebras entre aspas contam a mais)"""
+    lines = 0
+    last_byte = b''
+    with open_spreadsheet_stream(file_path) as f:
+        for block in iter(lambda: f.read(ROW_COUNT_BLOCK), b''):
+            lines += block.count(b'\n')
+            last_byte = block[-1:]
+    lines += 1 if last_byte not in (b'', b'\n') else 0
+    return max(0, lines - 1)
+
+def count_spreadsheet_rows(file_path):
+    """Total de linhas sem converter a planilha; None quando não há forma barata (xls, xlsx sem dimensão)"""
+    fmt, _ = spreadsheet_format(file_path)
+    if fmt == 'csv':
+        return count_csv_rows(file_path)
+    if fmt == 'xlsx':
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_path, read_only=True)
+        try:
+            max_row = workbook.worksheets[0].max_row
+        finally:
+            workbook.close()
+        return max(0, max_row - 1) if max_row else None
+    return None
+
+def read_spreadsheet_sample(file_path, nrows):
+    """Primeiras linhas da planilha, com o mesmo dialeto e mapa de tipos da leitura completa"""
+    if spreadsheet_format(file_path)[0] != 'csv':
+        return pd.read_excel(file_path, nrows=nrows)
     
-    print(f"[DEBUG] Aplicando {len(filters)} filtro(s) em DF com {len(df)} linhas.")
+    head, complete, dialect = sniff_csv_file(file_path)
     
+    def read(dialect):
+        dtypes = infer_csv_dtypes(read_csv_sample(head, dialect, complete))
+        options = csv_read_options(dialect)
+        try:
+            with open_spreadsheet_stream(file_path) as f:
+                df = pd.read_csv(f, nrows=nrows, dtype=dtypes or None, **options)
+        except UnicodeDecodeError:
+            raise
+        except (ValueError, TypeError):
+            with open_spreadsheet_stream(file_path) as f:
+                df = pd.read_csv(f, nrows=nrows, **options)
+        df.attrs['csv_dialect'] = {**dialect, 'engine': 'c'}
+        return df
+    return read_with_encoding_fallback(file_path, dialect, read)
+
+def analysis_sample_applies(file_path):
+    """Amostra só para arquivos grandes que ainda não estão no cache de planilhas"""
+    if not ANALYSIS_SAMPLE_ROWS or spreadsheet_format(file_path)[0] not in ('csv', 'xlsx'):
+        return False
+    if os.path.getsize(file_path) < ANALYSIS_SAMPLE_MIN_BYTES:
+        return False
+    return not dataset_is_cached(file_path)
+
+def load_analysis_frame(file_path):
+    """Planilha para as telas de análise: amostra com attrs['sampled'] e attrs['total_rows'],
+    ou a planilha inteira quando a amostra não se aplica ou falha"""
+    if not analysis_sample_applies(file_path):
+        return load_spreadsheet(file_path)
     try:
-        filtered_df = df.copy()
+        with stage_timer('analysis_sample', nbytes=os.path.getsize(file_path)) as info:
+            df = read_spreadsheet_sample(file_path, ANALYSIS_SAMPLE_ROWS)
+            total_rows = len(df) if len(df) < ANALYSIS_SAMPLE_ROWS else count_spreadsheet_rows(file_path)
+            info['rows'] = len(df)
     except Exception as e:
-        print(f"[ERROR] Erro ao fazer cópia do DataFrame: {e}")
-        return df
+        logger.debug("Amostra de análise falhou para %s, lendo a planilha inteira: %s", file_path, e)
+        total_rows = None
+    if total_rows is None:
+        return load_spreadsheet(file_path)
     
-    for i, filter_config in enumerate(filters):
-        column = filter_config.get('column')
-        operator = filter_config.get('operator')
-        value = filter_config.get('value')
-        
-        print(f"[DEBUG] Filtro {i+1}: {column} {operator} '{value}'")
-        
-        if not column or column not in filtered_df.columns:
-            print(f"[DEBUG] Coluna '{column}' não encontrada. Colunas disponíveis: {list(filtered_df.columns)}")
+    metrics.inc('checkplanilhas_analysis_sample_total', help_text='Análises feitas sobre amostra do arquivo')
+    df.attrs['sampled'] = True
+    df.attrs['total_rows'] = max(total_rows, len(df))
+    return df
+
+def load_analysis_frames(kind, file1_path, file2_path):
+    """As duas planilhas das telas de análise; só as lidas por inteiro passam pelo orçamento de memória"""
+    full_paths = [path for path in (file1_path, file2_path) if not analysis_sample_applies(path)]
+    with memory_admission(kind, *full_paths):
+        return load_analysis_frame(file1_path), load_analysis_frame(file2_path)
+
+def frame_total_rows(df):
+    """Total de linhas da planilha, mesmo quando o DataFrame é só a amostra da análise"""
+    return df.attrs.get('total_rows', len(df))
+
+# Checksums do conteúdo de cada coluna, calculados no carregamento: um dependente da ordem
+# das linhas e outro só do conjunto de valores (multiconjunto). Colunas com o mesmo
+# checksum nas duas planilhas não precisam passar pela comparação
+COLUMN_CHECKSUMS_ENABLED = True
+CHECKSUM_MIX_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+def column_value_hashes(series):
+    """Hash de 64 bits por valor, independente da compactação (int8 e int64, categoria e texto)"""
+    series = as_plain_series(series)
+    if pd.api.types.is_integer_dtype(series) and not pd.api.types.is_extension_array_dtype(series):
+        series = series.astype('int64')
+    elif pd.api.types.is_float_dtype(series):
+        series = series.astype('float64')
+    return pd.util.hash_pandas_object(series, index=False).to_numpy()
+
+class ColumnChecksum:
+    """(checksum na ordem das linhas, checksum do multiconjunto de valores), acumulável em blocos"""
+    
+    def __init__(self):
+        self.ordered = hashlib.blake2b(digest_size=16)
+        self.sums = [0, 0]
+    
+    def update(self, hashes):
+        self.ordered.update(hashes.tobytes())
+        # Soma dos hashes e de uma segunda mistura deles: não depende da ordem das linhas
+        mixed = (hashes * CHECKSUM_MIX_MULTIPLIER) ^ (hashes >> np.uint64(29))
+        self.sums[0] = (self.sums[0] + int(hashes.sum(dtype=np.uint64))) % 2 ** 64
+        self.sums[1] = (self.sums[1] + int(mixed.sum(dtype=np.uint64))) % 2 ** 64
+        return self
+    
+    def result(self):
+        return self.ordered.hexdigest(), f"{self.sums[0]:016x}{self.sums[1]:016x}"
+
+def column_checksums(df, columns=None):
+    """Checksums por coluna guardados em df.attrs (e no cache de planilhas); calcula os que faltam.
+    
+    Os checksums valem para o número de linhas em que foram calculados: um recorte da
+    planilha (filtros) herda os attrs, mas com outro número de linhas recalcula.
+    """
+    stored = df.attrs.get('column_checksums')
+    checksums = dict(stored['columns']) if stored and stored['rows'] == len(df) else {}
+    missing = [col for col in (df.columns if columns is None else columns)
+               if col in df.columns and col not in checksums]
+    if missing:
+        for col in missing:
+            checksums[col] = ColumnChecksum().update(column_value_hashes(df[col])).result()
+        # Substituir (e não alterar) o dicionário: recortes compartilham os valores dos attrs
+        df.attrs['column_checksums'] = {'rows': len(df), 'columns': checksums}
+    return checksums
+
+def identical_column_pairs(checksums1, checksums2, pairs, rows1, rows2):
+    """Pares de colunas com o mesmo conteúdo: (na mesma ordem de linhas, mesmo multiconjunto)"""
+    ordered, unordered = [], []
+    for col1, col2 in pairs:
+        if col1 not in checksums1 or col2 not in checksums2:
             continue
+        if checksums1[col1][1] == checksums2[col2][1]:
+            unordered.append((col1, col2))
+            if rows1 == rows2 and checksums1[col1][0] == checksums2[col2][0]:
+                ordered.append((col1, col2))
+    return ordered, unordered
+
+def identical_key_fields(field_details, identical_pairs):
+    """Os conjuntos de chaves das duas planilhas são iguais: todos os campos idênticos na ordem
+    das linhas ou, com um único campo, o mesmo multiconjunto de valores"""
+    if not identical_pairs or not field_details:
+        return False
+    ordered, unordered = identical_pairs
+    key_pairs = [(f['col1'], f['col2']) for f in field_details]
+    return all(pair in ordered for pair in key_pairs) or (len(key_pairs) == 1 and key_pairs[0] in unordered)
+
+def as_plain_series(series):
+    """Converte colunas categóricas de volta para valores simples (object)"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.astype(object)
+    return series
+
+# Os caches em disco (pickles das planilhas, bancos SQLite) são lidos sem outra validação:
+# ficam em diretórios 0700 da pasta instance/ do app, nunca no temporário compartilhado,
+# e só são lidos se o diretório e o arquivo pertencem ao usuário do processo
+def private_cache_directory(path):
+    """Cria o diretório com permissão 0700 e confere que só o usuário do processo tem acesso"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.path.islink(path) or not os.path.isdir(path):
+        raise PermissionError(f'{path} não é um diretório')
+    info = os.stat(path)
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        raise PermissionError(f'{path} pertence a outro usuário')
+    if info.st_mode & 0o077:
+        # Diretório nosso criado com permissões abertas (ex.: versão anterior, umask)
+        os.chmod(path, 0o700)
+    return path
+
+def is_private_file(path):
+    """O arquivo (ou diretório) pertence ao usuário do processo e ninguém mais pode alterá-lo"""
+    info = os.lstat(path)
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        return False
+    return not info.st_mode & 0o022
+
+# Cache em disco das planilhas já carregadas, compartilhado entre processos (workers do gunicorn).
+# Colunas numéricas e códigos de categorias ficam em .npy abertos com mmap: os workers
+# compartilham as páginas pelo cache do sistema operacional em vez de reler o arquivo.
+DATASET_CACHE_ENABLED = os.environ.get('DATASET_CACHE', '1') != '0'
+DATASET_CACHE_FOLDER = os.environ.get('DATASET_CACHE_DIR') or os.path.join(app.instance_path, 'datasets')
+DATASET_CACHE_MAX_BYTES = int(float(os.environ.get('DATASET_CACHE_MAX_MB', 2048)) * 1024 * 1024)
+# Diretórios temporários de gravações interrompidas são removidos após esse tempo
+DATASET_CACHE_STALE_SECONDS = 3600
+
+def dataset_cache_key(file_path, compact):
+    """Chave do arquivo carregado: caminho, tamanho e mtime (uploads têm nomes únicos)"""
+    stat = os.stat(file_path)
+    raw = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{int(bool(compact))}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def dataset_is_cached(file_path):
+    """A planilha já está no cache em disco (a leitura completa sai do mmap, sem o parser)"""
+    if not DATASET_CACHE_ENABLED:
+        return False
+    folder = os.path.join(DATASET_CACHE_FOLDER, dataset_cache_key(file_path, COMPACT_ON_LOAD))
+    return os.path.exists(os.path.join(folder, 'frame.pkl'))
+
+def store_cached_dataset(key, df, source_path):
+    """Grava o DataFrame no cache; a gravação é atômica (diretório temporário + rename)"""
+    final = os.path.join(DATASET_CACHE_FOLDER, key)
+    if os.path.exists(final):
+        return
+    temp = None
+    try:
+        private_cache_directory(DATASET_CACHE_FOLDER)
+        temp = tempfile.mkdtemp(prefix=f'.{key}.', dir=DATASET_CACHE_FOLDER)
+        layout = []
+        extras = {}
+        for position in range(df.shape[1]):
+            series = df.iloc[:, position]
+            dtype = series.dtype
+            if isinstance(dtype, pd.CategoricalDtype):
+                np.save(os.path.join(temp, f'{position}.npy'), series.cat.codes.to_numpy())
+                extras[position] = (dtype.categories, dtype.ordered)
+                layout.append('category')
+            elif isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM':
+                np.save(os.path.join(temp, f'{position}.npy'), series.to_numpy())
+                layout.append('numpy')
+            else:
+                # Texto e tipos de extensão (Int64, datas com fuso) não são mapeáveis em memória
+                extras[position] = series.array
+                layout.append('pickle')
         
-        initial_rows = len(filtered_df)
-        
+        with open(os.path.join(temp, 'frame.pkl'), 'wb') as f:
+            pickle.dump({'columns': df.columns, 'index': df.index, 'layout': layout,
+                         'extras': extras, 'attrs': df.attrs}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(temp, 'source'), 'w', encoding='utf-8') as f:
+            f.write(os.path.abspath(source_path))
+        os.rename(temp, final)
+        temp = None
+    except OSError as e:
+        # Outro worker pode ter gravado a mesma chave primeiro
+        logger.debug("Cache de planilha não gravado (%s): %s", key, e)
+    finally:
+        if temp:
+            shutil.rmtree(temp, ignore_errors=True)
+    prune_dataset_cache()
+
+def load_cached_dataset(key):
+    """DataFrame do cache (colunas numéricas em mmap copy-on-write) ou None"""
+    folder = os.path.join(DATASET_CACHE_FOLDER, key)
+    try:
+        private_cache_directory(DATASET_CACHE_FOLDER)
+        if not all(is_private_file(path) for path in (folder, os.path.join(folder, 'frame.pkl'))):
+            logger.warning("Cache de planilha ignorado: %s é de outro usuário ou gravável por outros", folder)
+            return None
+        with open(os.path.join(folder, 'frame.pkl'), 'rb') as f:
+            meta = pickle.load(f)
+        data = {}
+        for position, kind in enumerate(meta['layout']):
+            if kind == 'pickle':
+                data[position] = meta['extras'][position]
+                continue
+            values = np.load(os.path.join(folder, f'{position}.npy'), mmap_mode='c')
+            if kind == 'category':
+                categories, ordered = meta['extras'][position]
+                values = pd.Categorical.from_codes(values, dtype=pd.CategoricalDtype(categories, ordered))
+            data[position] = values
+        os.utime(folder)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+        # Entrada removida por outro worker durante a leitura: recarregar do arquivo original
+        logger.debug("Cache de planilha indisponível (%s): %s", key, e)
+        return None
+    
+    df = pd.DataFrame(data, index=meta['index'], copy=False)
+    df.columns = meta['columns']
+    df.attrs.update(meta['attrs'])
+    return df
+
+def prune_dataset_cache():
+    """Remove entradas cujo arquivo original já foi apagado e as menos usadas acima do limite"""
+    try:
+        names = os.listdir(DATASET_CACHE_FOLDER)
+    except OSError:
+        return
+    now = time.time()
+    entries = []
+    for name in names:
+        folder = os.path.join(DATASET_CACHE_FOLDER, name)
         try:
-            if operator == 'equals':
-                # Tentar converter para o tipo correto
-                print(f"[DEBUG] Valor original: '{value}' (tipo: {type(value)})")
-                print(f"[DEBUG] Coluna é numérica? {pd.api.types.is_numeric_dtype(filtered_df[column])}")
-                if pd.api.types.is_numeric_dtype(filtered_df[column]):
-                    try:
-                        value = pd.to_numeric(value)
-                        print(f"[DEBUG] Valor convertido: {value} (tipo: {type(value)})")
-                    except Exception as conv_e:
-                        print(f"[DEBUG] Erro na conversão: {conv_e}")
-                        pass
-                else:
-                    print(f"[DEBUG] Mantendo como string")
-                
-                # Verificar amostra da coluna
-                print(f"[DEBUG] Primeiros valores da coluna {column}: {filtered_df[column].head(3).tolist()}")
-                
-                filtered_df = filtered_df[filtered_df[column] == value]
-            elif operator == 'not_equals':
-                if pd.api.types.is_numeric_dtype(filtered_df[column]):
-                    try:
-                        value = pd.to_numeric(value)
-                    except:
-                        pass
-                filtered_df = filtered_df[filtered_df[column] != value]
-            elif operator == 'contains':
-                filtered_df = filtered_df[filtered_df[column].astype(str).str.contains(str(value), na=False, case=False)]
-            elif operator == 'not_contains':
-                filtered_df = filtered_df[~filtered_df[column].astype(str).str.contains(str(value), na=False, case=False)]
-            elif operator == 'starts_with':
-                filtered_df = filtered_df[filtered_df[column].astype(str).str.startswith(str(value), na=False)]
-            elif operator == 'ends_with':
-                filtered_df = filtered_df[filtered_df[column].astype(str).str.endswith(str(value), na=False)]
-            elif operator == 'greater_than':
-                numeric_col = pd.to_numeric(filtered_df[column], errors='coerce')
-                numeric_val = pd.to_numeric(value, errors='coerce')
-                filtered_df = filtered_df[numeric_col > numeric_val]
-            elif operator == 'less_than':
-                numeric_col = pd.to_numeric(filtered_df[column], errors='coerce')
-                numeric_val = pd.to_numeric(value, errors='coerce')
-                filtered_df = filtered_df[numeric_col < numeric_val]
-            elif operator == 'is_empty':
-                filtered_df = filtered_df[filtered_df[column].isna() | (filtered_df[column] == '')]
-            elif operator == 'is_not_empty':
-                filtered_df = filtered_df[filtered_df[column].notna() & (filtered_df[column] != '')]
-            
-            final_rows = len(filtered_df)
-            print(f"[DEBUG] Filtro {i+1} aplicado: {initial_rows} -> {final_rows} linhas")
-            
-        except Exception as e:
-            print(f"[DEBUG] Erro ao aplicar filtro {i+1}: {str(e)}")
+            if name.startswith('.'):
+                if now - os.path.getmtime(folder) > DATASET_CACHE_STALE_SECONDS:
+                    shutil.rmtree(folder, ignore_errors=True)
+                continue
+            with open(os.path.join(folder, 'source'), encoding='utf-8') as f:
+                source = f.read()
+            if not os.path.exists(source):
+                shutil.rmtree(folder, ignore_errors=True)
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(folder))
+            entries.append((os.path.getmtime(folder), size, folder))
+        except OSError:
             continue
     
-    print(f"[DEBUG] Total final após todos os filtros: {len(filtered_df)} linhas")
-    print(f"[DEBUG] Tipo do retorno: {type(filtered_df)}")
+    total = sum(size for _, size, _ in entries)
+    for _, size, folder in sorted(entries):
+        if total <= DATASET_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(folder, ignore_errors=True)
+        total -= size
+    metrics.set('checkplanilhas_dataset_cache_bytes', total, help_text='Tamanho do cache de planilhas em disco')
+
+# Índices invertidos por coluna para filtros de igualdade (equals / not_equals / in)
+VALUE_INDEXES_ENABLED = True
+# Até esta cardinalidade o índice usa bitmaps; acima, listas ordenadas de linhas
+BITMAP_MAX_CARDINALITY = 32
+INDEXED_OPERATORS = {'equals', 'not_equals', 'in'}
+
+def build_value_index(series):
+    """Constrói um índice invertido valor -> linhas para uma coluna.
+    
+    Colunas de baixa cardinalidade usam um bitmap por valor; as demais guardam
+    os números das linhas agrupados por valor (ordenados) e o deslocamento de cada grupo.
+    """
+    started = time.perf_counter()
+    codes, uniques = pd.factorize(as_plain_series(series), use_na_sentinel=True)
+    n_rows = len(codes)
+    # Valores distintos podem ser iguais em Python (ex.: 281 e 281.0 numa coluna mista)
+    value_to_code = {}
+    for code, value in enumerate(uniques.tolist()):
+        value_to_code.setdefault(value, []).append(code)
+    
+    if len(uniques) <= BITMAP_MAX_CARDINALITY:
+        kind = 'bitmap'
+        bitmaps = np.packbits(codes[np.newaxis, :] == np.arange(len(uniques))[:, np.newaxis], axis=1)
+        data = {'bitmaps': bitmaps}
+        nbytes = bitmaps.nbytes
+    else:
+        kind = 'postings'
+        valid = codes >= 0
+        row_ids = np.flatnonzero(valid)
+        order = np.argsort(codes[valid], kind='stable')
+        row_ids = row_ids[order].astype(np.int32)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(codes[valid], minlength=len(uniques))))).astype(np.int64)
+        data = {'row_ids': row_ids, 'offsets': offsets}
+        nbytes = row_ids.nbytes + offsets.nbytes
+    
+    return {
+        'kind': kind,
+        'n_rows': n_rows,
+        'numeric': pd.api.types.is_numeric_dtype(series),
+        'value_to_code': value_to_code,
+        'cardinality': len(uniques),
+        'build_ms': round((time.perf_counter() - started) * 1000, 2),
+        'bytes': int(nbytes),
+        **data
+    }
+
+def lookup_value_index(index, values):
+    """Máscara das linhas cujo valor está em `values`, usando o índice"""
+    mask = np.zeros(index['n_rows'], dtype=bool)
+    codes = [code for value in values for code in index['value_to_code'].get(value, [])]
+    for code in codes:
+        if index['kind'] == 'bitmap':
+            mask |= np.unpackbits(index['bitmaps'][code], count=index['n_rows']).astype(bool)
+        else:
+            mask[index['row_ids'][index['offsets'][code]:index['offsets'][code + 1]]] = True
+    return mask
+
+def describe_value_indexes(indexes):
+    """Resumo de tempo de construção e memória dos índices, por coluna"""
+    return {
+        str(col): {key: index[key] for key in ('kind', 'cardinality', 'build_ms', 'bytes')}
+        for col, index in indexes.items()
+    }
+
+def parse_filter_values(series, operator, value):
+    """Valores comparados por um filtro de igualdade, já no tipo da coluna"""
+    raw_values = [v.strip() for v in str(value).split(',')] if operator == 'in' else [value]
+    if not pd.api.types.is_numeric_dtype(series):
+        return raw_values
+    converted = []
+    for raw in raw_values:
+        try:
+            converted.append(pd.to_numeric(raw))
+        except Exception:
+            converted.append(raw)
+    return converted
+
+def build_filter_mask(df, filter_config, indexes=None):
+    """Calcula a máscara booleana de um único filtro sobre o DataFrame inteiro.
+    
+    Retorna None quando o filtro não pode ser aplicado (coluna inexistente ou erro),
+    caso em que ele deve ser ignorado, como sempre foi em apply_filters.
+    Se `indexes` for informado (dict coluna -> índice), filtros de igualdade são
+    resolvidos pelo índice da coluna, construído na primeira vez que ela é usada.
+    """
+    column = filter_config.get('column')
+    operator = filter_config.get('operator')
+    value = filter_config.get('value')
+    
+    if not column or column not in df.columns:
+        logger.debug("Coluna '%s' não encontrada", column)
+        return None
+    
+    series = df[column]
     
-    # Verificar se é um DataFrame válido antes do retorno
-    if not isinstance(filtered_df, pd.DataFrame):
-        print(f"[ERROR] apply_filters retornou {type(filtered_df)} ao invés de DataFrame!")
-        print(f"[ERROR] Retornando DataFrame original como fallback")
-        return df.copy()  # Retornar DataFrame original em caso de erro
+    if indexes is not None and VALUE_INDEXES_ENABLED and operator in INDEXED_OPERATORS:
+        try:
+            if column not in indexes:
+                indexes[column] = build_value_index(series)
+                logger.debug("Índice criado para %s: %s (%s valores, %.2f ms, %s bytes)", column,
+                             indexes[column]['kind'], indexes[column]['cardinality'],
+                             indexes[column]['build_ms'], indexes[column]['bytes'])
+            mask = lookup_value_index(indexes[column], parse_filter_values(series, operator, value))
+            return ~mask if operator == 'not_equals' else mask
+        except Exception as e:
+            logger.debug("Índice indisponível para %s, usando varredura: %s", column, e)
     
-    # Verificar se o DataFrame não está corrompido
     try:
-        _ = len(filtered_df)
-        _ = list(filtered_df.columns)
+        if operator == 'in':
+            mask = series.isin(parse_filter_values(series, operator, value))
+        elif operator == 'equals':
+            # Tentar converter para o tipo correto
+            if pd.api.types.is_numeric_dtype(series):
+                try:
+                    value = pd.to_numeric(value)
+                except Exception as conv_e:
+                    logger.debug("Valor '%s' mantido como texto: %s", value, conv_e)
+            
+            mask = series == value
+        elif operator == 'not_equals':
+            if pd.api.types.is_numeric_dtype(series):
+                try:
+                    value = pd.to_numeric(value)
+                except:
+                    pass
+            mask = series != value
+        elif operator == 'contains':
+            mask = series.astype(str).str.contains(str(value), na=False, case=False)
+        elif operator == 'not_contains':
+            mask = ~series.astype(str).str.contains(str(value), na=False, case=False)
+        elif operator == 'starts_with':
+            mask = series.astype(str).str.startswith(str(value), na=False)
+        elif operator == 'ends_with':
+            mask = series.astype(str).str.endswith(str(value), na=False)
+        elif operator == 'greater_than':
+            numeric_col = pd.to_numeric(as_plain_series(series), errors='coerce')
+            numeric_val = pd.to_numeric(value, errors='coerce')
+            mask = numeric_col > numeric_val
+        elif operator == 'less_than':
+            numeric_col = pd.to_numeric(as_plain_series(series), errors='coerce')
+            numeric_val = pd.to_numeric(value, errors='coerce')
+            mask = numeric_col < numeric_val
+        elif operator == 'is_empty':
+            mask = series.isna() | (series == '')
+        elif operator == 'is_not_empty':
+            mask = series.notna() & (series != '')
+        else:
+            return None
     except Exception as e:
-        print(f"[ERROR] DataFrame filtrado parece estar corrompido: {e}")
+        logger.debug("Erro ao aplicar filtro %s %s: %s", column, operator, str(e))
+        return None
+    
+    return mask.to_numpy(dtype=bool)
+
+@timed_stage('filter', rows=lambda result, df, *args: frame_rows(df),
+             nbytes=lambda result, df, *args: frame_bytes(df))
+def apply_filters(df, filters, indexes=None):
+    # Verificar se df é válido
+    if not isinstance(df, pd.DataFrame):
+        logger.error("apply_filters recebeu %s ao invés de DataFrame!", type(df))
+        return pd.DataFrame()  # Retornar DataFrame vazio
+    
+    if not filters:
+        logger.debug("Nenhum filtro para aplicar. Retornando DF original com %s linhas.", len(df))
+        return df.copy()  # Retornar cópia para segurança
+    
+    logger.debug("Aplicando %s filtro(s) em DF com %s linhas.", len(filters), len(df))
+    
+    # Cada filtro gera uma máscara sobre o DataFrame inteiro; o resultado é a
+    # interseção delas (equivalente a aplicar os filtros em sequência)
+    combined_mask = None
+    for i, filter_config in enumerate(filters):
+        mask = build_filter_mask(df, filter_config, indexes)
+        if mask is None:
+            continue
+        
+        combined_mask = mask if combined_mask is None else (combined_mask & mask)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Filtro %s (%s %s '%s'): %s linhas restantes", i + 1, filter_config.get('column'),
+                         filter_config.get('operator'), filter_config.get('value'), int(combined_mask.sum()))
+    
+    if combined_mask is None:
         return df.copy()
     
+    filtered_df = df[combined_mask]
+    
+    logger.debug("Total final após todos os filtros: %s linhas", len(filtered_df))
+    
     return filtered_df
 
 def normalize_column_name(col_name):
@@ -267,15 +1667,20 @@ def analyze_column_content(df, column, sample_size=100):
         }
     }
 
-def find_intelligent_column_mapping(df1, df2):
-    """Encontra mapeamento inteligente entre colunas de duas planilhas"""
+@timed_stage('mapping', rows=lambda result, df1, df2: frame_rows(df1, df2))
+def find_intelligent_column_mapping(df1, df2, content1=None):
+    """Encontra mapeamento inteligente entre colunas de duas planilhas.
+    
+    content1: análise de conteúdo da origem já calculada (uma origem, vários destinos).
+    """
     cols1 = list(df1.columns)
     cols2 = list(df2.columns)
     
-    print(f"[DEBUG] Analisando mapeamento entre {len(cols1)} e {len(cols2)} colunas")
+    logger.debug("Analisando mapeamento entre %s e %s colunas", len(cols1), len(cols2))
     
     # Analisar conteúdo das colunas
-    content1 = {col: analyze_column_content(df1, col) for col in cols1}
+    if content1 is None:
+        content1 = {col: analyze_column_content(df1, col) for col in cols1}
     content2 = {col: analyze_column_content(df2, col) for col in cols2}
     
     # Calcular matriz de similaridade
@@ -334,15 +1739,15 @@ def find_intelligent_column_mapping(df1, df2):
                 mapping[col1] = col2
                 used_cols2.add(col2)
                 mapping_details[col1] = match
-                print(f"[DEBUG] Mapeado: {col1} -> {col2} (similaridade: {similarity:.2f})")
+                logger.debug("Mapeado: %s -> %s (similaridade: %.2f)", col1, col2, similarity)
                 break
     
     # Identificar colunas não mapeadas
     unmapped_cols1 = [col for col in cols1 if col not in mapping]
     unmapped_cols2 = [col for col in cols2 if col not in used_cols2]
     
-    print(f"[DEBUG] Mapeamento concluído: {len(mapping)} correspondências encontradas")
-    print(f"[DEBUG] Não mapeadas - Origem: {len(unmapped_cols1)}, Destino: {len(unmapped_cols2)}")
+    logger.debug("Mapeamento concluído: %s correspondências encontradas", len(mapping))
+    logger.debug("Não mapeadas - Origem: %s, Destino: %s", len(unmapped_cols1), len(unmapped_cols2))
     
     return {
         'mapping': mapping,
@@ -437,113 +1842,252 @@ def calculate_key_field_score(df, column):
     
     return min(100, score)
 
-def identify_best_key_fields(column_mapping, df1, df2, min_fields=2, max_fields=6):
-    """Identifica os melhores campos para usar como chave de comparação"""
-    if not column_mapping:
-        return [], []
+# Busca da menor combinação de colunas que identifica as linhas nas duas planilhas
+KEY_SEARCH_SAMPLE_ROWS = 20000
+KEY_SEARCH_MAX_CANDIDATES = 24
+KEY_SEARCH_TIME_BUDGET = 2.0  # segundos; esgotado o tempo, fica a busca gulosa
+KEY_HASH_MULTIPLIER = np.uint64(0x100000001B3)  # combina os hashes das colunas de uma chave composta
+IDENTIFIER_NAME_TOKENS = {'id', 'cod', 'codigo', 'key', 'chave', 'nf', 'serie', 'num', 'numero', 'nota', 'doc',
+                          'documento', 'pedido'}
+MEASURE_NAME_PREFIXES = ('valor', 'vlr', 'custo', 'total', 'preco', 'qtd', 'quant', 'saldo', 'desconto', 'peso')
+
+def key_column_preference(series, column):
+    """Quanto a coluna parece um identificador estável (códigos, números de documento) e não uma medida"""
+    tokens = normalize_column_name(column).split('_')
+    preference = 0
+    if any(token in IDENTIFIER_NAME_TOKENS or token.startswith(('cod', 'num')) for token in tokens):
+        preference += 2
+    if any(token.startswith(MEASURE_NAME_PREFIXES) for token in tokens):
+        preference -= 2
     
-    # Calcular pontuação para cada par de colunas mapeadas
-    field_scores = []
-    for col1, col2 in column_mapping.items():
-        score1 = calculate_key_field_score(df1, col1)
-        score2 = calculate_key_field_score(df2, col2)
-        combined_score = (score1 + score2) / 2
-        
-        field_scores.append({
+    values = series.dropna()
+    if pd.api.types.is_integer_dtype(series):
+        preference += 1
+    elif pd.api.types.is_float_dtype(series) and len(values) and not (values % 1 == 0).all():
+        preference -= 2  # valores com casas decimais: medidas, não códigos
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        preference -= 1
+    return preference
+
+class KeySearchSide:
+    """Hashes das colunas de uma planilha para a busca de chave: na amostra e, sob demanda, completos.
+    
+    Com frame_key (hash do conteúdo e filtros da planilha), os hashes de cada coluna ficam no
+    cache de comparações: mudar o mapeamento só calcula os das colunas novas.
+    """
+    
+    frame_key = None
+    
+    def __init__(self, df, columns, sample_rows=KEY_SEARCH_SAMPLE_ROWS, frame_key=None):
+        self.df = df
+        self.columns = columns
+        self.frame_key = frame_key
+        self.set_sample(df.iloc[self.sample_positions(len(df), sample_rows)])
+        self.full_hashes = {}
+    
+    @staticmethod
+    def sample_positions(n_rows, sample_rows):
+        """Posições da amostra: as mesmas para o mesmo número de linhas, em qualquer backend"""
+        if n_rows <= sample_rows:
+            return np.arange(n_rows)
+        return np.sort(np.random.default_rng(0).choice(n_rows, sample_rows, replace=False))
+    
+    def set_sample(self, sample):
+        self.sample = sample
+        self.sample_hashes = {col: self.column_hashes(('sample', len(sample), col), sample[col]) for col in self.columns}
+        self.sample_distinct = {col: len(pd.unique(hashes)) for col, hashes in self.sample_hashes.items()}
+        # Linhas distintas da amostra considerando todas as colunas: nenhuma combinação passa disso
+        self.sample_target = len(pd.unique(self.combine(self.sample_hashes, self.columns)))
+    
+    def column_hashes(self, key, series):
+        if self.frame_key is None:
+            return pd.util.hash_pandas_object(series, index=False).to_numpy()
+        return cached_hashes(('column',) + self.frame_key + key,
+                             lambda: pd.util.hash_pandas_object(series, index=False).to_numpy())
+    
+    @staticmethod
+    def combine(hashes, columns):
+        combined = np.zeros(len(hashes[columns[0]]), dtype=np.uint64)
+        for col in columns:
+            combined = combined * KEY_HASH_MULTIPLIER ^ hashes[col]
+        return combined
+    
+    def sample_unique_count(self, columns):
+        return len(pd.unique(self.combine(self.sample_hashes, columns)))
+    
+    def can_be_unique(self, columns):
+        """Limite superior: a combinação tem no máximo o produto dos valores distintos de cada coluna"""
+        bound = 1
+        for col in columns:
+            bound *= self.sample_distinct[col]
+            if bound >= self.sample_target:
+                return True
+        return False
+    
+    def is_unique(self, columns):
+        """A combinação identifica as linhas da planilha inteira (linhas totalmente repetidas são toleradas)"""
+        if self.sample_unique_count(columns) < self.sample_target:
+            return False
+        return self.confirm_unique(columns)
+    
+    def confirm_unique(self, columns):
+        for col in columns:
+            if col not in self.full_hashes:
+                self.full_hashes[col] = self.column_hashes(('full', col), self.df[col])
+        combined = self.combine(self.full_hashes, columns)
+        repeated = pd.Series(combined).duplicated(keep=False).to_numpy()
+        if not repeated.any():
+            return True
+        # Chaves repetidas só valem se as linhas forem idênticas em todas as colunas mapeadas
+        rows = pd.util.hash_pandas_object(self.df.loc[repeated, self.columns], index=False).to_numpy()
+        groups = pd.DataFrame({'key': combined[repeated], 'row': rows}).drop_duplicates()
+        return groups['key'].is_unique
+
+@timed_stage('key_selection', rows=lambda result, column_mapping, df1, df2, *args, **kwargs: frame_rows(df1, df2))
+def identify_best_key_fields(column_mapping, df1, df2, min_fields=1, max_fields=6, time_budget=None, frame_keys=None):
+    """Identifica a menor combinação de campos que identifica as linhas nas duas planilhas.
+    
+    As combinações são testadas por tamanho, das colunas com cara de identificador
+    (códigos, números de documento) para as demais; o produto dos valores distintos
+    descarta combinações que não podem ser únicas antes de calcular o hash. A unicidade
+    é testada numa amostra e confirmada na planilha inteira. Sem combinação única dentro
+    do tempo, as colunas são escolhidas de forma gulosa pelo número de valores distintos.
+    frame_keys: identificação das duas planilhas no cache de hashes (ver KeySearchSide).
+    """
+    pairs = [(col1, col2) for col1, col2 in (column_mapping or {}).items() if col1 in df1.columns and col2 in df2.columns]
+    if not pairs or len(df1) == 0 or len(df2) == 0:
+        return [], [], []
+    
+    deadline = time.perf_counter() + (KEY_SEARCH_TIME_BUDGET if time_budget is None else time_budget)
+    frame_key1, frame_key2 = frame_keys or (None, None)
+    side1 = KeySearchSide(df1, [col1 for col1, _ in pairs], frame_key=frame_key1)
+    side2 = KeySearchSide(df2, [col2 for _, col2 in pairs], frame_key=frame_key2)
+    return search_key_fields(pairs, side1, side2, min_fields, max_fields, deadline)
+
+def search_key_fields(pairs, side1, side2, min_fields, max_fields, deadline):
+    """Busca da chave sobre os lados já amostrados (KeySearchSide ou equivalente de outro backend)"""
+    def distinct_ratio(pair):
+        return min(side1.sample_distinct[pair[0]] / side1.sample_target,
+                   side2.sample_distinct[pair[1]] / side2.sample_target)
+    
+    preference = {pair: key_column_preference(side1.sample[pair[0]], pair[0]) +
+                        key_column_preference(side2.sample[pair[1]], pair[1]) for pair in pairs}
+    candidates = sorted(pairs, key=lambda pair: (-preference[pair], -distinct_ratio(pair)))[:KEY_SEARCH_MAX_CANDIDATES]
+    
+    def is_key(combination):
+        cols1, cols2 = [col1 for col1, _ in combination], [col2 for _, col2 in combination]
+        return (side1.can_be_unique(cols1) and side2.can_be_unique(cols2) and
+                side1.is_unique(cols1) and side2.is_unique(cols2))
+    
+    # Medidas (valores com casas decimais, nomes como valor/custo/total) só entram depois que
+    # nenhuma combinação de identificadores, de qualquer tamanho, for única: um custo aleatório
+    # único não pode ganhar de nota + item
+    identifiers = [pair for pair in candidates if preference[pair] >= 0]
+    tiers = [identifiers, candidates] if len(identifiers) < len(candidates) else [candidates]
+    
+    selected = None
+    timed_out = False
+    for round_number, tier in enumerate(tiers):
+        for size in range(max(1, min_fields), min(max_fields, len(tier)) + 1):
+            for combination in itertools.combinations(tier, size):
+                if time.perf_counter() > deadline:
+                    timed_out = True
+                    break
+                if round_number and all(preference[pair] >= 0 for pair in combination):
+                    continue  # só identificadores: já testada na primeira rodada
+                if is_key(combination):
+                    selected = list(combination)
+                    break
+            if selected or timed_out:
+                break
+        if selected or timed_out:
+            break
+    
+    if selected is None:
+        # Gulosa: a cada passo, a coluna que mais distingue as linhas no lado mais fraco
+        selected = []
+        remaining = list(candidates)
+        while remaining and len(selected) < max_fields:
+            def coverage(pair):
+                combination = selected + [pair]
+                return (min(side1.sample_unique_count([c1 for c1, _ in combination]) / side1.sample_target,
+                            side2.sample_unique_count([c2 for _, c2 in combination]) / side2.sample_target),
+                        preference[pair])
+            best = max(remaining, key=coverage)
+            selected.append(best)
+            remaining.remove(best)
+            if coverage(best)[0] >= 1 and len(selected) >= min_fields:
+                break
+        logger.debug("Nenhuma chave única encontrada%s; usando seleção gulosa",
+                     " dentro do tempo" if timed_out else "")
+    
+    selected_fields = []
+    for col1, col2 in selected:
+        score1 = calculate_key_field_score(side1.sample, col1)
+        score2 = calculate_key_field_score(side2.sample, col2)
+        selected_fields.append({
             'col1': col1,
             'col2': col2,
             'score1': score1,
             'score2': score2,
-            'combined_score': combined_score
+            'combined_score': (score1 + score2) / 2
         })
-        
-        print(f"[DEBUG] Campo {col1} <-> {col2}: Score {combined_score:.1f} (df1: {score1:.1f}, df2: {score2:.1f})")
     
-    # Ordenar por pontuação
-    field_scores.sort(key=lambda x: x['combined_score'], reverse=True)
-    
-    # Selecionar os melhores campos
-    selected_fields = field_scores[:max_fields]
-    
-    # Filtrar campos com pontuação mínima
-    min_score_threshold = 40  # Pontuação mínima para ser considerado
-    selected_fields = [f for f in selected_fields if f['combined_score'] >= min_score_threshold]
-    
-    # Garantir número mínimo de campos se possível
-    if len(selected_fields) < min_fields:
-        # Relaxar o threshold se necessário
-        additional_fields = field_scores[len(selected_fields):min_fields]
-        selected_fields.extend(additional_fields)
-    
-    # Extrair listas de colunas
     key_cols1 = [f['col1'] for f in selected_fields]
     key_cols2 = [f['col2'] for f in selected_fields]
     
-    print(f"[DEBUG] Campos-chave selecionados: {len(key_cols1)}")
+    logger.debug("Campos-chave selecionados: %s", len(key_cols1))
     for i, field in enumerate(selected_fields):
-        print(f"[DEBUG] {i+1}. {field['col1']} <-> {field['col2']} (score: {field['combined_score']:.1f})")
+        logger.debug("%s. %s <-> %s (score: %.1f)", i + 1, field['col1'], field['col2'], field['combined_score'])
     
     return key_cols1, key_cols2, selected_fields
 
-def find_unique_rows_by_intelligent_keys(df1, df2, column_mapping=None):
-    """Encontra linhas exclusivas usando campos-chave identificados automaticamente"""
+@timed_stage('unique_rows', rows=lambda result, df1, df2, *args: frame_rows(df1, df2),
+             nbytes=lambda result, df1, df2, *args: frame_bytes(df1, df2))
+def find_unique_rows_by_intelligent_keys(df1, df2, column_mapping=None, identical_pairs=None, frame_keys=None):
+    """Encontra linhas exclusivas usando campos-chave identificados automaticamente.
+    
+    identical_pairs: (pares idênticos na ordem, pares com o mesmo multiconjunto), de
+    identical_column_pairs. Se a chave escolhida já é idêntica, não há linhas exclusivas.
+    frame_keys: (hash do conteúdo, filtros) de cada planilha; com eles, os hashes das
+    colunas e das chaves compostas são reaproveitados entre comparações (ex.: pré-cálculo).
+    """
     if column_mapping is None:
         # Se não há mapeamento, usar análise inteligente
         mapping_result = find_intelligent_column_mapping(df1, df2)
         column_mapping = mapping_result['mapping']
     
     if not column_mapping:
-        print("[DEBUG] Nenhum mapeamento de colunas disponível, usando comparação simples")
+        logger.debug("Nenhum mapeamento de colunas disponível, usando comparação simples")
         return find_unique_rows(df1, df2, 'smart')
     
     # Identificar melhores campos-chave
-    key_cols1, key_cols2, field_details = identify_best_key_fields(column_mapping, df1, df2)
+    key_cols1, key_cols2, field_details = identify_best_key_fields(column_mapping, df1, df2, frame_keys=frame_keys)
     
     if len(key_cols1) < 1:
-        print("[DEBUG] Nenhum campo-chave adequado encontrado, usando comparação simples")
+        logger.debug("Nenhum campo-chave adequado encontrado, usando comparação simples")
         return find_unique_rows(df1, df2, 'smart')
     
-    # Criar chaves compostas para comparação
-    def create_composite_key(df, key_cols):
-        if not key_cols:
-            return []
-        
-        key_values = []
-        for col in key_cols:
-            # Converter para string e tratar valores nulos
-            values = df[col].fillna('NULL').astype(str)
-            key_values.append(values)
-        
-        # Concatenar valores com separador
-        return ["|".join(row) for row in zip(*key_values)]
-    
-    # Criar chaves compostas
-    keys_origem = create_composite_key(df1, key_cols1)
-    keys_destino = create_composite_key(df2, key_cols2)
-    
-    print(f"[DEBUG] Chaves criadas - Origem: {len(keys_origem)}, Destino: {len(keys_destino)}")
-    
-    # Converter para sets para encontrar diferenças
-    set_origem = set(keys_origem)
-    set_destino = set(keys_destino)
-    
-    # Encontrar chaves exclusivas
-    only_in_origem = set_origem - set_destino
-    only_in_destino = set_destino - set_origem
+    comparison_info = [f"{f['col1']} ↔ {f['col2']} (score: {f['combined_score']:.1f})" for f in field_details]
+    if identical_key_fields(field_details, identical_pairs):
+        logger.debug("Campos-chave idênticos nas duas planilhas (checksum): nenhuma linha exclusiva")
+        return df1.iloc[:0].copy(), df2.iloc[:0].copy(), comparison_info
     
-    print(f"[DEBUG] Exclusivas - Origem: {len(only_in_origem)}, Destino: {len(only_in_destino)}")
+    # Chaves compostas como hash de 64 bits do texto de cada campo (nulos viram 'NULL'),
+    # sem montar uma string por linha
+    kinds = key_value_kinds(df1, df2, key_cols1, key_cols2)
+    frame_key1, frame_key2 = frame_keys or (None, None)
+    keys_origem = cached_key_hashes(df1, key_cols1, kinds, frame_key1)
+    keys_destino = cached_key_hashes(df2, key_cols2, kinds, frame_key2)
     
-    # Recuperar linhas completas
-    # Criar máscaras booleanas com índices corretos
-    mask_origem = pd.Series(keys_origem, index=df1.index).isin(only_in_origem)
-    mask_destino = pd.Series(keys_destino, index=df2.index).isin(only_in_destino)
+    # Linhas cuja chave não aparece na outra planilha
+    mask_origem = ~np.isin(keys_origem, np.unique(keys_destino))
+    mask_destino = ~np.isin(keys_destino, np.unique(keys_origem))
+    logger.debug("Exclusivas - Origem: %s, Destino: %s", int(mask_origem.sum()), int(mask_destino.sum()))
     
     rows_only_in_origem = df1[mask_origem].copy()
     rows_only_in_destino = df2[mask_destino].copy()
     
-    # Adicionar informação sobre os campos-chave usados
-    comparison_info = [f"{f['col1']} ↔ {f['col2']} (score: {f['combined_score']:.1f})" for f in field_details]
-    
     return rows_only_in_origem, rows_only_in_destino, comparison_info
 
 def find_unique_rows_by_key_fields(df1, df2):
@@ -564,8 +2108,8 @@ def find_unique_rows(df1, df2, comparison_strategy='smart'):
         column_mapping = find_column_mapping(df1.columns, df2.columns)
         mapped_columns = list(column_mapping.keys())
         
-        print(f"[DEBUG] Mapeamento de colunas encontrado: {len(column_mapping)} colunas")
-        print(f"[DEBUG] Primeiras 5 mapeadas: {dict(list(column_mapping.items())[:5])}")
+        logger.debug("Mapeamento de colunas encontrado: %s colunas", len(column_mapping))
+        logger.debug("Primeiras 5 mapeadas: %s", dict(list(column_mapping.items())[:5]))
         
         if len(mapped_columns) >= 2:  # Precisamos de pelo menos 2 colunas para comparar
             # Criar subsets com colunas mapeadas
@@ -587,7 +2131,7 @@ def find_unique_rows(df1, df2, comparison_strategy='smart'):
             unique_in_1 = hashes1 - hashes2
             unique_in_2 = hashes2 - hashes1
             
-            print(f"[DEBUG] Hashes únicos - Origem: {len(unique_in_1)}, Destino: {len(unique_in_2)}")
+            logger.debug("Hashes únicos - Origem: %s, Destino: %s", len(unique_in_1), len(unique_in_2))
             
             # Recuperar linhas originais
             rows_only_in_1 = df1[df1_subset['_hash'].isin(unique_in_1)].copy()
@@ -596,7 +2140,7 @@ def find_unique_rows(df1, df2, comparison_strategy='smart'):
             return rows_only_in_1, rows_only_in_2, mapped_columns
     
     # Estratégia 2: Comparação simples por número de linhas (fallback)
-    print("[DEBUG] Usando estratégia fallback - comparação por quantidade de linhas")
+    logger.debug("Usando estratégia fallback - comparação por quantidade de linhas")
     
     # Se uma planilha tem mais linhas, as extras são "únicas"
     len_diff = len(df2) - len(df1)
@@ -619,134 +2163,1494 @@ def find_unique_rows(df1, df2, comparison_strategy='smart'):
     
     return rows_only_in_1, rows_only_in_2, comparison_cols
 
+def to_numeric_frame(df, columns):
+    """Converte as colunas para float64 numa única passagem, ignorando valores não numéricos"""
+    # Somar sempre em float64 (colunas compactadas podem estar em float32)
+    return pd.DataFrame(
+        {col: pd.to_numeric(as_plain_series(df[col]), errors='coerce').astype('float64') for col in columns},
+        index=df.index
+    )
+
+# Somas em ordens diferentes (pandas, SQLite, blocos do CSV) só diferem nos últimos dígitos:
+# os totais são arredondados a 12 algarismos significativos em todos os motores, e a
+# reconciliação por grupo compara as somas com tolerância relativa
+TOTAL_SIGNIFICANT_DIGITS = 12
+TOTAL_RELATIVE_TOLERANCE = 1e-9
+
+def round_total(value):
+    """Soma (ou média) arredondada a TOTAL_SIGNIFICANT_DIGITS algarismos significativos"""
+    return float(f'{float(value):.{TOTAL_SIGNIFICANT_DIGITS}g}')
+
+@timed_stage('totals', rows=lambda result, df, *args: frame_rows(df))
 def calculate_totals(df, total_columns):
     """Calcula totais para colunas numéricas especificadas"""
     totals = {}
-    for col in total_columns:
-        if col in df.columns:
-            try:
-                # Converter para numérico e somar, ignorando valores não numéricos
-                numeric_series = pd.to_numeric(df[col], errors='coerce')
-                totals[col] = {
-                    'sum': float(numeric_series.sum()),
-                    'count': int(numeric_series.count()),
-                    'mean': float(numeric_series.mean()) if numeric_series.count() > 0 else 0,
-                    'min': float(numeric_series.min()) if numeric_series.count() > 0 else 0,
-                    'max': float(numeric_series.max()) if numeric_series.count() > 0 else 0
-                }
-            except:
-                totals[col] = {
-                    'sum': 0,
-                    'count': 0,
-                    'mean': 0,
-                    'min': 0,
-                    'max': 0,
-                    'error': 'Erro no cálculo'
-                }
+    valid_columns = [col for col in total_columns if col in df.columns]
+    if not valid_columns:
+        return totals
+    
+    try:
+        # Converter uma única vez e agregar todas as colunas de uma vez
+        numeric_df = to_numeric_frame(df, valid_columns)
+        stats = numeric_df.agg(['sum', 'count', 'mean', 'min', 'max'])
+    except Exception:
+        stats = None
+    
+    for col in valid_columns:
+        if stats is not None:
+            col_stats = stats[col]
+            has_values = col_stats['count'] > 0
+            totals[col] = {
+                'sum': round_total(col_stats['sum']),
+                'count': int(col_stats['count']),
+                'mean': round_total(col_stats['mean']) if has_values else 0,
+                'min': float(col_stats['min']) if has_values else 0,
+                'max': float(col_stats['max']) if has_values else 0
+            }
+        else:
+            totals[col] = {
+                'sum': 0,
+                'count': 0,
+                'mean': 0,
+                'min': 0,
+                'max': 0,
+                'error': 'Erro no cálculo'
+            }
     return totals
 
-def compare_spreadsheets_with_mapping(file1_path, file2_path, column_mapping, filters1=None, filters2=None, total_columns=None):
-    """Compara planilhas usando mapeamento específico de colunas"""
+def normalize_group_values(series):
+    """Normaliza valores de agrupamento para texto, como nas chaves compostas"""
+    series = as_plain_series(series)
+    # 281.0 (coluna float por causa de vazios) deve agrupar junto com 281
+    if pd.api.types.is_float_dtype(series):
+        non_null = series.dropna()
+        if len(non_null) > 0 and (non_null == non_null.round()).all():
+            series = series.astype('Int64')
+    return series.astype(object).fillna('NULL').astype(str)
+
+def round_group_sums(aggregated):
+    """Arredonda as colunas '|sum' da agregação por grupo, como round_total"""
+    for col in [col for col in aggregated.columns if col.endswith('|sum')]:
+        aggregated[col] = aggregated[col].map(round_total).astype('float64')
+
+def aggregate_by_group(df, group_cols, value_cols, suffix=''):
+    """Agrega soma e contagem por grupo numa única passagem groupby"""
+    group_names = [f'_g{i}' for i in range(len(group_cols))]
+    frame = to_numeric_frame(df, value_cols)
+    frame.columns = [f'_v{i}' for i in range(len(value_cols))]
+    for name, col in zip(group_names, group_cols):
+        frame[name] = normalize_group_values(df[col])
+    
+    grouped = frame.groupby(group_names, sort=False)
+    if value_cols:
+        aggregated = grouped.agg(['sum', 'count'])
+        aggregated.columns = [f'{col}|{stat}' for col, stat in aggregated.columns]
+        round_group_sums(aggregated)
+    else:
+        aggregated = pd.DataFrame(index=grouped.size().index)
+    aggregated['_rows'] = grouped.size()
+    aggregated.columns = [f'{col}{suffix}' for col in aggregated.columns]
+    return aggregated
+
+@timed_stage('grouped_totals', rows=lambda result, df1, df2, *args: frame_rows(df1, df2))
+def calculate_grouped_totals(df1, df2, group_mapping, value_mapping, max_rows=500):
+    """Reconciliação de totais por dimensão (ex.: por vendedor ou loja)
+    
+    group_mapping e value_mapping são listas de pares (coluna origem, coluna destino).
+    Retorna uma tabela lado a lado com os totais de cada grupo e as diferenças.
+    """
+    group_cols1 = [c1 for c1, c2 in group_mapping if c1 in df1.columns and c2 in df2.columns]
+    group_cols2 = [c2 for c1, c2 in group_mapping if c1 in df1.columns and c2 in df2.columns]
+    value_cols1 = [c1 for c1, c2 in value_mapping if c1 in df1.columns and c2 in df2.columns]
+    value_cols2 = [c2 for c1, c2 in value_mapping if c1 in df1.columns and c2 in df2.columns]
+    
+    if not group_cols1:
+        return {'error': 'Nenhuma coluna de agrupamento válida'}
+    
+    agg1 = aggregate_by_group(df1, group_cols1, value_cols1, suffix='|1')
+    agg2 = aggregate_by_group(df2, group_cols2, value_cols2, suffix='|2')
+    return reconcile_group_aggregates(agg1, agg2, group_cols1, group_cols2, value_cols1, max_rows)
+
+def reconcile_group_aggregates(agg1, agg2, group_cols1, group_cols2, value_cols1, max_rows=500):
+    """Tabela lado a lado a partir das agregações de cada planilha (formato de aggregate_by_group)"""
+    # Junção externa: grupos presentes em apenas uma das planilhas também aparecem
+    joined = agg1.join(agg2, how='outer').fillna(0)
+    
+    rows1 = joined['_rows|1']
+    rows2 = joined['_rows|2']
+    deltas = pd.DataFrame(index=joined.index)
+    for i in range(len(value_cols1)):
+        deltas[i] = joined[f'_v{i}|sum|2'] - joined[f'_v{i}|sum|1']
+    
+    max_delta = deltas.abs().max(axis=1) if value_cols1 else (rows2 - rows1).abs()
+    
+    # Tolerância relativa: um limite absoluto marcaria como diferentes somas grandes
+    # que só divergem no último dígito
+    status = pd.Series('ok', index=joined.index)
+    for i in range(len(value_cols1)):
+        close = np.isclose(joined[f'_v{i}|sum|2'], joined[f'_v{i}|sum|1'],
+                           rtol=TOTAL_RELATIVE_TOLERANCE, atol=1e-9)
+        status[~close] = 'diff'
+    status[rows1 != rows2] = 'diff'
+    status[rows2 == 0] = 'only_file1'
+    status[rows1 == 0] = 'only_file2'
+    
+    # Mostrar primeiro os grupos com maior diferença
+    order = max_delta.sort_values(ascending=False, kind='stable').index
+    
+    rows = []
+    for group in list(order)[:max_rows]:
+        group_values = list(group) if isinstance(group, tuple) else [group]
+        rows.append({
+            'group': group_values,
+            'rows1': int(rows1[group]),
+            'rows2': int(rows2[group]),
+            'status': status[group],
+            'values': {
+                col1: {
+                    'file1': float(joined.at[group, f'_v{i}|sum|1']),
+                    'file2': float(joined.at[group, f'_v{i}|sum|2']),
+                    'delta': float(deltas.at[group, i])
+                }
+                for i, col1 in enumerate(value_cols1)
+            }
+        })
+    
+    return {
+        'group_columns': group_cols1,
+        'group_columns_file2': group_cols2,
+        'value_columns': value_cols1,
+        'rows': rows,
+        'summary': {
+            'groups': len(joined),
+            'matching': int((status == 'ok').sum()),
+            'different': int((status == 'diff').sum()),
+            'only_file1': int((status == 'only_file1').sum()),
+            'only_file2': int((status == 'only_file2').sum()),
+            'truncated': len(joined) > max_rows
+        }
+    }
+
+# Cache dos resultados da comparação: chaves pelo conteúdo dos arquivos (SHA-256) e pela
+# forma canônica dos parâmetros; etapas intermediárias (planilhas filtradas e linhas
+# exclusivas) são reaproveitadas quando só parâmetros posteriores mudam (ex.: totalizadores)
+COMPARISON_CACHE_MAX_BYTES = int(float(os.environ.get('COMPARISON_CACHE_MAX_MB', 256)) * 1024 * 1024)
+CONTENT_HASH_BLOCK = 1024 * 1024
+CONTENT_HASH_MEMO_ENTRIES = 256
+_content_hashes = OrderedDict()
+_content_hashes_lock = threading.Lock()
+
+def file_content_hash(file_path):
+    """SHA-256 do arquivo, memorizado por caminho, tamanho e data de modificação"""
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _content_hashes_lock:
+        if memo_key in _content_hashes:
+            return _content_hashes[memo_key]
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(CONTENT_HASH_BLOCK), b''):
+            digest.update(block)
+    remember_content_hash(file_path, digest.hexdigest(), stat)
+    return digest.hexdigest()
+
+def remember_content_hash(file_path, content_hash, stat=None):
+    """Registra um SHA-256 já conhecido (ex.: calculado durante o upload em partes)"""
+    stat = stat or os.stat(file_path)
+    with _content_hashes_lock:
+        _content_hashes[(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)] = content_hash
+        while len(_content_hashes) > CONTENT_HASH_MEMO_ENTRIES:
+            _content_hashes.popitem(last=False)
+
+def canonical_json(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+def canonical_filters(filters):
+    """Filtros são combinados com E: a ordem em que foram adicionados não muda o resultado"""
+    return canonical_json(sorted(canonical_json(f) for f in filters or []))
+
+class ComparisonCache:
+    """LRU em memória, limitado em bytes, com métricas de acerto por etapa"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # chave -> (valor, bytes)
+        self.bytes = 0
+    
+    def get(self, stage, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        metrics.inc('checkplanilhas_comparison_cache_total',
+                    {'stage': stage, 'result': 'hit' if entry is not None else 'miss'},
+                    help_text='Consultas ao cache de comparações por etapa e resultado')
+        return entry[0] if entry is not None else None
+    
+    def contains(self, key):
+        """Consulta sem efeito no LRU nem nas métricas (usada pelo plano da comparação)"""
+        with self.lock:
+            return key in self.entries
+    
+    def put(self, stage, key, value, nbytes):
+        # Uma entrada não pode ocupar mais de um quarto do cache
+        if nbytes > self.max_bytes // 4:
+            return
+        evicted = 0
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.entries[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, size) = self.entries.popitem(last=False)
+                self.bytes -= size
+                evicted += 1
+            entries, total = len(self.entries), self.bytes
+        if evicted:
+            metrics.inc('checkplanilhas_comparison_cache_evictions_total', value=evicted,
+                        help_text='Entradas removidas do cache de comparações por falta de espaço')
+        metrics.set('checkplanilhas_comparison_cache_entries', entries, help_text='Entradas no cache de comparações')
+        metrics.set('checkplanilhas_comparison_cache_bytes', total, help_text='Bytes ocupados pelo cache de comparações')
+
+comparison_cache = ComparisonCache(COMPARISON_CACHE_MAX_BYTES)
+
+def comparison_frame_key(content_hash, filters):
+    """Identifica a planilha carregada e filtrada nos caches derivados dela"""
+    return (content_hash, canonical_filters(filters))
+
+def load_filtered_frame(file_path, content_hash, filters):
+    """Planilha carregada e filtrada, reaproveitada entre comparações com os mesmos filtros"""
+    key = ('frame',) + comparison_frame_key(content_hash, filters)
+    df = comparison_cache.get('frame', key)
+    if df is None:
+        df = load_spreadsheet(file_path)
+        if df is None:
+            return None
+        if filters:
+            df = apply_filters(df, filters).reset_index(drop=True)
+        comparison_cache.put('frame', key, df, frame_bytes(df))
+    return df
+
+def cached_hashes(key, compute):
+    """Vetor de hashes do cache de comparações (colunas e chaves compostas de uma planilha filtrada)"""
+    hashes = comparison_cache.get('key_hashes', key)
+    if hashes is None:
+        hashes = compute()
+        comparison_cache.put('key_hashes', key, hashes, hashes.nbytes)
+    return hashes
+
+def cached_key_hashes(df, key_cols, kinds, frame_key=None):
+    """composite_key_hashes, reaproveitado pela identificação da planilha (hash do conteúdo e filtros)"""
+    if frame_key is None:
+        return composite_key_hashes(df, key_cols, kinds)
+    return cached_hashes(('composite',) + frame_key + (tuple(key_cols), tuple(kinds)),
+                         lambda: composite_key_hashes(df, key_cols, kinds))
+
+# Backends de execução da comparação: filtros, linhas exclusivas e totais. O pandas (padrão)
+# trabalha com as planilhas inteiras em memória; o SQLite carrega cada arquivo uma vez num
+# banco em disco (pelo hash do conteúdo) e resolve tudo em SQL, só com a biblioteca padrão
+COMPARISON_BACKEND = os.environ.get('COMPARISON_BACKEND', 'pandas')
+SQLITE_BACKEND_FOLDER = os.environ.get('SQLITE_BACKEND_DIR') or os.path.join(app.instance_path, 'sqlite')
+SQLITE_BACKEND_MAX_BYTES = int(float(os.environ.get('SQLITE_BACKEND_MAX_MB', 8192)) * 1024 * 1024)
+SQLITE_LOAD_CHUNK_ROWS = 50000
+SQLITE_SCHEMA_VERSION = 2  # muda o nome dos bancos quando o formato muda
+SQLITE_BUSY_TIMEOUT = 30  # segundos esperando outro processo que cria índice no mesmo banco
+RESULT_SAMPLE_ROWS = 10  # linhas exclusivas de amostra no resultado
+
+class PandasComparison:
+    """Planilhas filtradas em memória, com as funções de sempre"""
+    
+    def __init__(self, df1, df2, content_hashes, filters1, filters2):
+        self.df1, self.df2 = df1, df2
+        self.rows1, self.rows2 = len(df1), len(df2)
+        self.columns1, self.columns2 = list(df1.columns), list(df2.columns)
+        self.content_hashes = content_hashes
+        self.filters1, self.filters2 = filters1, filters2
+    
+    def checksums(self, side, columns):
+        return column_checksums(self.df1 if side == 1 else self.df2, columns) if COLUMN_CHECKSUMS_ENABLED else {}
+    
+    def unique_rows(self, column_mapping, identical_pairs=None):
+        """(linhas só na origem, amostra, linhas só no destino, amostra, campos da comparação)"""
+        unique_key = ('unique_rows',) + tuple(self.content_hashes) + (canonical_json(column_mapping),
+                                                                     canonical_filters(self.filters1),
+                                                                     canonical_filters(self.filters2))
+        unique_rows = comparison_cache.get('unique_rows', unique_key)
+        if unique_rows is None:
+            frame_keys = (comparison_frame_key(self.content_hashes[0], self.filters1),
+                          comparison_frame_key(self.content_hashes[1], self.filters2))
+            unique_rows = find_unique_rows_by_intelligent_keys(self.df1, self.df2, column_mapping, identical_pairs,
+                                                               frame_keys)
+            comparison_cache.put('unique_rows', unique_key, unique_rows, frame_bytes(*unique_rows[:2]))
+        rows_only_in_1, rows_only_in_2, comparison_columns = unique_rows
+        return (len(rows_only_in_1), rows_only_in_1.head(RESULT_SAMPLE_ROWS).to_dict('records') if len(rows_only_in_1) > 0 else [],
+                len(rows_only_in_2), rows_only_in_2.head(RESULT_SAMPLE_ROWS).to_dict('records') if len(rows_only_in_2) > 0 else [],
+                comparison_columns)
+    
+    def totals(self, side, columns):
+        return calculate_totals(self.df1 if side == 1 else self.df2, columns)
+    
+    def grouped_totals(self, group_mapping, value_mapping):
+        return calculate_grouped_totals(self.df1, self.df2, group_mapping, value_mapping)
+
+class PandasBackend:
+    name = 'pandas'
+    
+    @contextmanager
+    def open(self, file1_path, file2_path, content_hashes, filters1, filters2):
+        """Reserva a memória da comparação e carrega as planilhas filtradas; None se a leitura falhar"""
+        with memory_admission('compare', file1_path, file2_path):
+            df1 = load_filtered_frame(file1_path, content_hashes[0], filters1)
+            df2 = load_filtered_frame(file2_path, content_hashes[1], filters2)
+            logger.debug("DF1 carregado: %s, shape: %s", type(df1), df1.shape if df1 is not None else 'None')
+            logger.debug("DF2 carregado: %s, shape: %s", type(df2), df2.shape if df2 is not None else 'None')
+            if df1 is None or df2 is None:
+                yield None
+            else:
+                yield PandasComparison(df1, df2, content_hashes, filters1, filters2)
+
+def sqlite_column_kind(series):
+    """Tipo lógico da coluna no bloco lido: define como os valores viram texto, como no pandas"""
+    kind = series.dtype.kind
+    if kind in 'iu':
+        return 'int'
+    if kind == 'f':
+        return 'float'
+    if kind == 'b':
+        return 'bool'
+    if kind == 'M':
+        return 'datetime'
+    return 'text'
+
+def merge_column_kinds(kind, other):
+    """Tipo da coluna no arquivo inteiro: um bloco com vazios transforma inteiros em float"""
+    if kind is None or kind == other:
+        return other
+    if {kind, other} == {'int', 'float'}:
+        return 'float'
+    return 'text'
+
+def sqlite_key_text(kinds, *values):
+    """Chave composta em texto, igual à de find_unique_rows_by_intelligent_keys (vazios como 'NULL')"""
+    parts = []
+    for kind, value in zip(kinds.split(','), values):
+        if value is None:
+            parts.append('NULL')
+        elif kind == 'float':
+            parts.append(repr(float(value)))
+        elif kind == 'int':
+            parts.append(str(int(value)))
+        elif kind == 'bool':
+            parts.append(str(bool(value)))
+        else:
+            parts.append(str(value))
+    return '|'.join(parts)
+
+def sqlite_pandas_text(kind, value):
+    """Texto do valor como em series.astype(str), usado pelos filtros de texto"""
+    return 'nan' if value is None else sqlite_key_text(kind, value)
+
+def sqlite_to_number(value):
+    """pd.to_numeric(errors='coerce') de um único valor"""
+    if value is None or isinstance(value, (int, float)):
+        return value
     try:
-        print(f"[DEBUG] Iniciando comparação com mapeamento")
-        print(f"[DEBUG] Arquivo 1: {file1_path}")
-        print(f"[DEBUG] Arquivo 2: {file2_path}")
-        print(f"[DEBUG] Mapeamento: {column_mapping}")
-        print(f"[DEBUG] Filtros1: {filters1}")
-        print(f"[DEBUG] Filtros2: {filters2}")
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=64)
+def compiled_filter_pattern(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+def register_sqlite_functions(connection):
+    connection.create_function('key_text', -1, sqlite_key_text, deterministic=True)
+    connection.create_function('pandas_text', 2, sqlite_pandas_text, deterministic=True)
+    connection.create_function('to_number', 1, sqlite_to_number, deterministic=True)
+    connection.create_function('regex_search', 2, lambda text, pattern: compiled_filter_pattern(pattern).search(text) is not None,
+                               deterministic=True)
+    connection.create_function('starts_with', 2, lambda text, prefix: text.startswith(prefix), deterministic=True)
+    connection.create_function('ends_with', 2, lambda text, suffix: text.endswith(suffix), deterministic=True)
+
+def iter_spreadsheet_chunks(file_path, dtypes=True):
+    """Blocos de linhas lidos como em load_spreadsheet (mesmo dialeto e mapa de tipos), sem compactação.
+    
+    Planilhas Excel não têm leitura em blocos: são lidas inteiras e depois fatiadas.
+    """
+    if spreadsheet_format(file_path)[0] != 'csv':
+        df = pd.read_excel(file_path)
+        for start in range(0, max(len(df), 1), SQLITE_LOAD_CHUNK_ROWS):
+            yield df.iloc[start:start + SQLITE_LOAD_CHUNK_ROWS]
+        return
+    head, complete, dialect = sniff_csv_file(file_path)
+    column_types = infer_csv_dtypes(read_csv_sample(head, dialect, complete)) if dtypes else None
+    with open_spreadsheet_stream(file_path) as f:
+        yield from pd.read_csv(f, dtype=column_types or None, chunksize=SQLITE_LOAD_CHUNK_ROWS,
+                               **csv_read_options(dialect))
+
+def build_sqlite_database(file_path, database_path):
+    """Carrega a planilha bloco a bloco na tabela `dados` (colunas c0, c1, ...) e os tipos em `colunas`"""
+    private_cache_directory(SQLITE_BACKEND_FOLDER)
+    temp = f'{database_path}.{uuid.uuid4().hex}.tmp'
+    rows = 0
+    try:
+        # Mapa de tipos da amostra que não vale para o arquivo inteiro: recarregar sem ele, como read_csv_file;
+        # codificação que falha no meio do arquivo: recarregar com a próxima (fica memorizada)
+        dtypes = True
+        while True:
+            connection = sqlite3.connect(temp)
+            try:
+                connection.execute('PRAGMA journal_mode=OFF')
+                connection.execute('PRAGMA synchronous=OFF')
+                columns, kinds = None, None
+                for chunk in iter_spreadsheet_chunks(file_path, dtypes):
+                    if columns is None:
+                        columns, kinds = list(chunk.columns), [None] * len(chunk.columns)
+                        checksums, chunk_kinds = [ColumnChecksum() for _ in columns], [set() for _ in columns]
+                        connection.execute(f'CREATE TABLE dados ({", ".join(f"c{i}" for i in range(len(columns)))})')
+                        insert = f'INSERT INTO dados VALUES ({", ".join("?" * len(columns))})'
+                    values = []
+                    for position in range(len(columns)):
+                        series = chunk.iloc[:, position]
+                        kinds[position] = merge_column_kinds(kinds[position], sqlite_column_kind(series))
+                        chunk_kinds[position].add(sqlite_column_kind(series))
+                        checksums[position].update(column_value_hashes(series))
+                        if series.dtype.kind == 'M':
+                            series = series.map(str, na_action='ignore')
+                        values.append(series.astype(object).where(series.notna(), None).tolist())
+                    connection.executemany(insert, zip(*values))
+                    rows += len(chunk)
+                # Checksums como os de column_checksums; inválidos se o tipo mudou entre os blocos
+                connection.execute('CREATE TABLE colunas (posicao INTEGER, nome TEXT, tipo TEXT, ordenado TEXT, conteudo TEXT)')
+                connection.executemany('INSERT INTO colunas VALUES (?, ?, ?, ?, ?)', [
+                    (i, str(col), kind) + (checksums[i].result() if chunk_kinds[i] == {kind} else (None, None))
+                    for i, (col, kind) in enumerate(zip(columns or [], kinds or []))
+                ])
+                connection.commit()
+                break
+            except UnicodeDecodeError as e:
+                if fall_back_csv_encoding(file_path, csv_dialect_of(file_path), e) is None:
+                    raise
+            except (ValueError, TypeError) as e:
+                if not dtypes:
+                    raise
+                logger.debug("Mapa de tipos da amostra não vale para %s: %s", file_path, e)
+                dtypes = False
+            finally:
+                connection.close()
+            rows = 0
+            os.remove(temp)
+        os.replace(temp, database_path)
+        temp = None
+    finally:
+        if temp and os.path.exists(temp):
+            os.remove(temp)
+    return rows
+
+def sqlite_database_path(content_hash):
+    return os.path.join(SQLITE_BACKEND_FOLDER, f'{content_hash}.v{SQLITE_SCHEMA_VERSION}.sqlite3')
+
+def sqlite_database_for(file_path, content_hash):
+    """Banco SQLite da planilha, criado na primeira comparação do conteúdo e reaproveitado depois"""
+    database_path = sqlite_database_path(content_hash)
+    private_cache_directory(SQLITE_BACKEND_FOLDER)
+    if os.path.exists(database_path):
+        if not is_private_file(database_path):
+            raise PermissionError(f'{database_path} é de outro usuário ou gravável por outros')
+        os.utime(database_path)
+        return database_path
+    with stage_timer('sqlite_load', nbytes=os.path.getsize(file_path)):
+        rows = build_sqlite_database(file_path, database_path)
+    logger.info("Planilha %s carregada no SQLite: %s linhas", os.path.basename(file_path), rows)
+    prune_sqlite_databases()
+    return database_path
+
+def prune_sqlite_databases():
+    """Remove cargas interrompidas e os bancos menos usados acima do limite"""
+    try:
+        names = os.listdir(SQLITE_BACKEND_FOLDER)
+    except OSError:
+        return
+    now = time.time()
+    entries = []
+    for name in names:
+        path = os.path.join(SQLITE_BACKEND_FOLDER, name)
+        try:
+            if name.endswith('.tmp'):
+                if now - os.path.getmtime(path) > DATASET_CACHE_STALE_SECONDS:
+                    os.remove(path)
+            elif name.endswith('.sqlite3'):
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= SQLITE_BACKEND_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    metrics.set('checkplanilhas_sqlite_backend_bytes', total, help_text='Tamanho dos bancos SQLite em disco')
+
+class SqliteTable:
+    """Uma planilha anexada à conexão, já filtrada (tabela temporária) quando há filtros"""
+    
+    def __init__(self, connection, schema, filters):
+        self.connection = connection
+        self.schema = schema
+        self.kinds = {}
+        self.sql_names = {}
+        self.checksums = {}
+        for position, name, kind, ordered, unordered in connection.execute(
+                f'SELECT posicao, nome, tipo, ordenado, conteudo FROM {schema}.colunas ORDER BY posicao'):
+            self.kinds[name] = kind
+            self.sql_names[name] = f'c{position}'
+            if ordered is not None:
+                self.checksums[name] = (ordered, unordered)
+        self.columns = list(self.kinds)
+        self.relation = f'{schema}.dados'
         
-        # Ler as planilhas
-        df1 = load_spreadsheet(file1_path)
-        df2 = load_spreadsheet(file2_path)
+        conditions, params = [], []
+        for filter_config in filters or []:
+            condition = self.filter_condition(filter_config)
+            if condition is not None:
+                conditions.append(condition[0])
+                params.extend(condition[1])
+        if conditions:
+            # Tabela temporária na ordem original: rowid continua sendo a posição da linha
+            connection.execute(f'CREATE TEMP TABLE filtrada_{schema} AS SELECT * FROM {self.relation} '
+                               f'WHERE {" AND ".join(conditions)} ORDER BY rowid', params)
+            self.relation = f'temp.filtrada_{schema}'
+            self.checksums = {}  # calculados na carga, valem só para a planilha inteira
+        self.rows = connection.execute(f'SELECT COUNT(*) FROM {self.relation}').fetchone()[0]
+    
+    def filter_condition(self, filter_config):
+        """(SQL, parâmetros) com a mesma semântica de build_filter_mask; None ignora o filtro"""
+        column = filter_config.get('column')
+        operator = filter_config.get('operator')
+        value = filter_config.get('value')
+        if not column or column not in self.kinds:
+            logger.debug("Coluna '%s' não encontrada", column)
+            return None
+        name, kind = self.sql_names[column], self.kinds[column]
+        numeric = kind in ('int', 'float', 'bool')
         
-        print(f"[DEBUG] DF1 carregado: {type(df1)}, shape: {df1.shape if df1 is not None else 'None'}")
-        print(f"[DEBUG] DF2 carregado: {type(df2)}, shape: {df2.shape if df2 is not None else 'None'}")
+        if operator in INDEXED_OPERATORS:
+            raw_values = [v.strip() for v in str(value).split(',')] if operator == 'in' else [value]
+            values = []
+            for raw in raw_values:
+                if numeric:
+                    try:
+                        raw = pd.to_numeric(raw)
+                        raw = raw.item() if hasattr(raw, 'item') else raw
+                    except Exception:
+                        pass
+                values.append(raw)
+            self.create_index(name)
+            if operator == 'equals':
+                return f'{name} = ?', values
+            if operator == 'not_equals':
+                return f'{name} IS NOT ?', values
+            return f'{name} IN ({", ".join("?" * len(values))})', values
         
-        if df1 is None or df2 is None:
-            return {'error': 'Erro ao carregar as planilhas'}
+        text = f"pandas_text('{kind}', {name})"
+        if operator in ('contains', 'not_contains'):
+            try:
+                compiled_filter_pattern(str(value))
+            except re.error as e:
+                logger.debug("Erro ao aplicar filtro %s %s: %s", column, operator, e)
+                return None
+            negation = 'NOT ' if operator == 'not_contains' else ''
+            return f'{negation}regex_search({text}, ?)', [str(value)]
+        if operator == 'starts_with':
+            return f'starts_with({text}, ?)', [str(value)]
+        if operator == 'ends_with':
+            return f'ends_with({text}, ?)', [str(value)]
+        if operator in ('greater_than', 'less_than'):
+            number = pd.to_numeric(value, errors='coerce')
+            if pd.isna(number):
+                return '0', []
+            comparison = '>' if operator == 'greater_than' else '<'
+            return f'{name if numeric else f"to_number({name})"} {comparison} ?', [float(number)]
+        if operator == 'is_empty':
+            return f"({name} IS NULL OR {name} = '')", []
+        if operator == 'is_not_empty':
+            return f"({name} IS NOT NULL AND {name} != '')", []
+        return None
+    
+    def create_index(self, name):
+        """Índice persistente na coluna filtrada; serve às próximas comparações do mesmo arquivo"""
+        try:
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS {self.schema}.dados_{name} ON dados ({name})')
+        except sqlite3.OperationalError as e:
+            logger.debug("Índice não criado em %s.%s: %s", self.schema, name, e)
+    
+    def read_rows(self, rowids, columns=None):
+        """DataFrame das linhas pedidas (rowid = posição + 1), com os tipos do pandas"""
+        columns = self.columns if columns is None else columns
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS linhas_pedidas (linha INTEGER PRIMARY KEY)')
+        self.connection.execute('DELETE FROM temp.linhas_pedidas')
+        self.connection.executemany('INSERT INTO temp.linhas_pedidas VALUES (?)', ((int(rowid),) for rowid in rowids))
+        rows = self.connection.execute(
+            f'SELECT {", ".join(self.sql_names[col] for col in columns)} FROM {self.relation} '
+            f'WHERE rowid IN (SELECT linha FROM temp.linhas_pedidas) ORDER BY rowid'
+        ).fetchall()
+        df = pd.DataFrame(rows, columns=columns) if rows else pd.DataFrame({col: [] for col in columns})
+        for col in columns:
+            kind = self.kinds[col]
+            if kind == 'float':
+                df[col] = df[col].astype('float64')
+            elif kind == 'int':
+                df[col] = df[col].astype('int64')
+            elif kind == 'bool':
+                df[col] = df[col].astype(bool)
+            elif kind == 'datetime':
+                df[col] = pd.to_datetime(df[col])
+            else:
+                df[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+        return df
+    
+    def key_expression(self, columns):
+        kinds = ','.join(self.kinds[col] for col in columns)
+        return f"key_text('{kinds}', {', '.join(self.sql_names[col] for col in columns)})"
+    
+    def build_keys(self, columns, table_name):
+        """Tabela temporária (linha, chave) com índice na chave composta"""
+        self.connection.execute(f'CREATE TEMP TABLE {table_name} AS '
+                                f'SELECT rowid AS linha, {self.key_expression(columns)} AS chave FROM {self.relation}')
+        self.connection.execute(f'CREATE INDEX temp.{table_name}_chave ON {table_name} (chave)')
+    
+    def totals(self, columns):
+        """Totais no formato de calculate_totals, com a conversão numérica de to_numeric"""
+        totals = {}
+        for col in [col for col in columns if col in self.kinds]:
+            name = self.sql_names[col]
+            value = name if self.kinds[col] in ('int', 'float', 'bool') else f'to_number({name})'
+            try:
+                total, count, minimum, maximum = self.connection.execute(
+                    f'SELECT TOTAL({value}), COUNT({value}), MIN({value}), MAX({value}) FROM {self.relation}'
+                ).fetchone()
+            except sqlite3.Error:
+                totals[col] = {'sum': 0, 'count': 0, 'mean': 0, 'min': 0, 'max': 0, 'error': 'Erro no cálculo'}
+                continue
+            has_values = count > 0
+            totals[col] = {
+                'sum': round_total(total),
+                'count': int(count),
+                'mean': round_total(total / count) if has_values else 0,
+                'min': float(minimum) if has_values else 0,
+                'max': float(maximum) if has_values else 0
+            }
+        return totals
+    
+    def group_expression(self, col):
+        """Valor do grupo em texto, como normalize_group_values (float inteiro agrupa com o inteiro)"""
+        name, kind = self.sql_names[col], self.kinds[col]
+        if kind == 'float':
+            fractional = self.connection.execute(
+                f'SELECT 1 FROM {self.relation} WHERE {name} IS NOT NULL AND {name} != CAST({name} AS INTEGER) LIMIT 1'
+            ).fetchone()
+            if fractional is None:
+                kind = 'int'
+        return f"key_text('{kind}', {name})"
+    
+    def aggregate_by_group(self, group_cols, value_cols, suffix=''):
+        """Soma e contagem por grupo em SQL, no formato de aggregate_by_group"""
+        group_names = [f'_g{i}' for i in range(len(group_cols))]
+        selects = [f'{self.group_expression(col)} AS {name}' for col, name in zip(group_cols, group_names)]
+        value_names = []
+        for i, col in enumerate(value_cols):
+            name = self.sql_names[col]
+            value = name if self.kinds[col] in ('int', 'float', 'bool') else f'to_number({name})'
+            selects += [f'TOTAL({value})', f'COUNT({value})']
+            value_names += [f'_v{i}|sum', f'_v{i}|count']
+        # Grupos na ordem da primeira linha, como groupby(sort=False)
+        rows = self.connection.execute(
+            f'SELECT {", ".join(selects)}, COUNT(*) FROM {self.relation} '
+            f'GROUP BY {", ".join(str(i + 1) for i in range(len(group_cols)))} ORDER BY MIN(rowid)'
+        ).fetchall()
+        aggregated = pd.DataFrame(rows, columns=group_names + value_names + ['_rows']).set_index(group_names)
+        aggregated = aggregated.astype({name: 'float64' for name in value_names if name.endswith('|sum')})
+        round_group_sums(aggregated)
+        aggregated.columns = [f'{col}{suffix}' for col in aggregated.columns]
+        return aggregated
+
+class SqliteKeySearchSide(KeySearchSide):
+    """Lado da busca de chave com a amostra lida do SQLite e a confirmação em SQL"""
+    
+    def __init__(self, table, columns, sample_rows=KEY_SEARCH_SAMPLE_ROWS):
+        self.table = table
+        self.columns = columns
+        self.set_sample(table.read_rows(self.sample_positions(table.rows, sample_rows) + 1, columns))
+    
+    def confirm_unique(self, columns):
+        keys = ', '.join(self.table.sql_names[col] for col in columns)
+        repeated = f'GROUP BY {keys} HAVING COUNT(*) > 1 LIMIT 1'
+        if self.table.connection.execute(f'SELECT 1 FROM {self.table.relation} {repeated}').fetchone() is None:
+            return True
+        # Chaves repetidas só valem se as linhas forem idênticas em todas as colunas mapeadas
+        mapped = ', '.join(self.table.sql_names[col] for col in self.columns)
+        return self.table.connection.execute(
+            f'SELECT 1 FROM (SELECT DISTINCT {mapped} FROM {self.table.relation}) {repeated}'
+        ).fetchone() is None
+
+class SqliteComparison:
+    """As duas planilhas anexadas a uma conexão SQLite; chaves, linhas exclusivas e totais em SQL"""
+    
+    def __init__(self, connection, file_paths, content_hashes, filters1, filters2):
+        self.connection = connection
+        self.file_paths = file_paths
+        self.content_hashes = content_hashes
+        self.filters1, self.filters2 = filters1, filters2
+        with stage_timer('filter'):
+            self.table1 = SqliteTable(connection, 'p1', filters1)
+            self.table2 = SqliteTable(connection, 'p2', filters2)
+        self.rows1, self.rows2 = self.table1.rows, self.table2.rows
+        self.columns1, self.columns2 = self.table1.columns, self.table2.columns
+    
+    def checksums(self, side, columns):
+        table = self.table1 if side == 1 else self.table2
+        return {col: table.checksums[col] for col in columns if col in table.checksums} if COLUMN_CHECKSUMS_ENABLED else {}
+    
+    def unique_rows(self, column_mapping, identical_pairs=None):
+        pairs = [(col1, col2) for col1, col2 in (column_mapping or {}).items()
+                 if col1 in self.table1.kinds and col2 in self.table2.kinds]
+        selected_fields = []
+        if pairs and self.rows1 and self.rows2:
+            with stage_timer('key_selection', rows=self.rows1 + self.rows2):
+                side1 = SqliteKeySearchSide(self.table1, [col1 for col1, _ in pairs])
+                side2 = SqliteKeySearchSide(self.table2, [col2 for _, col2 in pairs])
+                _, _, selected_fields = search_key_fields(pairs, side1, side2, 1, 6,
+                                                          time.perf_counter() + KEY_SEARCH_TIME_BUDGET)
+        if not selected_fields:
+            # Sem campos-chave (planilha vazia ou sem mapeamento): comparação simples do pandas
+            logger.debug("Nenhum campo-chave adequado encontrado, usando comparação simples em memória")
+            df1 = load_filtered_frame(self.file_paths[0], self.content_hashes[0], self.filters1)
+            df2 = load_filtered_frame(self.file_paths[1], self.content_hashes[1], self.filters2)
+            return PandasComparison(df1, df2, self.content_hashes, self.filters1,
+                                    self.filters2).unique_rows(column_mapping, identical_pairs)
         
-        # Aplicar filtros se especificados
-        if filters1:
-            print(f"[DEBUG] Aplicando filtros em DF1...")
-            df1_filtered = apply_filters(df1, filters1)
-            print(f"[DEBUG] DF1 após filtros: {type(df1_filtered)}, shape: {df1_filtered.shape if hasattr(df1_filtered, 'shape') else 'N/A'}")
-            df1 = df1_filtered.reset_index(drop=True)
-            
-        if filters2:
-            print(f"[DEBUG] Aplicando filtros em DF2...")
-            df2_filtered = apply_filters(df2, filters2)
-            print(f"[DEBUG] DF2 após filtros: {type(df2_filtered)}, shape: {df2_filtered.shape if hasattr(df2_filtered, 'shape') else 'N/A'}")
-            df2 = df2_filtered.reset_index(drop=True)
+        comparison_info = [f"{f['col1']} ↔ {f['col2']} (score: {f['combined_score']:.1f})" for f in selected_fields]
+        if identical_key_fields(selected_fields, identical_pairs):
+            return 0, [], 0, [], comparison_info
         
-        results = {}
+        with stage_timer('unique_rows', rows=self.rows1 + self.rows2):
+            self.table1.build_keys([f['col1'] for f in selected_fields], 'chaves_1')
+            self.table2.build_keys([f['col2'] for f in selected_fields], 'chaves_2')
+            result = []
+            for table, keys, other in ((self.table1, 'chaves_1', 'chaves_2'), (self.table2, 'chaves_2', 'chaves_1')):
+                only = f'FROM temp.{keys} k WHERE NOT EXISTS (SELECT 1 FROM temp.{other} o WHERE o.chave = k.chave)'
+                count = self.connection.execute(f'SELECT COUNT(*) {only}').fetchone()[0]
+                rowids = [row[0] for row in self.connection.execute(
+                    f'SELECT linha {only} ORDER BY linha LIMIT {RESULT_SAMPLE_ROWS}')]
+                result += [count, table.read_rows(rowids).to_dict('records') if count else []]
+        return tuple(result) + (comparison_info,)
+    
+    def totals(self, side, columns):
+        with stage_timer('totals', rows=self.rows1 if side == 1 else self.rows2):
+            return (self.table1 if side == 1 else self.table2).totals(columns)
+    
+    def grouped_totals(self, group_mapping, value_mapping, max_rows=500):
+        valid = lambda mapping: [(c1, c2) for c1, c2 in mapping if c1 in self.table1.kinds and c2 in self.table2.kinds]
+        group_mapping, value_mapping = valid(group_mapping), valid(value_mapping)
+        if not group_mapping:
+            return {'error': 'Nenhuma coluna de agrupamento válida'}
+        group_cols1, group_cols2 = [c1 for c1, _ in group_mapping], [c2 for _, c2 in group_mapping]
+        value_cols1, value_cols2 = [c1 for c1, _ in value_mapping], [c2 for _, c2 in value_mapping]
+        with stage_timer('grouped_totals', rows=self.rows1 + self.rows2):
+            agg1 = self.table1.aggregate_by_group(group_cols1, value_cols1, suffix='|1')
+            agg2 = self.table2.aggregate_by_group(group_cols2, value_cols2, suffix='|2')
+            return reconcile_group_aggregates(agg1, agg2, group_cols1, group_cols2, value_cols1, max_rows)
+
+class SqliteBackend:
+    name = 'sqlite'
+    
+    @contextmanager
+    def open(self, file1_path, file2_path, content_hashes, filters1, filters2):
+        """Anexa os bancos das duas planilhas (criados na primeira vez) a uma conexão nova.
         
-        # Informações sobre mapeamento usado
-        results['mapping_info'] = {
-            'column_mapping': column_mapping,
-            'mapped_columns_count': len(column_mapping),
-            'original_columns': {
-                'file1': len(df1.columns),
-                'file2': len(df2.columns)
-            }
-        }
+        Sem reserva no orçamento de memória: a carga lê um bloco por vez e as consultas
+        usam o cache de páginas do SQLite e tabelas temporárias em disco.
+        """
+        try:
+            paths = [sqlite_database_for(path, content_hash)
+                     for path, content_hash in zip((file1_path, file2_path), content_hashes)]
+        except Exception as e:
+            logger.exception("Erro ao carregar planilha no SQLite: %s", e)
+            yield None
+            return
+        connection = sqlite3.connect(':memory:', timeout=SQLITE_BUSY_TIMEOUT)
+        try:
+            register_sqlite_functions(connection)
+            connection.execute('ATTACH DATABASE ? AS p1', (paths[0],))
+            connection.execute('ATTACH DATABASE ? AS p2', (paths[1],))
+            yield SqliteComparison(connection, (file1_path, file2_path), content_hashes, filters1, filters2)
+        finally:
+            connection.close()
+
+COMPARISON_BACKENDS = {backend.name: backend for backend in (PandasBackend(), SqliteBackend())}
+
+def get_comparison_backend(name=None):
+    name = name or COMPARISON_BACKEND
+    if name not in COMPARISON_BACKENDS:
+        raise ValueError(f"Backend de comparação desconhecido: {name}")
+    return COMPARISON_BACKENDS[name]
+
+def compare_spreadsheets_with_mapping(file1_path, file2_path, column_mapping, filters1=None, filters2=None, total_columns=None, group_columns=None,
+                                     key_fields=None, sorted_inputs=False, backend=None):
+    """Compara planilhas usando mapeamento específico de colunas, reaproveitando resultados já calculados.
+    
+    Com key_fields (campos-chave já escolhidos) e CSVs sem filtros nem agrupamento, tenta a
+    comparação em fluxo: quando o usuário declarou os arquivos ordenados (sorted_inputs) ou,
+    com MERGE_DIFF_AUTO, quando o início dos dois arquivos está ordenado pela chave.
+    Fora desse caso, a comparação roda no backend pedido (COMPARISON_BACKEND por padrão).
+    """
+    return collect_comparison_sections(iter_compare_spreadsheets_with_mapping(
+        file1_path, file2_path, column_mapping, filters1, filters2, total_columns, group_columns,
+        key_fields, sorted_inputs, backend
+    ))
+
+def iter_compare_spreadsheets_with_mapping(file1_path, file2_path, column_mapping, filters1=None, filters2=None, total_columns=None,
+                                           group_columns=None, key_fields=None, sorted_inputs=False, backend=None):
+    """compare_spreadsheets_with_mapping por seções: gera (seção, chaves do resultado) à medida que cada etapa termina.
+    
+    Resultado do cache e comparação em fluxo chegam de uma vez ('complete'); uma falha
+    encerra a sequência com ('error', {'error': mensagem}).
+    """
+    try:
+        backend = get_comparison_backend(backend)
+        content_hashes = (file_content_hash(file1_path), file_content_hash(file2_path))
+        key, merge_allowed = comparison_result_key(file1_path, file2_path, content_hashes, column_mapping, filters1,
+                                                   filters2, total_columns, group_columns, key_fields,
+                                                   sorted_inputs, backend.name)
+        results = comparison_cache.get('result', key)
+        if results is not None:
+            # Cópia: quem renderiza não deve alterar a entrada do cache
+            yield 'complete', copy.deepcopy(results)
+            return
         
-        # Comparar dimensões
-        results['dimensions'] = {
-            'file1': {'rows': len(df1), 'cols': len(df1.columns)},
-            'file2': {'rows': len(df2), 'cols': len(df2.columns)},
-            'mapped_cols': len(column_mapping)
-        }
+        cost_inputs = comparison_cost_inputs(file1_path, file2_path, content_hashes, filters1, filters2)
+        started = time.perf_counter()
+        if merge_allowed:
+            try:
+                results = compare_sorted_csv_files(file1_path, file2_path, column_mapping, key_fields,
+                                                   total_columns, check_order=not sorted_inputs)
+            except (MergeOrderError, UnicodeDecodeError) as e:
+                # O motor por hash relê com a codificação seguinte (read_csv_file), que fica memorizada
+                logger.info("Comparação em fluxo interrompida, usando o motor por hash: %s", e)
+                results = None
+                metrics.inc('checkplanilhas_merge_diff_total', {'result': 'fallback'},
+                            help_text='Tentativas de comparação em fluxo por resultado')
+            else:
+                metrics.inc('checkplanilhas_merge_diff_total', {'result': 'merge' if results else 'unsorted'},
+                            help_text='Tentativas de comparação em fluxo por resultado')
+            if results is not None:
+                comparison_cache.put('result', key, results, len(pickle.dumps(results)))
+                record_comparison_runtime('merge', cost_inputs, results, column_mapping, time.perf_counter() - started)
+                yield 'complete', copy.deepcopy(results)
+                return
         
-        # Comparar colunas (necessário para o template results.html)
-        cols1 = set(df1.columns)
-        cols2 = set(df2.columns)
-        results['columns'] = {
-            'only_in_file1': list(cols1 - cols2),
-            'only_in_file2': list(cols2 - cols1),
-            'common': list(cols1 & cols2)
-        }
+        results = {}
+        for section, updates in iter_comparison_with_mapping(file1_path, file2_path, column_mapping, filters1, filters2,
+                                                             total_columns, group_columns, content_hashes, backend.name):
+            if section == 'error':
+                yield section, updates
+                return
+            results.update(updates)
+            yield section, copy.deepcopy(updates)
+        comparison_cache.put('result', key, results, len(pickle.dumps(results)))
+        record_comparison_runtime(backend.name, cost_inputs, results, column_mapping, time.perf_counter() - started)
+    except Exception as e:
+        logger.exception("Erro na comparação: %s", e)
+        yield 'error', {'error': str(e)}
+
+def collect_comparison_sections(sections):
+    """Junta as seções num único dicionário de resultado; uma falha vira só {'error': mensagem}, como sempre"""
+    results = {}
+    for section, updates in sections:
+        if section == 'error':
+            return updates
+        results.update(updates)
+    return results
+
+def mapped_identical_pairs(job, column_mapping):
+    """(pares mapeados presentes nas duas planilhas, pares com o mesmo conteúdo segundo os checksums)"""
+    cols1, cols2 = set(job.columns1), set(job.columns2)
+    pairs = [(col1, col2) for col1, col2 in column_mapping.items() if col1 in cols1 and col2 in cols2]
+    return pairs, identical_column_pairs(job.checksums(1, [col1 for col1, _ in pairs]),
+                                         job.checksums(2, [col2 for _, col2 in pairs]),
+                                         pairs, job.rows1, job.rows2)
+
+def comparison_result_key(file1_path, file2_path, content_hashes, column_mapping, filters1, filters2, total_columns,
+                          group_columns, key_fields, sorted_inputs, backend_name):
+    """(chave do resultado no cache, comparação em fluxo permitida) para os parâmetros da comparação"""
+    merge_allowed = bool(key_fields and (sorted_inputs or MERGE_DIFF_AUTO) and not filters1 and not filters2
+                         and not group_columns and spreadsheet_format(file1_path)[0] == 'csv'
+                         and spreadsheet_format(file2_path)[0] == 'csv')
+    key = ('result',) + tuple(content_hashes) + (canonical_json(column_mapping), canonical_filters(filters1),
+                                                 canonical_filters(filters2), canonical_json(total_columns or []),
+                                                 canonical_json(group_columns or []), merge_allowed, backend_name)
+    return key, merge_allowed
+
+def run_comparison_with_mapping(file1_path, file2_path, column_mapping, filters1=None, filters2=None, total_columns=None, group_columns=None, content_hashes=None, backend=None):
+    """Executa a comparação com mapeamento no backend escolhido (pandas por padrão)"""
+    return collect_comparison_sections(iter_comparison_with_mapping(
+        file1_path, file2_path, column_mapping, filters1, filters2, total_columns, group_columns, content_hashes, backend
+    ))
+
+def iter_comparison_with_mapping(file1_path, file2_path, column_mapping, filters1=None, filters2=None, total_columns=None, group_columns=None, content_hashes=None, backend=None):
+    """run_comparison_with_mapping por seções, na ordem em que results.html as mostra:
+    'overview' (dimensões, colunas e filtros), 'unique_rows' e 'totals' (totalizadores e agrupamento)"""
+    try:
+        backend = get_comparison_backend(backend)
+        logger.debug("Iniciando comparação com mapeamento (backend %s)", backend.name)
+        logger.debug("Arquivo 1: %s", file1_path)
+        logger.debug("Arquivo 2: %s", file2_path)
+        logger.debug("Mapeamento: %s", column_mapping)
+        logger.debug("Filtros1: %s", filters1)
+        logger.debug("Filtros2: %s", filters2)
+        
+        if content_hashes is None:
+            content_hashes = (file_content_hash(file1_path), file_content_hash(file2_path))
         
-        # Identificar linhas exclusivas usando mapeamento específico
-        if len(df1) > 0 or len(df2) > 0:
-            rows_only_in_1, rows_only_in_2, comparison_columns = find_unique_rows_by_intelligent_keys(df1, df2, column_mapping)
+        # Ler as planilhas e aplicar os filtros (ou reaproveitar o que o backend já tem)
+        with backend.open(file1_path, file2_path, content_hashes, filters1, filters2) as job:
+            if job is None:
+                yield 'error', {'error': 'Erro ao carregar as planilhas'}
+                return
             
-            results['unique_rows'] = {
-                'only_in_file1': {
-                    'count': len(rows_only_in_1),
-                    'sample': rows_only_in_1.head(10).to_dict('records') if len(rows_only_in_1) > 0 else []
-                },
-                'only_in_file2': {
-                    'count': len(rows_only_in_2),
-                    'sample': rows_only_in_2.head(10).to_dict('records') if len(rows_only_in_2) > 0 else []
-                },
-                'comparison_columns': comparison_columns
+            results = {}
+            
+            # Informações sobre mapeamento usado
+            results['mapping_info'] = {
+                'column_mapping': column_mapping,
+                'mapped_columns_count': len(column_mapping),
+                'original_columns': {
+                    'file1': len(job.columns1),
+                    'file2': len(job.columns2)
+                }
             }
-        
-        # Calcular totalizadores se especificado
-        if total_columns:
-            # Filtrar apenas colunas que existem no mapeamento
-            valid_total_cols1 = [col for col in total_columns if col in column_mapping]
-            valid_total_cols2 = [column_mapping[col] for col in valid_total_cols1]
             
-            results['totals'] = {
-                'file1': calculate_totals(df1, valid_total_cols1),
-                'file2': calculate_totals(df2, valid_total_cols2),
-                'columns': valid_total_cols1
+            # Comparar dimensões
+            results['dimensions'] = {
+                'file1': {'rows': job.rows1, 'cols': len(job.columns1)},
+                'file2': {'rows': job.rows2, 'cols': len(job.columns2)},
+                'mapped_cols': len(column_mapping)
             }
+            
+            # Comparar colunas (necessário para o template results.html)
+            cols1 = set(job.columns1)
+            cols2 = set(job.columns2)
+            results['columns'] = {
+                'only_in_file1': list(cols1 - cols2),
+                'only_in_file2': list(cols2 - cols1),
+                'common': list(cols1 & cols2)
+            }
+            
+            # Colunas com o mesmo conteúdo nas duas planilhas (checksums da carga) não são comparadas
+            pairs, identical_pairs = mapped_identical_pairs(job, column_mapping)
+            results['identical_columns'] = {
+                'ordered': [col1 for col1, _ in identical_pairs[0]],
+                'unordered': [col1 for col1, _ in identical_pairs[1] if (col1, column_mapping[col1]) not in identical_pairs[0]],
+                'all': bool(pairs) and len(identical_pairs[0]) == len(pairs)
+            }
+            
+            # Adicionar informações sobre filtros aplicados
+            results['filters_applied'] = {
+                'file1': filters1 if filters1 else [],
+                'file2': filters2 if filters2 else [],
+                'column_mapping_used': True,
+                'total_columns': total_columns if total_columns else [],
+                'group_columns': group_columns if group_columns else []
+            }
+            identical_all = results['identical_columns']['all']
+            yield 'overview', results
+            
+            # Identificar linhas exclusivas usando mapeamento específico
+            results = {}
+            if identical_all:
+                # Todas as colunas mapeadas idênticas, linha a linha: nada a procurar
+                logger.debug("Colunas mapeadas idênticas nas duas planilhas (checksum): comparação encerrada")
+                results['unique_rows'] = {
+                    'only_in_file1': {'count': 0, 'sample': []},
+                    'only_in_file2': {'count': 0, 'sample': []},
+                    'comparison_columns': ['Colunas mapeadas idênticas (checksum)']
+                }
+            elif job.rows1 > 0 or job.rows2 > 0:
+                count1, sample1, count2, sample2, comparison_columns = job.unique_rows(column_mapping, identical_pairs)
+                results['unique_rows'] = {
+                    'only_in_file1': {'count': count1, 'sample': sample1},
+                    'only_in_file2': {'count': count2, 'sample': sample2},
+                    'comparison_columns': comparison_columns
+                }
+            yield 'unique_rows', results
+            
+            results = {}
+            # Calcular totalizadores se especificado
+            if total_columns:
+                # Filtrar apenas colunas que existem no mapeamento
+                valid_total_cols1 = [col for col in total_columns if col in column_mapping]
+                valid_total_cols2 = [column_mapping[col] for col in valid_total_cols1]
+                
+                # Mesmo multiconjunto de valores: os totais do destino são os da origem
+                same_values = {col1 for col1, _ in identical_pairs[1]}
+                totals1 = job.totals(1, valid_total_cols1)
+                totals2 = job.totals(2, [column_mapping[col] for col in valid_total_cols1 if col not in same_values])
+                totals2.update({column_mapping[col]: dict(totals1[col]) for col in valid_total_cols1
+                                if col in same_values and col in totals1})
+                
+                results['totals'] = {
+                    'file1': totals1,
+                    # Totais do destino indexados pelo nome da coluna de origem (lado a lado)
+                    'file2': {col1: totals2[col2] for col1, col2 in zip(valid_total_cols1, valid_total_cols2) if col2 in totals2},
+                    'columns': valid_total_cols1
+                }
+            
+            # Reconciliação por dimensão (ex.: totais por vendedor) numa única passagem
+            if group_columns:
+                group_mapping = [(col, column_mapping[col]) for col in group_columns if col in column_mapping]
+                value_mapping = [(col, column_mapping[col]) for col in (total_columns or []) if col in column_mapping]
+                if group_mapping:
+                    results['grouped_totals'] = job.grouped_totals(group_mapping, value_mapping)
+            yield 'totals', results
         
-        # Adicionar informações sobre filtros aplicados
-        results['filters_applied'] = {
-            'file1': filters1 if filters1 else [],
-            'file2': filters2 if filters2 else [],
-            'column_mapping_used': True,
-            'total_columns': total_columns if total_columns else []
-        }
-        
-        return results
+    except MemoryBudgetExceeded:
+        raise
+    except Exception as e:
+        logger.exception("Erro na comparação: %s", e)
+        yield 'error', {'error': str(e)}
+
+# Uma origem contra vários destinos (ex.: fechamento do mês, um arquivo por vendedor):
+# a origem é lida, analisada e indexada uma vez; cada destino é comparado em paralelo
+# contra os hashes das chaves da origem, e a cobertura consolidada aponta as linhas
+# da origem que nenhum destino tem
+MULTI_DESTINATION_WORKERS = int(os.environ.get('MULTI_DESTINATION_WORKERS', min(4, os.cpu_count() or 1)))
+MAX_DESTINATION_FILES = 50
+COVERAGE_SAMPLE_ROWS = 50
+
+class OriginKeyIndex:
+    """Hashes das chaves compostas da origem, calculados uma vez por conjunto de colunas-chave.
+    
+    Os hashes usam a normalização em texto da comparação exata (sem o atalho numérico
+    de key_value_kinds, que depende do tipo no destino), então servem para qualquer destino.
+    """
+    
+    def __init__(self, df):
+        self.df = df
+        self.lock = threading.Lock()
+        self.entries = {}
+    
+    def get(self, key_cols):
+        """(hash por linha da origem, hashes distintos ordenados)"""
+        key = tuple(key_cols)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                with stage_timer('origin_index', rows=len(self.df)):
+                    hashes = composite_key_hashes(self.df, list(key_cols))
+                    entry = self.entries[key] = (hashes, np.unique(hashes))
+        return entry
+
+def compare_destination_with_origin(origin, file_path, name, shared_key=None, column_mapping=None):
+    """Compara um destino com a origem já carregada; devolve (resultado, linhas da origem cobertas).
+    
+    origin: {'df', 'content', 'index'}. shared_key: campos-chave escolhidos para o primeiro
+    destino, reaproveitados quando todas as colunas têm correspondência neste destino.
+    """
+    started = time.perf_counter()
+    result = {'name': name, 'error': None}
+    df1 = origin['df']
+    df2 = load_spreadsheet(file_path)
+    if df2 is None:
+        result['error'] = 'Erro ao carregar a planilha'
+        return result, None
+    result['rows'] = len(df2)
+    
+    if column_mapping:
+        mapping = {col1: col2 for col1, col2 in column_mapping.items() if col1 in df1.columns and col2 in df2.columns}
+    else:
+        mapping = find_intelligent_column_mapping(df1, df2, content1=origin['content'])['mapping']
+    result['mapped_columns'] = len(mapping)
+    
+    if shared_key and all(f['col1'] in mapping for f in shared_key):
+        key_cols1 = [f['col1'] for f in shared_key]
+        key_cols2 = [mapping[col1] for col1 in key_cols1]
+    else:
+        key_cols1, key_cols2, _ = identify_best_key_fields(mapping, df1, df2) if mapping else ([], [], [])
+    if not key_cols1:
+        result['error'] = 'Nenhum campo-chave adequado encontrado'
+        return result, None
+    result['key_fields'] = [{'col1': col1, 'col2': col2} for col1, col2 in zip(key_cols1, key_cols2)]
+    
+    with stage_timer('unique_rows', rows=frame_rows(df1, df2)):
+        origin_hashes, origin_keys = origin['index'].get(key_cols1)
+        destination_hashes = composite_key_hashes(df2, key_cols2)
+        in_origin = np.isin(destination_hashes, origin_keys)
+        covered = np.isin(origin_hashes, np.unique(destination_hashes))
+    
+    only_in_destination = df2[~in_origin]
+    result.update({
+        'matched_rows': int(in_origin.sum()),
+        'origin_rows_covered': int(covered.sum()),
+        'only_in_destination': {
+            'count': len(only_in_destination),
+            'sample': only_in_destination.head(RESULT_SAMPLE_ROWS).to_dict('records')
+        },
+        'elapsed_s': round(time.perf_counter() - started, 3)
+    })
+    return result, covered
+
+def compare_origin_with_destinations(file1_path, destinations, column_mapping=None):
+    """Compara uma origem com vários destinos [(caminho, nome)], reaproveitando a leitura e as chaves da origem"""
+    try:
+        # Orçamento: a origem e os maiores destinos que podem estar carregados ao mesmo tempo
+        largest = sorted((path for path, _ in destinations), key=os.path.getsize, reverse=True)
+        with memory_admission('compare', file1_path, *largest[:MULTI_DESTINATION_WORKERS]):
+            df1 = load_spreadsheet(file1_path)
+            if df1 is None:
+                return {'error': 'Erro ao carregar a planilha de origem'}
+            origin = {
+                'df': df1,
+                'content': {col: analyze_column_content(df1, col) for col in df1.columns},
+                'index': OriginKeyIndex(df1)
+            }
+            
+            # O primeiro destino escolhe a chave; os demais a reaproveitam quando possível
+            first, covered_first = compare_destination_with_origin(origin, *destinations[0], column_mapping=column_mapping)
+            shared_key = first.get('key_fields')
+            outcomes = [(first, covered_first)]
+            with ThreadPoolExecutor(max_workers=MULTI_DESTINATION_WORKERS) as executor:
+                futures = [executor.submit(compare_destination_with_origin, origin, path, name, shared_key, column_mapping)
+                           for path, name in destinations[1:]]
+                outcomes += [future.result() for future in futures]
         
+        coverage_count = np.zeros(len(df1), dtype=np.int32)
+        for _, covered in outcomes:
+            if covered is not None:
+                coverage_count += covered
+        uncovered = df1[coverage_count == 0]
+        return {
+            'origin': {'rows': len(df1), 'columns': len(df1.columns)},
+            'destinations': [result for result, _ in outcomes],
+            'coverage': {
+                'covered_rows': int((coverage_count > 0).sum()),
+                'uncovered_rows': len(uncovered),
+                'multiple_rows': int((coverage_count > 1).sum()),
+                'covered_ratio': float((coverage_count > 0).mean()) if len(df1) else 1.0,
+                'uncovered_sample': uncovered.head(COVERAGE_SAMPLE_ROWS).to_dict('records'),
+                'sample_columns': list(df1.columns)
+            }
+        }
+    except MemoryBudgetExceeded:
+        raise
     except Exception as e:
+        logger.exception("Erro na comparação com vários destinos: %s", e)
         return {'error': str(e)}
 
+# Comparação em fluxo (merge) para exportações já ordenadas pela chave: os dois CSVs são
+# percorridos em blocos, sem conjuntos de chaves em memória; uma linha fora de ordem
+# interrompe o merge e a comparação volta para o motor por hash. As chaves são normalizadas
+# como números (281 e 281.0 são a mesma chave) e vêm dos campos sugeridos na análise, então
+# o resultado pode diferir do motor por hash: só roda quando pedido (arquivos declarados
+# ordenados) ou, com MERGE_DIFF_AUTO=1, quando o início dos arquivos está ordenado
+MERGE_DIFF_AUTO = os.environ.get('MERGE_DIFF_AUTO', '0') == '1'
+MERGE_CHUNK_CELLS = 500000  # células por bloco lido de cada arquivo (linhas = células / colunas)
+MERGE_ORDER_CHECK_ROWS = 1000
+MERGE_SAMPLE_ROWS = 10
+MERGE_MAX_DIFFERENCES = 100
+INTEGER_TEXT_PATTERN = re.compile(r'^[+-]?\d+$')
+
+class MergeOrderError(Exception):
+    """Linhas fora da ordem da chave, ou chave que não é única: a comparação em fluxo não se aplica"""
+
+def csv_dialect_of(file_path):
+    return sniff_csv_file(file_path)[2]
+
+def csv_header(file_path, dialect):
+    with open_spreadsheet_stream(file_path) as f:
+        options = csv_read_options(dialect)
+        return list(pd.read_csv(f, nrows=0, **options).columns)
+
+def merge_value_parser(dialect):
+    """Valor de uma célula lida como texto, normalizado como na leitura tipada: números viram int/float, vazios None"""
+    decimal, thousands = dialect['decimal'], dialect['thousands']
+    
+    def parse(text):
+        if not isinstance(text, str):
+            return None
+        text = text.strip()
+        if INTEGER_TEXT_PATTERN.match(text):
+            return int(text)
+        number = text.replace(thousands, '') if thousands else text
+        if decimal != '.':
+            number = number.replace(decimal, '.')
+        try:
+            value = float(number)
+        except ValueError:
+            return text
+        return value if value == value else None
+    return parse
+
+def str_methods(series):
+    """`series.str` sem guardar o acessor na Series.
+    
+    O pandas guarda o acessor na própria Series, e os dois formam um ciclo de referência:
+    nos laços por bloco, cada bloco lido só seria liberado pela coleta do gc.
+    """
+    return pd.Series.str(series)
+
+class StreamingTotals:
+    """Totais das colunas acumulados bloco a bloco, no formato de calculate_totals"""
+    
+    def __init__(self, columns, dialect):
+        self.columns = columns
+        self.dialect = dialect
+        self.stats = {col: {'sum': 0.0, 'count': 0, 'min': None, 'max': None} for col in columns}
+    
+    def update(self, chunk):
+        for col in self.columns:
+            text = str_methods(chunk[col]).strip()
+            if self.dialect['thousands']:
+                text = str_methods(text).replace(self.dialect['thousands'], '', regex=False)
+            if self.dialect['decimal'] != '.':
+                text = str_methods(text).replace(self.dialect['decimal'], '.', regex=False)
+            values = pd.to_numeric(text, errors='coerce').dropna()
+            if not len(values):
+                continue
+            stats = self.stats[col]
+            stats['sum'] += float(values.sum())
+            stats['count'] += len(values)
+            stats['min'] = float(values.min()) if stats['min'] is None else min(stats['min'], float(values.min()))
+            stats['max'] = float(values.max()) if stats['max'] is None else max(stats['max'], float(values.max()))
+    
+    def result(self):
+        totals = {}
+        for col, stats in self.stats.items():
+            has_values = stats['count'] > 0
+            totals[col] = {
+                'sum': round_total(stats['sum']),
+                'count': stats['count'],
+                'mean': round_total(stats['sum'] / stats['count']) if has_values else 0,
+                'min': stats['min'] if has_values else 0,
+                'max': stats['max'] if has_values else 0
+            }
+        return totals
+
+def parse_key_column(text, dialect):
+    """merge_value_parser aplicado à coluna inteira do bloco, com vazios como ''"""
+    stripped = str_methods(text).strip()
+    values = pd.Series(stripped.tolist(), index=text.index, dtype=object)
+    integer = str_methods(stripped).fullmatch(INTEGER_TEXT_PATTERN.pattern).fillna(False).astype(bool)
+    # int() direto do texto: chaves longas (ex.: chave de acesso da NF-e) não perdem dígitos
+    values[integer] = stripped[integer].map(int)
+    rest = stripped[~integer & stripped.notna()]
+    if dialect['thousands']:
+        rest = str_methods(rest).replace(dialect['thousands'], '', regex=False)
+    if dialect['decimal'] != '.':
+        rest = str_methods(rest).replace(dialect['decimal'], '.', regex=False)
+    numbers = pd.to_numeric(rest, errors='coerce').dropna()
+    values[numbers.index] = numbers.tolist()
+    values[stripped.isna()] = ''
+    return values.tolist()
+
+def checked_key_group(file_path, group_key, group):
+    """O grupo, se a chave for única (linhas repetidas só valem se forem idênticas, como em confirm_unique).
+    
+    Os campos-chave podem vir da análise sobre uma amostra: a verificação aqui vale para
+    o arquivo inteiro, e a chave que não se sustenta devolve a comparação ao motor por hash.
+    """
+    if len(group) > 1 and len(set(group)) > 1:
+        raise MergeOrderError(f"{os.path.basename(file_path)}: chave {group_key} repetida em linhas diferentes")
+    return group_key, group
+
+def iter_key_groups(file_path, dialect, columns, key_cols, totals=None, max_rows=None):
+    """(chave, linhas) para cada sequência de linhas com a mesma chave, verificando a ordem e a unicidade.
+    
+    As linhas são tuplas com o texto das colunas pedidas; só o bloco atual fica em memória.
+    """
+    chunk_rows = max(1000, MERGE_CHUNK_CELLS // max(1, len(columns)))
+    group_key, group = None, []
+    with open_spreadsheet_stream(file_path) as f:
+        reader = pd.read_csv(f, usecols=columns, dtype=str, chunksize=chunk_rows, nrows=max_rows,
+                             **csv_read_options(dialect))
+        for chunk in reader:
+            if totals is not None:
+                totals.update(chunk)
+            keys = zip(*(parse_key_column(chunk[col], dialect) for col in key_cols))
+            rows = zip(*(chunk[col].tolist() for col in columns))
+            del chunk
+            for key, row in zip(keys, rows):
+                if group and key == group_key:
+                    group.append(row)
+                    continue
+                if group:
+                    try:
+                        out_of_order = key < group_key
+                    except TypeError:
+                        out_of_order = True
+                    if out_of_order:
+                        raise MergeOrderError(f"{os.path.basename(file_path)}: chave {key} depois de {group_key}")
+                    yield checked_key_group(file_path, group_key, group)
+                group_key, group = key, [row]
+    if group:
+        yield checked_key_group(file_path, group_key, group)
+
+def merge_key_groups(groups1, groups2):
+    """Junta os dois fluxos ordenados: (chave, linhas da origem ou None, linhas do destino ou None)"""
+    current1, current2 = next(groups1, None), next(groups2, None)
+    while current1 is not None or current2 is not None:
+        try:
+            if current2 is None or (current1 is not None and current1[0] < current2[0]):
+                yield current1[0], current1[1], None
+                current1 = next(groups1, None)
+            elif current1 is None or current2[0] < current1[0]:
+                yield current2[0], None, current2[1]
+                current2 = next(groups2, None)
+            else:
+                yield current1[0], current1[1], current2[1]
+                current1, current2 = next(groups1, None), next(groups2, None)
+        except TypeError:
+            raise MergeOrderError('chaves de tipos diferentes nas duas planilhas')
+
+def is_sorted_by_key(file_path, dialect, columns, key_cols):
+    """Verificação rápida do início do arquivo, antes de tentar o merge automaticamente"""
+    try:
+        for _ in iter_key_groups(file_path, dialect, columns, key_cols, max_rows=MERGE_ORDER_CHECK_ROWS):
+            pass
+        return True
+    except MergeOrderError:
+        return False
+
+def compare_sorted_csv_files(file1_path, file2_path, column_mapping, key_fields, total_columns=None, check_order=False):
+    """Comparação em fluxo de dois CSVs ordenados pela chave, no formato de run_comparison_with_mapping.
+    
+    Além das linhas exclusivas, aponta as células diferentes nas linhas com a mesma chave.
+    Devolve None quando o início dos arquivos já está fora de ordem (check_order) e
+    levanta MergeOrderError quando a ordem falha no meio do caminho.
+    """
+    dialect1, dialect2 = csv_dialect_of(file1_path), csv_dialect_of(file2_path)
+    header1, header2 = csv_header(file1_path, dialect1), csv_header(file2_path, dialect2)
+    pairs = [(col1, col2) for col1, col2 in column_mapping.items() if col1 in header1 and col2 in header2]
+    key_fields = [f for f in key_fields if (f['col1'], f['col2']) in pairs]
+    if not key_fields:
+        return None
+    columns1, columns2 = [col1 for col1, _ in pairs], [col2 for _, col2 in pairs]
+    key_cols1, key_cols2 = [f['col1'] for f in key_fields], [f['col2'] for f in key_fields]
+    if check_order and not (is_sorted_by_key(file1_path, dialect1, columns1, key_cols1) and
+                            is_sorted_by_key(file2_path, dialect2, columns2, key_cols2)):
+        return None
+    
+    valid_total_cols1 = [col for col in total_columns or [] if col in column_mapping and col in columns1]
+    valid_total_cols2 = [column_mapping[col] for col in valid_total_cols1]
+    totals1, totals2 = StreamingTotals(valid_total_cols1, dialect1), StreamingTotals(valid_total_cols2, dialect2)
+    
+    parse1, parse2 = merge_value_parser(dialect1), merge_value_parser(dialect2)
+    value_positions = [i for i, col1 in enumerate(columns1) if col1 not in key_cols1]
+    rows = {1: 0, 2: 0}
+    only = {1: {'count': 0, 'sample': []}, 2: {'count': 0, 'sample': []}}
+    differences = []
+    total_differences = 0
+    
+    with stage_timer('merge_diff') as info:
+        groups = merge_key_groups(iter_key_groups(file1_path, dialect1, columns1, key_cols1, totals1),
+                                  iter_key_groups(file2_path, dialect2, columns2, key_cols2, totals2))
+        for key, group1, group2 in groups:
+            for side, group, columns, parse in ((1, group1, columns1, parse1), (2, group2, columns2, parse2)):
+                if group is None:
+                    continue
+                rows[side] += len(group)
+                if (group1 is None) != (group2 is None):
+                    only[side]['count'] += len(group)
+                    free = MERGE_SAMPLE_ROWS - len(only[side]['sample'])
+                    # Valores tipados, como nas amostras do motor por hash (vazios viram None)
+                    only[side]['sample'].extend({col: parse(value) for col, value in zip(columns, row)}
+                                                for row in group[:free])
+            if group1 is None or group2 is None:
+                continue
+            # Linhas com a mesma chave: compara célula a célula (texto igual dispensa a normalização)
+            for row1, row2 in zip(group1, group2):
+                if row1 == row2:
+                    continue
+                for i in value_positions:
+                    if row1[i] != row2[i] and parse1(row1[i]) != parse2(row2[i]):
+                        total_differences += 1
+                        if len(differences) < MERGE_MAX_DIFFERENCES:
+                            differences.append({'row': '|'.join(str(value) for value in key), 'column': columns1[i],
+                                                'file1_value': row1[i], 'file2_value': row2[i]})
+        info['rows'] = rows[1] + rows[2]
+    
+    comparison_info = [f"{f['col1']} ↔ {f['col2']} (score: {f['combined_score']:.1f})" for f in key_fields]
+    results = {
+        'comparison_engine': 'merge',
+        'mapping_info': {
+            'column_mapping': column_mapping,
+            'mapped_columns_count': len(column_mapping),
+            'original_columns': {'file1': len(header1), 'file2': len(header2)}
+        },
+        'dimensions': {
+            'file1': {'rows': rows[1], 'cols': len(header1)},
+            'file2': {'rows': rows[2], 'cols': len(header2)},
+            'mapped_cols': len(column_mapping)
+        },
+        'columns': {
+            'only_in_file1': list(set(header1) - set(header2)),
+            'only_in_file2': list(set(header2) - set(header1)),
+            'common': list(set(header1) & set(header2))
+        },
+        'unique_rows': {
+            'only_in_file1': only[1],
+            'only_in_file2': only[2],
+            'comparison_columns': comparison_info
+        },
+        'data_differences': differences,
+        'total_differences': total_differences,
+        'filters_applied': {
+            'file1': [],
+            'file2': [],
+            'column_mapping_used': True,
+            'total_columns': total_columns if total_columns else [],
+            'group_columns': []
+        }
+    }
+    if total_columns:
+        file2_totals = totals2.result()
+        results['totals'] = {
+            'file1': totals1.result(),
+            'file2': {col1: file2_totals[col2] for col1, col2 in zip(valid_total_cols1, valid_total_cols2)},
+            'columns': valid_total_cols1
+        }
+    return results
+
+@timed_stage('diff', rows=lambda result, df1, df2: frame_rows(df1, df2))
+def find_cell_differences(df1, df2):
+    """Compara valores célula por célula, por posição, nas colunas de df1"""
+    differences = []
+    min_rows = min(len(df1), len(df2))
+    
+    for i in range(min_rows):
+        for col in df1.columns:
+            val1 = df1.iloc[i][col]
+            val2 = df2.iloc[i][col]
+            
+            # Tratar valores NaN
+            if pd.isna(val1) and pd.isna(val2):
+                continue
+            elif pd.isna(val1) or pd.isna(val2) or val1 != val2:
+                differences.append({
+                    'row': i + 2,  # +2 porque linha 1 é cabeçalho e começamos do 0
+                    'column': col,
+                    'file1_value': str(val1) if not pd.isna(val1) else 'VAZIO',
+                    'file2_value': str(val2) if not pd.isna(val2) else 'VAZIO'
+                })
+    
+    return differences
+
+@admission_controlled('compare')
 def compare_spreadsheets(file1_path, file2_path, filters1=None, filters2=None, selected_columns=None, total_columns=None):
     try:
         # Ler as planilhas
@@ -790,30 +3694,27 @@ def compare_spreadsheets(file1_path, file2_path, filters1=None, filters2=None, s
             'common': list(cols1 & cols2)
         }
         
+        # Colunas idênticas nas duas planilhas (checksums da carga) ficam fora da comparação
+        common = [col for col in df1.columns if col in cols2]
+        identical_pairs = ([], [])
+        if COLUMN_CHECKSUMS_ENABLED and common:
+            identical_pairs = identical_column_pairs(column_checksums(df1, common), column_checksums(df2, common),
+                                                     [(col, col) for col in common], len(df1), len(df2))
+        identical = [col for col, _ in identical_pairs[0]]
+        results['identical_columns'] = {
+            'ordered': identical,
+            'unordered': [col for col, _ in identical_pairs[1] if col not in identical],
+            'all': cols1 == cols2 and len(identical) == len(common) > 0
+        }
+        
         # Se têm as mesmas colunas, comparar dados
         if cols1 == cols2:
             # Reordenar colunas para comparação
             df2 = df2[df1.columns]
             
-            # Comparar valores célula por célula
-            differences = []
-            min_rows = min(len(df1), len(df2))
-            
-            for i in range(min_rows):
-                for col in df1.columns:
-                    val1 = df1.iloc[i][col]
-                    val2 = df2.iloc[i][col]
-                    
-                    # Tratar valores NaN
-                    if pd.isna(val1) and pd.isna(val2):
-                        continue
-                    elif pd.isna(val1) or pd.isna(val2) or val1 != val2:
-                        differences.append({
-                            'row': i + 2,  # +2 porque linha 1 é cabeçalho e começamos do 0
-                            'column': col,
-                            'file1_value': str(val1) if not pd.isna(val1) else 'VAZIO',
-                            'file2_value': str(val2) if not pd.isna(val2) else 'VAZIO'
-                        })
+            # Comparar valores célula por célula, só nas colunas que não são idênticas
+            diff_columns = [col for col in df1.columns if col not in identical]
+            differences = find_cell_differences(df1[diff_columns], df2[diff_columns]) if diff_columns else []
             
             results['data_differences'] = differences[:100]  # Limitar a 100 diferenças
             results['total_differences'] = len(differences)
@@ -825,8 +3726,15 @@ def compare_spreadsheets(file1_path, file2_path, filters1=None, filters2=None, s
                 results['extra_rows_file2'] = len(df2) - len(df1)
         
         # Identificar linhas exclusivas usando análise inteligente de campos-chave
-        if len(df1) > 0 or len(df2) > 0:
-            rows_only_in_1, rows_only_in_2, comparison_columns = find_unique_rows_by_intelligent_keys(df1, df2)
+        if results['identical_columns']['all']:
+            results['unique_rows'] = {
+                'only_in_file1': {'count': 0, 'sample': []},
+                'only_in_file2': {'count': 0, 'sample': []},
+                'comparison_columns': ['Colunas idênticas (checksum)']
+            }
+        elif len(df1) > 0 or len(df2) > 0:
+            rows_only_in_1, rows_only_in_2, comparison_columns = find_unique_rows_by_intelligent_keys(
+                df1, df2, identical_pairs=identical_pairs)
             
             results['unique_rows'] = {
                 'only_in_file1': {
@@ -840,46 +3748,1506 @@ def compare_spreadsheets(file1_path, file2_path, filters1=None, filters2=None, s
                 'comparison_columns': comparison_columns
             }
         
-        # Calcular totalizadores se especificado
-        if total_columns:
-            results['totals'] = {
-                'file1': calculate_totals(df1, total_columns),
-                'file2': calculate_totals(df2, total_columns),
-                'columns': total_columns
-            }
+        # Calcular totalizadores se especificado
+        if total_columns:
+            # Mesmo multiconjunto de valores: os totais da segunda planilha são os da primeira
+            same_values = {col for col, _ in identical_pairs[1]}
+            totals1 = calculate_totals(df1, total_columns)
+            totals2 = calculate_totals(df2, [col for col in total_columns if col not in same_values])
+            totals2.update({col: dict(totals1[col]) for col in total_columns if col in same_values and col in totals1})
+            results['totals'] = {
+                'file1': totals1,
+                'file2': totals2,
+                'columns': total_columns
+            }
+        
+        # Adicionar informações sobre filtros aplicados
+        results['filters_applied'] = {
+            'file1': filters1 if filters1 else [],
+            'file2': filters2 if filters2 else [],
+            'selected_columns': selected_columns if selected_columns else [],
+            'total_columns': total_columns if total_columns else []
+        }
+        
+        return results
+        
+    except Exception as e:
+        logger.exception("Erro na comparação: %s", e)
+        return {'error': str(e)}
+
+# Hash de 64 bits da chave composta, calculado em blocos de linhas (colunas de texto)
+KEY_HASH_BLOCK_ROWS = 500000
+
+# Estimativa rápida das linhas exclusivas: uma passagem em blocos lendo só as colunas-chave
+# (e as de filtro); cada planilha vira um resumo de tamanho fixo (HyperLogLog + k menores hashes)
+ESTIMATE_HLL_PRECISION = 14  # 16384 registradores: erro padrão de ~0,8% na contagem de chaves
+ESTIMATE_KMV_SIZE = 16384    # até esse número de chaves distintas o resultado é exato
+ESTIMATE_CHUNK_ROWS = 200000
+ESTIMATE_Z = 1.96            # intervalos de 95%
+
+def key_value_kinds(df1, df2, key_cols1, key_cols2):
+    """Tipo numérico comum de cada par de colunas-chave ('i' ou 'f'), ou None quando o par é comparado como texto.
+    
+    Com o mesmo tipo dos dois lados, valores iguais têm o mesmo texto e o hash pode ser
+    calculado direto sobre os números, sem convertê-los para string.
+    """
+    kinds = []
+    for col1, col2 in zip(key_cols1, key_cols2):
+        kind1, kind2 = df1[col1].dtype.kind, df2[col2].dtype.kind
+        kinds.append(kind1 if kind1 == kind2 and kind1 in 'if' else None)
+    return kinds
+
+def composite_key_hashes(df, key_cols, kinds=None, block_rows=KEY_HASH_BLOCK_ROWS):
+    """Hash de 64 bits da chave composta de cada linha.
+    
+    Os valores são normalizados como na comparação exata (nulos viram 'NULL' e tudo
+    vira texto), então chaves iguais nas duas planilhas têm o mesmo hash.
+    """
+    null_hash = pd.util.hash_array(np.array(['NULL'], dtype=object))[0]
+    combined = np.zeros(len(df), dtype=np.uint64)
+    for col, kind in zip(key_cols, kinds or [None] * len(key_cols)):
+        series = df[col]
+        if kind == 'i':
+            column_hash = pd.util.hash_array(series.to_numpy(dtype=np.int64))
+        elif kind == 'f':
+            values = series.to_numpy(dtype=np.float64)
+            column_hash = pd.util.hash_array(values)
+            column_hash[np.isnan(values)] = null_hash
+        else:
+            column_hash = np.empty(len(df), dtype=np.uint64)
+            for start in range(0, len(df), block_rows):
+                # Texto e hash só dos valores distintos do bloco; o código -1 (nulo) aponta para 'NULL', no fim
+                codes, uniques = pd.factorize(series.iloc[start:start + block_rows])
+                labels = np.append(pd.Index(uniques).astype(str).to_numpy(dtype=object), 'NULL')
+                column_hash[start:start + block_rows] = pd.util.hash_array(labels, categorize=False)[codes]
+        combined = combined * KEY_HASH_MULTIPLIER ^ column_hash
+    return combined
+
+class KeySketch:
+    """Resumo das chaves de uma planilha: registradores HyperLogLog e os k menores hashes"""
+    
+    def __init__(self, precision=ESTIMATE_HLL_PRECISION, size=ESTIMATE_KMV_SIZE):
+        self.precision = precision
+        self.size = size
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+        self.minimums = np.empty(0, dtype=np.uint64)
+        self.rows = 0
+    
+    def update(self, hashes):
+        self.rows += len(hashes)
+        if not len(hashes):
+            return
+        # HyperLogLog: os primeiros bits escolhem o registrador, os demais dão o posto
+        # (zeros à esquerda + 1); o restante tem menos de 53 bits e cabe exato num float
+        rest_bits = 64 - self.precision
+        buckets = (hashes >> np.uint64(rest_bits)).astype(np.intp)
+        rest = hashes & np.uint64((1 << rest_bits) - 1)
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        np.maximum.at(self.registers, buckets, (rest_bits + 1 - bit_length).astype(np.uint8))
+        
+        # k menores valores: quando o resumo está cheio só entram hashes abaixo do maior guardado
+        if self.full:
+            hashes = hashes[hashes < self.minimums[-1]]
+        self.minimums = np.union1d(self.minimums, hashes)[:self.size]
+    
+    @property
+    def full(self):
+        return len(self.minimums) >= self.size
+    
+    @property
+    def threshold(self):
+        """Maior hash até onde o resumo conhece todas as chaves da planilha"""
+        return self.minimums[-1] if self.full else np.uint64(2 ** 64 - 1)
+    
+    def distinct(self, z=ESTIMATE_Z):
+        """Número de chaves distintas: (estimativa, mínimo, máximo)"""
+        if not self.full:
+            count = len(self.minimums)
+            return count, count, count
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        zeros = int((self.registers == 0).sum())
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        # O resumo cheio garante pelo menos `size` chaves
+        estimate = max(estimate, self.size)
+        margin = z * 1.04 / math.sqrt(m)
+        return estimate, max(self.size, estimate * (1 - margin)), estimate * (1 + margin)
+
+def wilson_interval(successes, trials, z=ESTIMATE_Z):
+    """Proporção observada e intervalo de Wilson (estável com proporções perto de 0 ou 1)"""
+    if not trials:
+        return 0.0, 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denominator
+    half = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return p, max(0.0, center - half), min(1.0, center + half)
+
+def estimate_key_overlap(sketch1, sketch2, z=ESTIMATE_Z):
+    """Chaves distintas em comum e exclusivas de cada planilha, com intervalos de confiança.
+    
+    A fração da planilha menor presente na maior é medida nos hashes abaixo dos dois
+    limiares (amostra uniforme das chaves da menor) e multiplicada pela sua contagem.
+    """
+    distinct = {1: sketch1.distinct(z), 2: sketch2.distinct(z)}
+    small, large = (1, 2) if distinct[1][0] <= distinct[2][0] else (2, 1)
+    sketches = {1: sketch1, 2: sketch2}
+    threshold = min(sketch1.threshold, sketch2.threshold)
+    sample = sketches[small].minimums[sketches[small].minimums <= threshold]
+    shared = int(np.isin(sample, sketches[large].minimums, assume_unique=True).sum())
+    
+    d_small, d_small_low, d_small_high = distinct[small]
+    d_large, d_large_low, d_large_high = distinct[large]
+    exact = not sketch1.full and not sketch2.full
+    if exact:
+        both = (shared, shared, shared)
+        only_small = (d_small - shared,) * 3
+        only_large = (d_large - shared,) * 3
+    else:
+        p, p_low, p_high = wilson_interval(shared, len(sample), z)
+        both = (p * d_small, p_low * d_small_low, min(p_high * d_small_high, d_large_high))
+        only_small = ((1 - p) * d_small, (1 - p_high) * d_small_low, (1 - p_low) * d_small_high)
+        only_large = (max(0.0, d_large - both[0]), max(0.0, d_large_low - both[2]),
+                      max(0.0, d_large_high - both[1]))
+    only = {small: only_small, large: only_large}
+    
+    def interval(values):
+        estimate, low, high = (int(round(v)) for v in values)
+        return {'estimate': estimate, 'low': min(low, estimate), 'high': max(high, estimate)}
+    
+    return {
+        'exact': exact,
+        'sample_size': len(sample),
+        'distinct': {side: interval(distinct[side]) for side in (1, 2)},
+        'both': interval(both),
+        'only': {side: interval(only[side]) for side in (1, 2)}
+    }
+
+def estimate_key_kinds(sample1, sample2, key_cols1, key_cols2):
+    """'f' para pares de colunas numéricas nas duas amostras (hash do float64), None para texto.
+    
+    Os blocos de um CSV podem ter tipos diferentes (281 num, 281.0 noutro por causa de um
+    vazio): o tipo do par é decidido uma vez, pela amostra, e imposto a todos os blocos.
+    """
+    numeric = lambda series: series.dtype.kind in 'iuf'
+    return ['f' if numeric(sample1[col1]) and numeric(sample2[col2]) else None
+            for col1, col2 in zip(key_cols1, key_cols2)]
+
+def sketch_key_columns(file_path, key_cols, kinds, filters=None):
+    """KeySketch das chaves de uma planilha numa única passagem em blocos, lendo só as colunas usadas"""
+    filter_cols = [f['column'] for f in filters or [] if f.get('column')]
+    columns = list(dict.fromkeys(key_cols + filter_cols))
+    # Chaves de texto lidas como texto (sem a inferência de tipos do bloco), salvo se um filtro as usa
+    text_cols = {col: str for col, kind in zip(key_cols, kinds) if kind is None and col not in filter_cols}
+    
+    def build(chunks):
+        sketch = KeySketch()
+        for chunk in chunks:
+            if filters:
+                chunk = apply_filters(chunk, filters)
+            keys = pd.DataFrame({col: pd.to_numeric(chunk[col], errors='coerce').astype('float64') if kind
+                                 else chunk[col] for col, kind in zip(key_cols, kinds)})
+            sketch.update(composite_key_hashes(keys, key_cols, kinds))
+        return sketch
+    
+    if spreadsheet_format(file_path)[0] != 'csv':
+        return build([pd.read_excel(file_path, usecols=columns, dtype=text_cols)])
+    _, _, dialect = sniff_csv_file(file_path)
+    
+    def read(dialect):
+        with open_spreadsheet_stream(file_path) as f:
+            return build(pd.read_csv(f, usecols=columns, dtype=text_cols or None, chunksize=ESTIMATE_CHUNK_ROWS,
+                                     **csv_read_options(dialect)))
+    return read_with_encoding_fallback(file_path, dialect, read)
+
+def estimate_comparison(file1_path, file2_path, column_mapping, filters1=None, filters2=None, key_fields=None):
+    """Estimativa das linhas exclusivas de cada planilha sem executar a comparação completa.
+    
+    Usa os campos-chave sugeridos na análise (key_fields) quando todos seguem mapeados; senão,
+    escolhe as chaves sobre uma amostra. Cada planilha é lida uma vez, em blocos e só nas
+    colunas-chave e de filtro, sem carregar a planilha inteira nem passar pelo orçamento de
+    memória. Com chaves repetidas as contagens de chaves viram linhas pela média de linhas por chave.
+    """
+    key_pairs = [(f['col1'], f['col2']) for f in key_fields or [] if column_mapping.get(f['col1']) == f['col2']]
+    sample1 = read_spreadsheet_sample(file1_path, KEY_SEARCH_SAMPLE_ROWS)
+    sample2 = read_spreadsheet_sample(file2_path, KEY_SEARCH_SAMPLE_ROWS)
+    keys_source = 'analysis'
+    if not key_pairs or len(key_pairs) != len(key_fields) or not all(
+            col1 in sample1.columns and col2 in sample2.columns for col1, col2 in key_pairs):
+        key_cols1, key_cols2, _ = identify_best_key_fields(column_mapping, sample1, sample2)
+        key_pairs, keys_source = list(zip(key_cols1, key_cols2)), 'sample'
+    if not key_pairs:
+        return {'error': 'Nenhum campo-chave adequado encontrado; use a comparação exata'}
+    key_cols1, key_cols2 = [col1 for col1, _ in key_pairs], [col2 for _, col2 in key_pairs]
+    kinds = estimate_key_kinds(sample1, sample2, key_cols1, key_cols2)
+    
+    with stage_timer('estimate', nbytes=os.path.getsize(file1_path) + os.path.getsize(file2_path)) as info:
+        sketch1 = sketch_key_columns(file1_path, key_cols1, kinds, filters1)
+        sketch2 = sketch_key_columns(file2_path, key_cols2, kinds, filters2)
+        overlap = estimate_key_overlap(sketch1, sketch2)
+        info['rows'] = sketch1.rows + sketch2.rows
+    
+    def rows_interval(side, rows):
+        keys = overlap['distinct'][side]['estimate']
+        ratio = rows / keys if keys else 1.0
+        return {name: min(rows, int(round(value * ratio))) for name, value in overlap['only'][side].items()}
+    
+    return {
+        'method': 'exact' if overlap['exact'] else 'sketch',
+        'confidence': 0.95,
+        'sample_size': overlap['sample_size'],
+        'keys': [{'col1': col1, 'col2': col2} for col1, col2 in key_pairs],
+        'keys_source': keys_source,
+        'file1': {'rows': sketch1.rows, 'distinct_keys': overlap['distinct'][1]},
+        'file2': {'rows': sketch2.rows, 'distinct_keys': overlap['distinct'][2]},
+        'both_keys': overlap['both'],
+        'only_in_file1': rows_interval(1, sketch1.rows),
+        'only_in_file2': rows_interval(2, sketch2.rows)
+    }
+
+# Cache do preview de filtros: por sessão e planilha guarda o DataFrame, a máscara
+# de cada filtro já avaliado e a máscara acumulada de cada prefixo da cadeia
+MAX_FILTER_PREVIEW_ENTRIES = 32
+MAX_CACHED_FILTER_MASKS = 64
+_filter_preview_cache = OrderedDict()
+_filter_preview_lock = threading.Lock()
+_filter_preview_tickets = itertools.count(1)
+
+class PreviewCancelled(Exception):
+    """Preview de filtros substituído por uma requisição mais recente"""
+
+def get_session_cache_id():
+    """Identificador da sessão usado nos caches do servidor"""
+    if 'cache_id' not in session:
+        session['cache_id'] = uuid.uuid4().hex
+    return session['cache_id']
+
+def clear_session_cache(cache_id):
+    """Remove do cache tudo o que pertence à sessão"""
+    if not cache_id:
+        return
+    with _filter_preview_lock:
+        for key in [key for key in _filter_preview_cache if key[0] == cache_id]:
+            del _filter_preview_cache[key]
+    with _mapping_analysis_lock:
+        _mapping_analysis_cache.pop(cache_id, None)
+    cancel_session_precompute(cache_id)
+
+def get_filter_preview_state(cache_id, planilha_num, file_path):
+    """Obtém (ou cria) o estado de preview da planilha na sessão"""
+    key = (cache_id, planilha_num)
+    with _filter_preview_lock:
+        state = _filter_preview_cache.get(key)
+        if state is None or state['file_path'] != file_path:
+            state = {
+                'file_path': file_path,
+                'df': None,
+                'masks': OrderedDict(),
+                'indexes': {},
+                'prefix': [],
+                'latest_ticket': 0,
+                'lock': threading.Lock()
+            }
+            _filter_preview_cache[key] = state
+        _filter_preview_cache.move_to_end(key)
+        while len(_filter_preview_cache) > MAX_FILTER_PREVIEW_ENTRIES:
+            _filter_preview_cache.popitem(last=False)
+        # Cada requisição recebe um ticket; as anteriores ainda em andamento são canceladas
+        state['latest_ticket'] = next(_filter_preview_tickets)
+    return state, state['latest_ticket']
+
+def filter_signature(filter_config):
+    """Forma canônica de um filtro para reaproveitar máscaras"""
+    return json.dumps([filter_config.get('column'), filter_config.get('operator'),
+                       str(filter_config.get('value', ''))], ensure_ascii=False)
+
+def compute_incremental_filter_mask(state, filters, ticket):
+    """Combina as máscaras dos filtros reaproveitando o que já foi calculado.
+    
+    O maior prefixo igual ao da requisição anterior é reutilizado diretamente e,
+    dos filtros restantes, só os predicados nunca vistos são avaliados.
+    Retorna None quando nenhum filtro se aplica (todas as linhas).
+    """
+    df = state['df']
+    signatures = [filter_signature(f) for f in filters]
+    prefix = state['prefix']
+    
+    common = 0
+    while common < len(prefix) and common < len(signatures) and prefix[common][0] == signatures[common]:
+        common += 1
+    
+    mask = prefix[common - 1][1] if common else None
+    new_prefix = prefix[:common]
+    evaluated = 0
+    
+    for filter_config, signature in zip(filters[common:], signatures[common:]):
+        if state['latest_ticket'] != ticket:
+            raise PreviewCancelled()
+        
+        if signature in state['masks']:
+            predicate = state['masks'][signature]
+            state['masks'].move_to_end(signature)
+        else:
+            predicate = build_filter_mask(df, filter_config, state['indexes'])
+            evaluated += 1
+            state['masks'][signature] = predicate
+            while len(state['masks']) > MAX_CACHED_FILTER_MASKS:
+                state['masks'].popitem(last=False)
+        
+        if predicate is not None:
+            mask = predicate if mask is None else (mask & predicate)
+        new_prefix.append((signature, mask))
+    
+    state['prefix'] = new_prefix
+    logger.debug("Preview incremental: %s filtro(s) reaproveitado(s), %s avaliado(s)", common, evaluated)
+    return mask
+
+# Detalhes da página de mapeamento sob demanda: a página traz só o esqueleto (nomes,
+# tipos e correspondências) e a análise de cada coluna, as amostras e os candidatos
+# de correspondência são buscados por endpoints JSON quando o usuário expande a linha
+MAPPING_CANDIDATES = 5
+MAPPING_SAMPLE_ROWS = 3
+MAPPING_DETAILS_MAX_AGE = 3600
+MAX_MAPPING_ANALYSIS_ENTRIES = 32
+_mapping_analysis_cache = OrderedDict()
+_mapping_analysis_lock = threading.Lock()
+
+def mapping_analysis_version(file1_path, file2_path):
+    """Versão dos detalhes do par: muda quando a sessão troca de arquivos.
+    
+    Vai na URL dos endpoints, então a resposta pode ficar no cache do navegador
+    sem risco de mostrar a análise de um upload anterior.
+    """
+    raw = '|'.join(
+        f"{os.path.abspath(path)}|{os.stat(path).st_size}|{os.stat(path).st_mtime_ns}"
+        for path in (file1_path, file2_path)
+    )
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+def remember_mapping_analysis(cache_id, file1_path, file2_path, df1, df2, mapping_result):
+    """Guarda o que os endpoints de detalhes precisam, sem manter os DataFrames"""
+    state = {
+        'version': mapping_analysis_version(file1_path, file2_path),
+        'columns': {1: list(df1.columns), 2: list(df2.columns)},
+        'content_analysis': {1: mapping_result['content_analysis']['origin'],
+                             2: mapping_result['content_analysis']['destination']},
+        'samples': {1: df1.head(MAPPING_SAMPLE_ROWS).astype(object).fillna('VAZIO').to_dict('records'),
+                    2: df2.head(MAPPING_SAMPLE_ROWS).astype(object).fillna('VAZIO').to_dict('records')},
+        'candidates': [row[:MAPPING_CANDIDATES] for row in mapping_result['similarity_matrix']]
+    }
+    with _mapping_analysis_lock:
+        _mapping_analysis_cache[cache_id] = state
+        _mapping_analysis_cache.move_to_end(cache_id)
+        while len(_mapping_analysis_cache) > MAX_MAPPING_ANALYSIS_ENTRIES:
+            _mapping_analysis_cache.popitem(last=False)
+    return state
+
+def get_mapping_analysis(cache_id, file1_path, file2_path):
+    """Análise de mapeamento da sessão; refeita a partir dos arquivos se outro
+    processo atendeu o /analyze ou se a entrada saiu do cache"""
+    version = mapping_analysis_version(file1_path, file2_path)
+    with _mapping_analysis_lock:
+        state = _mapping_analysis_cache.get(cache_id)
+        if state is not None and state['version'] == version:
+            _mapping_analysis_cache.move_to_end(cache_id)
+            return state
+    
+    df1, df2 = load_analysis_frames('analyze', file1_path, file2_path)
+    if df1 is None or df2 is None:
+        return None
+    mapping_result = find_intelligent_column_mapping(df1, df2)
+    return remember_mapping_analysis(cache_id, file1_path, file2_path, df1, df2, mapping_result)
+
+def mapping_details_response(payload):
+    """Resposta JSON dos detalhes: imutável para a versão da URL, com ETag para revalidação"""
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    response.cache_control.private = True
+    response.cache_control.max_age = MAPPING_DETAILS_MAX_AGE
+    return response.make_conditional(request)
+
+# Plano da comparação (dry-run): antes de rodar, prevê o motor que será usado, as linhas
+# depois dos filtros, a cardinalidade das chaves, o tempo e a memória. O tempo vem de um
+# modelo de custo linear por motor, corrigido por um fator calibrado com as comparações já
+# executadas, no mesmo esquema da estimativa de memória
+RUNTIME_CALIBRATION_FILE = 'runtime_calibration.json'
+# Comparações mais curtas que isso são dominadas por custos fixos e não calibram o modelo
+RUNTIME_CALIBRATION_MIN_SECONDS = 0.2
+# Acima desse tempo previsto a interface pede confirmação antes de comparar
+PLAN_CONFIRM_SECONDS = float(os.environ.get('PLAN_CONFIRM_SECONDS', 30))
+# Custos brutos em segundos, medidos numa máquina de 1 vCPU com os conjuntos de benchmark
+# (25 mil a 1 milhão de linhas); o fator de calibração de cada motor corrige para o servidor
+COMPARISON_COST_MODEL = {
+    'fixed': {'pandas': 0.02, 'sqlite': 0.9, 'merge': 0.02},
+    'parse_per_cell': {'csv': 3e-7, 'xlsx': 8e-6, 'xls': 8e-6},
+    'cached_load_per_cell': 5e-9,
+    'filter_per_row': 3e-8,
+    'pandas_per_cell': 1e-7,       # células mapeadas das linhas que passam pelos filtros
+    'sqlite_load_per_cell': 4e-7,  # primeira carga do arquivo no banco
+    'sqlite_per_row': 3.6e-6,
+    'merge_per_byte': 6.5e-8,
+}
+
+class RuntimeCalibration(MemoryCalibration):
+    """Razão tempo medido / previsão bruta por motor da comparação, persistida em JSON"""
+    
+    # Servidores diferentes da máquina de referência podem ser bem mais rápidos ou lentos
+    factor_bounds = (0.1, 10.0)
+    
+    def record(self, engine, predicted_seconds, elapsed_seconds):
+        if predicted_seconds <= 0 or elapsed_seconds <= 0:
+            return
+        calibrated = predicted_seconds * self.factor(engine)
+        factor = self.update(engine, elapsed_seconds / predicted_seconds,
+                             {'predicted_s': round(calibrated, 4), 'elapsed_s': round(elapsed_seconds, 4)})
+        metrics.observe('checkplanilhas_runtime_estimate_ratio', elapsed_seconds / calibrated, {'engine': engine},
+                        'Tempo de comparação medido / previsto')
+        metrics.set('checkplanilhas_runtime_calibration_factor', factor, {'engine': engine},
+                    'Fator de calibração do modelo de tempo da comparação')
+
+runtime_calibration = RuntimeCalibration(RUNTIME_CALIBRATION_FILE)
+
+def comparison_cost_inputs(file1_path, file2_path, content_hashes, filters1=None, filters2=None):
+    """Forma de cada planilha e o que já está pronto para ela (cache de planilhas, banco SQLite, filtro)"""
+    inputs = []
+    for file_path, content_hash, filters in ((file1_path, content_hashes[0], filters1),
+                                             (file2_path, content_hashes[1], filters2)):
+        shape = estimate_spreadsheet_shape(file_path)
+        rows = shape['rows'] or 0
+        inputs.append({
+            'format': shape['format'],
+            'rows': rows,
+            'columns': shape['columns'] or 0,
+            'file_bytes': shape['file_bytes'],
+            'bytes_per_row': shape['bytes_per_row'] or shape['frame_bytes'] / max(1, rows),
+            'dataset_cached': dataset_is_cached(file_path),
+            'frame_cached': comparison_cache.contains(('frame',) + comparison_frame_key(content_hash, filters)),
+            'sqlite_loaded': os.path.exists(sqlite_database_path(content_hash)),
+            'filters': len(filters or []),
+        })
+    return inputs
+
+def predict_comparison_seconds(engine, inputs, filtered_rows, mapped_columns):
+    """Tempo bruto previsto pelo modelo de custo, antes do fator de calibração do motor"""
+    model = COMPARISON_COST_MODEL
+    if engine == 'cache':
+        return 0.0
+    if engine == 'merge':
+        return model['fixed']['merge'] + sum(info['file_bytes'] for info in inputs) * model['merge_per_byte']
+    
+    seconds = model['fixed'][engine]
+    for info, rows in zip(inputs, filtered_rows):
+        cells = info['rows'] * info['columns']
+        if engine == 'sqlite':
+            if not info['sqlite_loaded']:
+                seconds += cells * model['sqlite_load_per_cell']
+            seconds += info['rows'] * model['sqlite_per_row']
+            continue
+        if not info['frame_cached']:
+            per_cell = (model['cached_load_per_cell'] if info['dataset_cached']
+                        else model['parse_per_cell'].get(info['format'], model['parse_per_cell']['xls']))
+            seconds += cells * per_cell + info['rows'] * info['filters'] * model['filter_per_row']
+        seconds += rows * max(1, mapped_columns) * model['pandas_per_cell']
+    return seconds
+
+def predict_comparison_memory(engine, file_paths, inputs):
+    """Pico de memória previsto: o da admissão no pandas, um bloco por arquivo no SQLite e no fluxo"""
+    if engine == 'cache':
+        return 0
+    if engine == 'pandas':
+        return estimate_job_memory('compare', file_paths)['bytes']
+    if engine == 'sqlite':
+        return int(sum(min(info['rows'], SQLITE_LOAD_CHUNK_ROWS) * info['bytes_per_row']
+                       for info in inputs if not info['sqlite_loaded']))
+    return int(sum(MERGE_CHUNK_CELLS * info['bytes_per_row'] / max(1, info['columns']) for info in inputs))
+
+def record_comparison_runtime(engine, cost_inputs, results, column_mapping, elapsed):
+    """Confronta o tempo medido com a previsão bruta e ajusta o fator de calibração do motor"""
+    if elapsed < RUNTIME_CALIBRATION_MIN_SECONDS or getattr(_active_profile, 'profile', None) is not None:
+        return
+    dimensions = results.get('dimensions', {})
+    filtered_rows = (dimensions.get('file1', {}).get('rows', 0), dimensions.get('file2', {}).get('rows', 0))
+    predicted = predict_comparison_seconds(engine, cost_inputs, filtered_rows, len(column_mapping))
+    runtime_calibration.record(engine, predicted, elapsed)
+    logger.info("Comparação %s: prevista %.2fs, medida %.2fs", engine,
+                predicted * runtime_calibration.factor(engine), elapsed)
+
+def plan_filtered_rows(cache_id, planilha_num, file_path, filters):
+    """Linhas da planilha depois dos filtros e o DataFrame filtrado usado para medir as chaves.
+    
+    Usa, nessa ordem, a planilha do preview de filtros da sessão (com as máscaras e os
+    índices já calculados), a planilha inteira quando ela é barata de ler (pequena ou no
+    cache) ou a amostra do início do arquivo, extrapolando a proporção de linhas que passam.
+    """
+    with _filter_preview_lock:
+        state = _filter_preview_cache.get((cache_id, planilha_num))
+    if state is not None and state['file_path'] == file_path and state['df'] is not None:
+        with state['lock']:
+            df = state['df']
+            mask = None
+            for filter_config in filters:
+                predicate = state['masks'].get(filter_signature(filter_config))
+                if predicate is None:
+                    predicate = build_filter_mask(df, filter_config, state['indexes'])
+                if predicate is not None:
+                    mask = predicate if mask is None else (mask & predicate)
+        filtered = df if mask is None else df[mask]
+        return {'rows': len(df), 'rows_after_filters': len(filtered), 'method': 'index'}, filtered
+    
+    with memory_admission('plan', *([] if analysis_sample_applies(file_path) else [file_path])):
+        df = load_analysis_frame(file_path)
+    if df is None:
+        raise ValueError(f'Erro ao carregar {os.path.basename(file_path)}')
+    filtered = apply_filters(df, filters) if filters else df
+    total_rows = frame_total_rows(df)
+    if not df.attrs.get('sampled'):
+        return {'rows': total_rows, 'rows_after_filters': len(filtered), 'method': 'exact'}, filtered
+    selectivity = len(filtered) / len(df) if len(df) else 0.0
+    return {'rows': total_rows, 'rows_after_filters': int(round(selectivity * total_rows)), 'method': 'sample',
+            'sample_rows': len(df)}, filtered
+
+def key_cardinality(df, key_cols, kinds, rows_after_filters):
+    """Chaves distintas da combinação escolhida, extrapoladas pela proporção quando o DataFrame é amostra"""
+    if not key_cols or len(df) == 0:
+        return {'distinct': 0, 'unique_ratio': 0.0, 'sampled': False, 'columns': {}}
+    distinct = len(np.unique(composite_key_hashes(df, key_cols, kinds)))
+    ratio = distinct / len(df)
+    sampled = len(df) != rows_after_filters
+    return {
+        'distinct': int(round(ratio * rows_after_filters)) if sampled else distinct,
+        'unique_ratio': round(ratio, 4),
+        'sampled': sampled,
+        'columns': {col: int(df[col].nunique()) for col in key_cols}  # na amostra, quando sampled
+    }
+
+def merge_would_apply(file1_path, file2_path, column_mapping, key_fields, sorted_inputs):
+    """O início dos dois CSVs está ordenado pela chave (mesma verificação da comparação em fluxo)"""
+    if sorted_inputs:
+        return True
+    try:
+        dialect1, dialect2 = csv_dialect_of(file1_path), csv_dialect_of(file2_path)
+        header1, header2 = csv_header(file1_path, dialect1), csv_header(file2_path, dialect2)
+    except Exception as e:
+        logger.debug("Verificação de ordem do plano falhou: %s", e)
+        return False
+    pairs = [(col1, col2) for col1, col2 in column_mapping.items() if col1 in header1 and col2 in header2]
+    key_fields = [f for f in key_fields if (f['col1'], f['col2']) in pairs]
+    if not key_fields:
+        return False
+    return (is_sorted_by_key(file1_path, dialect1, [col1 for col1, _ in pairs], [f['col1'] for f in key_fields]) and
+            is_sorted_by_key(file2_path, dialect2, [col2 for _, col2 in pairs], [f['col2'] for f in key_fields]))
+
+def plan_comparison(file1_path, file2_path, column_mapping, filters1=None, filters2=None, total_columns=None,
+                    group_columns=None, key_fields=None, sorted_inputs=False, cache_id=None, backend=None,
+                    provisional_keys=False):
+    """Plano da comparação sem executá-la: motor, linhas depois dos filtros, chaves, tempo e memória.
+    
+    O motor segue as mesmas regras de compare_spreadsheets_with_mapping (resultado em cache,
+    comparação em fluxo, backend configurado). Tempo e memória também são previstos para os
+    dois backends, para a interface sugerir o SQLite quando o pandas não cabe no orçamento.
+    provisional_keys: key_fields vieram da amostra da análise e são escolhidos de novo aqui.
+    """
+    backend = get_comparison_backend(backend)
+    content_hashes = (file_content_hash(file1_path), file_content_hash(file2_path))
+    key, merge_allowed = comparison_result_key(file1_path, file2_path, content_hashes, column_mapping, filters1,
+                                               filters2, total_columns, group_columns, key_fields,
+                                               sorted_inputs, backend.name)
+    if comparison_cache.contains(key):
+        engine, reason = 'cache', 'Resultado idêntico já calculado'
+    elif merge_allowed and merge_would_apply(file1_path, file2_path, column_mapping, key_fields, sorted_inputs):
+        engine, reason = 'merge', 'CSVs ordenados pelos campos-chave, sem filtros'
+    else:
+        engine, reason = backend.name, f'Backend configurado ({backend.name})'
+    
+    sides = []
+    for planilha_num, file_path, filters in ((1, file1_path, filters1 or []), (2, file2_path, filters2 or [])):
+        info, filtered = plan_filtered_rows(cache_id, planilha_num, file_path, filters)
+        sides.append(({'name': os.path.basename(file_path), 'filters': len(filters), **info}, filtered))
+    (file1, df1), (file2, df2) = sides
+    
+    # Campos-chave da análise quando todos seguem mapeados e não vieram de amostra; senão,
+    # escolhidos sobre o que o plano leu
+    key_pairs = [(f['col1'], f['col2']) for f in key_fields or [] if column_mapping.get(f['col1']) == f['col2']]
+    if provisional_keys or not key_pairs or len(key_pairs) != len(key_fields or []):
+        key_cols1, key_cols2, _ = identify_best_key_fields(column_mapping, df1, df2)
+        key_pairs = list(zip(key_cols1, key_cols2))
+    key_pairs = [(col1, col2) for col1, col2 in key_pairs if col1 in df1.columns and col2 in df2.columns]
+    key_cols1, key_cols2 = [col1 for col1, _ in key_pairs], [col2 for _, col2 in key_pairs]
+    kinds = key_value_kinds(df1, df2, key_cols1, key_cols2)
+    file1['keys'] = key_cardinality(df1, key_cols1, kinds, file1['rows_after_filters'])
+    file2['keys'] = key_cardinality(df2, key_cols2, kinds, file2['rows_after_filters'])
+    
+    inputs = comparison_cost_inputs(file1_path, file2_path, content_hashes, filters1, filters2)
+    for info, side in zip(inputs, (file1, file2)):
+        info['rows'] = side['rows']
+    filtered_rows = (file1['rows_after_filters'], file2['rows_after_filters'])
+    
+    def forecast(name):
+        raw = predict_comparison_seconds(name, inputs, filtered_rows, len(column_mapping))
+        factor = runtime_calibration.factor(name)
+        return {'seconds': round(raw * factor, 3), 'raw_seconds': round(raw, 3), 'calibration_factor': round(factor, 3),
+                'memory_bytes': predict_comparison_memory(name, (file1_path, file2_path), inputs)}
+    
+    estimates = {name: forecast(name) for name in dict.fromkeys([engine, *COMPARISON_BACKENDS])}
+    chosen = estimates[engine]
+    
+    # A comparação no pandas passa pela admissão de memória; os outros motores leem em blocos.
+    # O limite é o deste processo: sob o gunicorn, cada worker fica com uma fração do orçamento
+    budget_bytes = memory_budget.budget_bytes if MEMORY_BUDGET_BYTES else 0
+    if engine != 'pandas' or not budget_bytes:
+        admission = 'unlimited' if engine == 'pandas' else 'not_required'
+    elif chosen['memory_bytes'] > budget_bytes:
+        admission = 'rejected'
+    elif memory_budget.reserved + chosen['memory_bytes'] > budget_bytes:
+        admission = 'queued'
+    else:
+        admission = 'immediate'
+    
+    warnings = []
+    recommendation = 'run'
+    if admission == 'rejected':
+        recommendation = 'reject'
+        warnings.append(f"A comparação precisa de ~{chosen['memory_bytes'] / 1048576:.0f} MB, acima do limite de "
+                        f"{budget_bytes / 1048576:.0f} MB do servidor.")
+        if estimates['sqlite']['memory_bytes'] <= budget_bytes:
+            warnings.append(f"O backend SQLite (COMPARISON_BACKEND=sqlite) caberia: ~{estimates['sqlite']['seconds']:.0f}s.")
+    elif admission == 'queued':
+        warnings.append('O servidor está ocupado com outras comparações: a comparação vai aguardar na fila.')
+    if recommendation == 'run' and chosen['seconds'] > PLAN_CONFIRM_SECONDS:
+        recommendation = 'confirm'
+        warnings.append(f"A comparação deve levar ~{chosen['seconds']:.0f}s.")
+    for side, label in ((file1, 'origem'), (file2, 'destino')):
+        if side['keys']['unique_ratio'] and side['keys']['unique_ratio'] < 0.9:
+            warnings.append(f"Os campos-chave repetem valores na {label} "
+                            f"({side['keys']['unique_ratio'] * 100:.0f}% de linhas com chave única).")
+        if side['filters'] and side['rows'] and not side['rows_after_filters']:
+            warnings.append(f'Nenhuma linha da {label} passa pelos filtros.')
+    
+    metrics.inc('checkplanilhas_plan_total', {'engine': engine, 'recommendation': recommendation},
+                help_text='Planos de comparação por motor e recomendação')
+    return {
+        'engine': engine,
+        'engine_reason': reason,
+        'file1': file1,
+        'file2': file2,
+        'keys': [{'col1': col1, 'col2': col2} for col1, col2 in key_pairs],
+        'runtime': {name: chosen[name] for name in ('seconds', 'raw_seconds', 'calibration_factor')},
+        'memory': {'bytes': chosen['memory_bytes'], 'budget_bytes': budget_bytes,
+                   'reserved_bytes': memory_budget.reserved, 'admission': admission},
+        'alternatives': estimates,
+        'recommendation': recommendation,
+        'warnings': warnings
+    }
+
+# Página de resultados em fluxo: results.html é enviada em partes. O cabeçalho sai na hora,
+# a visão geral (dimensões e colunas) assim que as planilhas são lidas e filtradas, e as linhas
+# exclusivas e os totais à medida que cada etapa termina. O template marca os pontos de envio
+# com stream_flush(); fora do fluxo a função não escreve nada
+STREAM_RESULTS = os.environ.get('STREAM_RESULTS', '1') != '0'
+STREAM_FLUSH_MARKER = '<!-- stream-flush -->'
+RESULT_SECTIONS = ('overview', 'unique_rows', 'totals', 'end')
+# Seção que produz cada chave do resultado; as demais chaves vêm na visão geral
+RESULT_KEY_SECTIONS = {
+    'unique_rows': 'unique_rows',
+    'data_differences': 'unique_rows',
+    'total_differences': 'unique_rows',
+    'comparison_engine': 'unique_rows',
+    'totals': 'totals',
+    'grouped_totals': 'totals',
+    'stage_error': 'end',
+}
+
+class ProgressiveResults(Mapping):
+    """Resultado para results.html que executa as etapas da comparação sob demanda.
+    
+    Consultar uma chave avança as seções até a que a produz. Uma falha antes da visão
+    geral vira 'error', como no resultado completo; depois dela, o começo da página já
+    foi enviado e a falha vira 'stage_error', mostrada no fim.
+    """
+    
+    def __init__(self, sections):
+        self._sections = sections
+        self._data = {}
+        self._reached = -1
+    
+    def _advance(self, section):
+        target = RESULT_SECTIONS.index(section)
+        while self._reached < target:
+            try:
+                name, updates = next(self._sections)
+            except StopIteration:
+                self._reached = len(RESULT_SECTIONS)
+                break
+            if name == 'error':
+                self._data['error' if self._reached < 0 else 'stage_error'] = updates['error']
+                self._reached = len(RESULT_SECTIONS)
+            else:
+                self._data.update(updates)
+                self._reached = max(self._reached, RESULT_SECTIONS.index('totals' if name == 'complete' else name))
+    
+    def __getitem__(self, key):
+        self._advance(RESULT_KEY_SECTIONS.get(key, 'overview'))
+        return self._data[key]
+    
+    def __iter__(self):
+        self._advance('end')
+        return iter(self._data)
+    
+    def __len__(self):
+        self._advance('end')
+        return len(self._data)
+    
+    def close(self):
+        """Encerra as etapas pendentes (ex.: navegador fechado no meio), liberando planilhas e memória reservada"""
+        self._sections.close()
+
+def no_stream_flush(message=None):
+    return ''
+
+def stream_flush_point(message=None):
+    """Ponto de envio do template: o que foi renderizado até aqui vai para o navegador antes da próxima etapa"""
+    pending = f'<div class="stream-pending text-muted small mb-3">⏳ {escape(message)}</div>' if message else ''
+    return Markup(pending + STREAM_FLUSH_MARKER)
+
+app.add_template_global(no_stream_flush, 'stream_flush')
+
+def render_results_page(sections, cleanup=None, **context):
+    """results.html a partir das seções da comparação: em fluxo (STREAM_RESULTS) ou de uma vez.
+    
+    cleanup roda quando a página termina de ser gerada, mesmo se o navegador desistir antes.
+    """
+    if not STREAM_RESULTS:
+        try:
+            return render_template('results.html', results=collect_comparison_sections(sections), **context)
+        finally:
+            if cleanup:
+                cleanup()
+    
+    results = ProgressiveResults(sections)
+    chunks = stream_template('results.html', results=results, stream_flush=stream_flush_point, **context)
+    
+    def generate():
+        buffer = []
+        try:
+            for chunk in chunks:
+                buffer.append(chunk)
+                if STREAM_FLUSH_MARKER in chunk:
+                    yield ''.join(buffer).replace(STREAM_FLUSH_MARKER, '')
+                    buffer = []
+            yield ''.join(buffer)
+        finally:
+            chunks.close()
+            results.close()
+            if cleanup:
+                cleanup()
+    
+    response = Response(generate(), mimetype='text/html')
+    # Proxies como o nginx guardariam a resposta inteira antes de repassar
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def session_comparison_cleanup():
+    """Tira os arquivos da comparação da sessão e devolve a limpeza (arquivos e caches) para depois da página"""
+    paths = [session.pop('file1_path', None), session.pop('file2_path', None)]
+    cache_id = session.get('cache_id')
+    for key in ('file1_name', 'file2_name', 'column_mapping', 'suggested_keys'):
+        session.pop(key, None)
+    
+    def cleanup():
+        # Limpar arquivos temporários
+        for path in paths:
+            if path and os.path.exists(path):
+                os.remove(path)
+        clear_session_cache(cache_id)
+    return cleanup
+
+# Pré-cálculo especulativo: enquanto o usuário revisa o mapeamento, o servidor já lê as
+# planilhas inteiras (para o cache de planilhas e o de comparações), calcula os hashes das
+# colunas mapeadas, escolhe a chave e encontra as linhas exclusivas do mapeamento sugerido.
+# A comparação aproveita o que estiver pronto pelos caches de sempre; com outro mapeamento,
+# só o que depende dele é refeito (hashes das colunas novas, chave e linhas exclusivas)
+PRECOMPUTE_ENABLED = os.environ.get('PRECOMPUTE', '1') != '0'
+# Tempo de CPU que o pré-cálculo pode gastar por sessão (medido na thread do pré-cálculo)
+PRECOMPUTE_CPU_SECONDS = float(os.environ.get('PRECOMPUTE_CPU_SECONDS', 60))
+# A leitura de CSV com pyarrow trabalha também nas threads do pyarrow, fora da conta da thread:
+# a CPU medida nessas etapas é multiplicada por este fator (medido: 1,24 a 1,34)
+PRECOMPUTE_ARROW_CPU_FACTOR = float(os.environ.get('PRECOMPUTE_ARROW_CPU_FACTOR', 1.3))
+PRECOMPUTE_WORKERS = int(os.environ.get('PRECOMPUTE_WORKERS', 1))
+# Sessão sem nenhuma requisição por esse tempo é considerada abandonada
+PRECOMPUTE_IDLE_SECONDS = 600
+# Quanto a comparação espera a etapa em andamento, cujo resultado ela vai reaproveitar
+PRECOMPUTE_CLAIM_WAIT = 30
+MAX_PRECOMPUTE_SESSIONS = 256
+
+_precompute_executor = ThreadPoolExecutor(max_workers=PRECOMPUTE_WORKERS, thread_name_prefix='precompute')
+_precompute_lock = threading.Lock()
+_precompute_jobs = OrderedDict()       # cache_id -> SessionPrecompute
+_precompute_cpu_spent = OrderedDict()  # cache_id -> segundos de CPU já gastos pela sessão
+
+class PrecomputeStopped(Exception):
+    """Pré-cálculo interrompido: sessão cancelada ou abandonada, orçamento esgotado ou servidor ocupado"""
+
+def precompute_cpu_remaining(cache_id):
+    with _precompute_lock:
+        return PRECOMPUTE_CPU_SECONDS - _precompute_cpu_spent.get(cache_id, 0.0)
+
+def charge_precompute_cpu(cache_id, seconds):
+    with _precompute_lock:
+        _precompute_cpu_spent[cache_id] = _precompute_cpu_spent.pop(cache_id, 0.0) + seconds
+        while len(_precompute_cpu_spent) > MAX_PRECOMPUTE_SESSIONS:
+            _precompute_cpu_spent.popitem(last=False)
+    metrics.inc('checkplanilhas_precompute_cpu_seconds_total', value=seconds,
+                help_text='Tempo de CPU gasto pelo pré-cálculo especulativo')
+
+class SessionPrecompute:
+    """Pré-cálculo de uma sessão para a comparação rápida (mapeamento e chaves sugeridos, sem filtros).
+    
+    As etapas rodam em ordem; antes de cada uma, a sessão precisa continuar ativa e o tempo
+    previsto pelo modelo de custo da comparação precisa caber no que resta do orçamento.
+    O tempo cobrado é o de CPU da thread do pré-cálculo (as outras requisições do processo não
+    entram na conta), vezes `cpu_factor` nas etapas que também usam as threads do pyarrow.
+    Uma etapa não é interrompida no meio; se ela estourar o orçamento, nenhuma outra começa.
+    """
+    
+    def __init__(self, cache_id, file1_path, file2_path, column_mapping, key_fields):
+        self.cache_id = cache_id
+        self.file1_path, self.file2_path = file1_path, file2_path
+        self.column_mapping = column_mapping
+        self.key_fields = key_fields or []
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.touched = time.monotonic()
+        self.steps = []  # (etapa, resultado, segundos de CPU)
+        self.future = None
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def stop_reason(self):
+        if self.cancelled.is_set():
+            return 'cancelled'
+        if time.monotonic() - self.touched > PRECOMPUTE_IDLE_SECONDS:
+            return 'abandoned'
+        return None
+    
+    def record(self, step, result, cpu_seconds=0.0):
+        self.steps.append((step, result, round(cpu_seconds, 3)))
+        metrics.inc('checkplanilhas_precompute_steps_total', {'step': step, 'result': result},
+                    help_text='Etapas do pré-cálculo especulativo por resultado')
+    
+    def step(self, name, predicted_seconds, func, cpu_factor=1.0):
+        """Executa a etapa se a sessão continua ativa e a previsão cabe no orçamento; devolve o resultado"""
+        reason = self.stop_reason()
+        if reason is None:
+            remaining = precompute_cpu_remaining(self.cache_id)
+            if remaining <= 0 or predicted_seconds > remaining:
+                reason = 'budget'
+        if reason:
+            self.record(name, reason)
+            raise PrecomputeStopped(reason)
+        
+        started = time.thread_time()
+        result = 'failed'
+        try:
+            value = func()
+            result = 'done'
+            return value
+        except MemoryBudgetExceeded:
+            result = 'busy'
+            raise PrecomputeStopped(result)
+        finally:
+            cpu_seconds = (time.thread_time() - started) * cpu_factor
+            charge_precompute_cpu(self.cache_id, cpu_seconds)
+            self.record(name, result, cpu_seconds)
+    
+    def run(self):
+        try:
+            self.precompute()
+        except PrecomputeStopped as e:
+            logger.info("Pré-cálculo da sessão interrompido: %s", e)
+        except Exception as e:
+            logger.exception("Erro no pré-cálculo da sessão: %s", e)
+        finally:
+            self.finished.set()
+            logger.info("Pré-cálculo da sessão: %s", ', '.join(f'{step} {result} ({cpu:.2f}s)'
+                                                                for step, result, cpu in self.steps))
+    
+    def precompute(self):
+        file_paths = (self.file1_path, self.file2_path)
+        content_hashes = self.step('content_hash', 0.0, lambda: tuple(file_content_hash(path) for path in file_paths))
+        
+        # Nada a adiantar quando a comparação rápida vai sair do cache ou ser feita em fluxo
+        backend = get_comparison_backend()
+        key, merge_allowed = comparison_result_key(self.file1_path, self.file2_path, content_hashes, self.column_mapping,
+                                                   None, None, None, None, self.key_fields, False, backend.name)
+        if comparison_cache.contains(key):
+            self.record('plan', 'cached')
+            return
+        if merge_allowed and merge_would_apply(self.file1_path, self.file2_path, self.column_mapping,
+                                               self.key_fields, False):
+            self.record('plan', 'merge')
+            return
         
-        # Adicionar informações sobre filtros aplicados
-        results['filters_applied'] = {
-            'file1': filters1 if filters1 else [],
-            'file2': filters2 if filters2 else [],
-            'selected_columns': selected_columns if selected_columns else [],
-            'total_columns': total_columns if total_columns else []
-        }
+        model = COMPARISON_COST_MODEL
+        factor = runtime_calibration.factor(backend.name)
+        inputs = comparison_cost_inputs(self.file1_path, self.file2_path, content_hashes)
+        if backend.name == 'sqlite':
+            for side, (path, content_hash, info) in enumerate(zip(file_paths, content_hashes, inputs), 1):
+                predicted = 0.0 if info['sqlite_loaded'] else info['rows'] * info['columns'] * model['sqlite_load_per_cell']
+                self.step(f'sqlite_load{side}', predicted * factor,
+                          lambda path=path, content_hash=content_hash: sqlite_database_for(path, content_hash))
+            return
         
-        return results
+        try:
+            with memory_admission('precompute', *file_paths, wait=False):
+                frames = []
+                for side, (path, content_hash, info) in enumerate(zip(file_paths, content_hashes, inputs), 1):
+                    per_cell = 0.0
+                    parsed_by_arrow = False
+                    if not info['frame_cached']:
+                        per_cell = (model['cached_load_per_cell'] if info['dataset_cached']
+                                    else model['parse_per_cell'].get(info['format'], model['parse_per_cell']['xls']))
+                        parsed_by_arrow = not info['dataset_cached'] and info['format'] == 'csv' and CSV_ENGINE == 'pyarrow'
+                    frames.append(self.step(f'load{side}', info['rows'] * info['columns'] * per_cell * factor,
+                                            lambda path=path, content_hash=content_hash: load_filtered_frame(path, content_hash, None),
+                                            PRECOMPUTE_ARROW_CPU_FACTOR if parsed_by_arrow else 1.0))
+                if frames[0] is None or frames[1] is None:
+                    return
+                
+                # Hashes das colunas, escolha da chave, hashes da chave composta e linhas exclusivas
+                job = PandasComparison(frames[0], frames[1], content_hashes, None, None)
+                predicted = (job.rows1 + job.rows2) * max(1, len(self.column_mapping)) * model['pandas_per_cell']
+                self.step('unique_rows', predicted * factor,
+                          lambda: job.unique_rows(self.column_mapping, mapped_identical_pairs(job, self.column_mapping)[1]))
+        except MemoryBudgetExceeded:
+            self.record('admission', 'busy')
+
+def start_session_precompute(cache_id, file1_path, file2_path, column_mapping, key_fields):
+    """Agenda o pré-cálculo da sessão (chamado depois que a página de mapeamento foi enviada)"""
+    job = SessionPrecompute(cache_id, file1_path, file2_path, column_mapping, key_fields)
+    with _precompute_lock:
+        previous = _precompute_jobs.pop(cache_id, None)
+        _precompute_jobs[cache_id] = job
+        evicted = [previous] if previous else []
+        while len(_precompute_jobs) > MAX_PRECOMPUTE_SESSIONS:
+            evicted.append(_precompute_jobs.popitem(last=False)[1])
+    for old in evicted:
+        old.cancel()
+    job.future = _precompute_executor.submit(job.run)
+
+def cancel_session_precompute(cache_id):
+    """Interrompe o pré-cálculo da sessão (nova análise, comparação concluída ou página abandonada)"""
+    with _precompute_lock:
+        job = _precompute_jobs.pop(cache_id, None)
+    if job is not None:
+        job.cancel()
+
+def touch_session_precompute(cache_id):
+    """Requisição da sessão: o usuário continua na página de mapeamento"""
+    job = _precompute_jobs.get(cache_id)
+    if job is not None:
+        job.touched = time.monotonic()
+
+def claim_session_precompute(cache_id):
+    """Antes da comparação: interrompe as próximas etapas e espera a atual, que a comparação reaproveita"""
+    with _precompute_lock:
+        job = _precompute_jobs.get(cache_id)
+    if job is None:
+        state = 'none'
+    elif job.finished.is_set():
+        state = 'finished'
+    else:
+        job.cancel()
+        if job.future is not None and job.future.cancel():
+            state = 'queued'
+        else:
+            state = 'running'
+            job.finished.wait(PRECOMPUTE_CLAIM_WAIT)
+    metrics.inc('checkplanilhas_precompute_claims_total', {'state': state},
+                help_text='Estado do pré-cálculo quando a comparação começou')
+    return state
+
+def after_session_precompute(cache_id, sections):
+    """Seções da comparação depois de reclamar o pré-cálculo; com a página em fluxo, a espera fica depois do cabeçalho"""
+    claim_session_precompute(cache_id)
+    yield from sections
+
+# Uploads em partes (retomáveis) para arquivos acima de MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_UPLOAD_BYTES = int(float(os.environ.get('MAX_UPLOAD_MB', 2048)) * 1024 * 1024)
+UPLOAD_READ_BLOCK = 256 * 1024
+# Acima desse tamanho o CSV não é convertido durante o upload (só hash e contagem de linhas)
+STREAMING_PARSE_MAX_BYTES = 512 * 1024 * 1024
+# Linhas completas acumuladas antes de converter um lote em colunas
+STREAMING_PARSE_BATCH_BYTES = 4 * 1024 * 1024
+# Uploads incompletos sem atividade por mais tempo que isso são descartados
+UPLOAD_EXPIRATION_SECONDS = 24 * 3600
+
+class StreamingCsvParser:
+    """Converte o CSV em lotes de colunas enquanto os bytes chegam.
+    
+    Cada lote de linhas completas (sem aspas abertas no corte) vira um DataFrame
+    com a inferência de tipos do pandas, e os lotes são concatenados no final.
+    Se dois lotes discordarem no tipo de uma coluna (número num, texto no outro),
+    a concatenação não seria igual à leitura do arquivo inteiro: o parser
+    desiste e a planilha é lida do disco normalmente na análise.
+    """
+    
+    def __init__(self):
+        self.header = None
+        self.dialect = None
+        self.columns = None
+        self.pending = bytearray()
+        self.batches = []
+        self.failed = None
+    
+    def feed(self, data):
+        if self.failed:
+            return
+        self.pending += data
+        if len(self.pending) >= STREAMING_PARSE_BATCH_BYTES:
+            self._parse_pending(final=False)
+    
+    def _parse_pending(self, final):
+        if final:
+            cut = len(self.pending)
+        else:
+            cut = self.pending.rfind(b'\n') + 1
+            # Campo entre aspas com quebra de linha atravessando o corte: esperar mais bytes
+            if cut == 0 or self.pending.count(b'"', 0, cut) % 2:
+                return
+        portion = bytes(self.pending[:cut])
+        del self.pending[:cut]
         
-    except Exception as e:
-        return {'error': str(e)}
+        try:
+            if self.header is None:
+                # Mesmo dialeto que read_csv_file detectaria no começo do arquivo
+                self.dialect = sniff_csv_dialect(portion[:CSV_SNIFF_BYTES], complete=final and len(portion) < CSV_SNIFF_BYTES)
+                if self.dialect['encoding'] == 'utf-16':
+                    raise ValueError('UTF-16 não pode ser dividido em linhas byte a byte')
+                header_end = portion.find(b'\n') + 1 or len(portion)
+                self.header = portion[:header_end]
+                if self.header.count(b'"') % 2:
+                    raise ValueError('cabeçalho com quebra de linha entre aspas')
+                self.columns = list(pd.read_csv(io.BytesIO(self.header), **csv_read_options(self.dialect)).columns)
+                portion = portion[header_end:]
+            if portion.strip():
+                batch = pd.read_csv(io.BytesIO(self.header + portion), **csv_read_options(self.dialect))
+                if list(batch.columns) != self.columns:
+                    raise ValueError('colunas diferentes do cabeçalho')
+                self.batches.append(batch)
+        except Exception as e:
+            self.fail(f'lote ilegível: {e}')
+    
+    def fail(self, reason):
+        logger.debug("Conversão durante o upload abandonada: %s", reason)
+        self.failed = reason
+        self.batches = []
+        self.pending = bytearray()
+    
+    @staticmethod
+    def _compatible(dtypes):
+        # Inteiros e floats se combinam em float64, como na leitura do arquivo inteiro
+        if len({str(dtype) for dtype in dtypes}) == 1:
+            return True
+        return all(isinstance(dtype, np.dtype) and dtype.kind in 'if' for dtype in dtypes)
+    
+    def finish(self):
+        """DataFrame igual ao da leitura do arquivo completo, ou None"""
+        if not self.failed:
+            self._parse_pending(final=True)
+        if self.failed or self.columns is None:
+            return None
+        if not self.batches:
+            return pd.read_csv(io.BytesIO(self.header), **csv_read_options(self.dialect))
+        
+        for position in range(len(self.columns)):
+            # Lotes em que a coluna veio toda vazia (float NaN) se combinam com qualquer tipo
+            dtypes = [batch.iloc[:, position].dtype for batch in self.batches
+                      if batch.iloc[:, position].notna().any()]
+            if len(dtypes) > 1 and not self._compatible(dtypes):
+                self.fail(f'tipos divergentes entre lotes na coluna {self.columns[position]}')
+                return None
+        df = pd.concat(self.batches, ignore_index=True)
+        self.batches = []
+        return df
+
+# Estado em memória dos uploads em andamento neste processo (hash incremental e parser)
+_upload_streams = {}
+_upload_streams_lock = threading.Lock()
+
+def upload_meta_path(upload_id):
+    return os.path.join(UPLOAD_FOLDER, f'upload_{secure_filename(upload_id)}.json')
+
+def load_upload_meta(upload_id):
+    try:
+        with open(upload_meta_path(upload_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_upload_meta(meta):
+    temp = upload_meta_path(meta['id']) + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(temp, upload_meta_path(meta['id']))
+
+def public_upload_status(meta):
+    return {key: meta.get(key) for key in ('id', 'filename', 'size', 'offset', 'complete', 'sha256',
+                                           'rows', 'columns', 'parsed')}
+
+def get_upload_stream(meta, offset):
+    """Estado incremental do upload; refeito a partir do disco se outro processo recebeu as partes anteriores"""
+    with _upload_streams_lock:
+        state = _upload_streams.get(meta['id'])
+        if state is None or state['offset'] != offset:
+            fmt, compression = spreadsheet_format(meta['filename'])
+            state = {'offset': 0, 'hash': hashlib.sha256(), 'lines': 0, 'last_byte': b'',
+                     'parser': None, 'decompressor': None, 'lock': threading.Lock(), 'touched': time.time()}
+            # .csv.gz é descompactado parte a parte; .zip só pode ser lido depois (diretório no fim do arquivo)
+            if compression == 'gzip':
+                state['decompressor'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if (DATASET_CACHE_ENABLED and fmt == 'csv' and compression != 'zip'
+                    and meta['size'] <= STREAMING_PARSE_MAX_BYTES):
+                state['parser'] = StreamingCsvParser()
+            _upload_streams[meta['id']] = state
+            if offset:
+                with open(meta['path'], 'rb') as f:
+                    for block in iter(lambda: f.read(UPLOAD_READ_BLOCK), b''):
+                        consume_upload_block(state, block)
+        state['touched'] = time.time()
+        return state
+
+def consume_upload_block(state, block):
+    state['hash'].update(block)
+    state['offset'] += len(block)
+    data = block
+    decompressor = state['decompressor']
+    if decompressor is not None:
+        try:
+            data = decompressor.decompress(block)
+            # gzip com vários membros (arquivos concatenados): continuar no membro seguinte
+            while decompressor.eof and decompressor.unused_data:
+                rest = decompressor.unused_data
+                decompressor = state['decompressor'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decompressor.decompress(rest)
+        except zlib.error as e:
+            # Arquivo corrompido: o upload continua, a leitura na análise vai apontar o erro
+            state['decompressor'] = None
+            state['lines'] = None
+            if state['parser'] is not None:
+                state['parser'].fail(f'gzip inválido: {e}')
+            return
+    if state['lines'] is None or not data:
+        return
+    state['lines'] += data.count(b'\n')
+    state['last_byte'] = data[-1:]
+    if state['parser'] is not None:
+        state['parser'].feed(data)
+
+def finalize_upload(meta, state):
+    """Fecha o upload: hash final, contagem de linhas e DataFrame já convertido no cache compartilhado"""
+    meta.update({'complete': True, 'sha256': state['hash'].hexdigest(), 'parsed': False})
+    fmt, compression = spreadsheet_format(meta['filename'])
+    if fmt == 'csv' and compression != 'zip' and state['lines'] is not None:
+        lines = state['lines'] + (1 if state['last_byte'] not in (b'', b'\n') else 0)
+        # Estimativa (quebras de linha entre aspas contam a mais) até o parser confirmar
+        meta['rows'] = max(0, lines - 1)
+    
+    parser = state['parser']
+    df = parser.finish() if parser is not None else None
+    if df is not None:
+        meta.update({'rows': len(df), 'columns': len(df.columns), 'parsed': True})
+        compact = COMPACT_ON_LOAD
+        prepare_loaded_frame(df, meta['path'], compact, dataset_cache_key(meta['path'], compact))
+    with _upload_streams_lock:
+        _upload_streams.pop(meta['id'], None)
+    logger.info("Upload %s concluído: %s bytes, sha256 %s, %s linhas", meta['id'], meta['size'],
+                meta['sha256'][:12], meta.get('rows'))
+
+def expire_stale_uploads():
+    """Descarta uploads abandonados (arquivos parciais e estado em memória)"""
+    now = time.time()
+    with _upload_streams_lock:
+        for upload_id, state in list(_upload_streams.items()):
+            if now - state['touched'] > UPLOAD_EXPIRATION_SECONDS:
+                _upload_streams.pop(upload_id, None)
+    for name in os.listdir(UPLOAD_FOLDER):
+        if not (name.startswith('upload_') and name.endswith('.json')):
+            continue
+        path = os.path.join(UPLOAD_FOLDER, name)
+        try:
+            if now - os.path.getmtime(path) <= UPLOAD_EXPIRATION_SECONDS:
+                continue
+            with open(path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if os.path.exists(meta['path']):
+                os.remove(meta['path'])
+            os.remove(path)
+        except (OSError, ValueError, KeyError):
+            continue
+
+def take_completed_uploads(*upload_ids):
+    """(caminho, nome original) dos uploads concluídos, consumindo os metadados; None se algum não estiver pronto"""
+    metas = [load_upload_meta(upload_id) for upload_id in upload_ids]
+    if not all(meta and meta.get('complete') for meta in metas):
+        return None
+    for meta in metas:
+        os.remove(upload_meta_path(meta['id']))
+        remember_content_hash(meta['path'], meta['sha256'])
+    return [(meta['path'], meta['filename']) for meta in metas]
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if _precompute_jobs:
+        touch_session_precompute(session.get('cache_id'))
+    
+    mode = requested_profile_mode() if ADMIN_TOKEN else None
+    if mode and request.endpoint and not request.endpoint.startswith('admin_') and _profile_slot.acquire(blocking=False):
+        profile = RequestProfile(request.endpoint, mode)
+        profile.start()
+        _active_profile.profile = profile
+        g.profile = profile
+
+def finish_request_profile(profile=None):
+    """Encerra o profiling da requisição (o de g, se nenhum for passado) e grava o relatório"""
+    if profile is None:
+        profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    try:
+        report = profile.stop()
+        save_profile_report(report)
+        logger.info("Perfil %s gravado para %s (%.3fs)", report['id'], report['route'], report['duration_s'])
+        return report['id']
+    finally:
+        _active_profile.profile = None
+        _profile_slot.release()
+
+@app.teardown_request
+def cleanup_request_profile(exc):
+    # Requisições que terminaram com exceção não passam pelo after_request
+    if 'profile' in g:
+        finish_request_profile()
+
+def record_request_duration(started, labels, status_code):
+    metrics.observe('checkplanilhas_request_duration_seconds', time.perf_counter() - started, labels,
+                    'Latência das requisições por rota')
+    metrics.inc('checkplanilhas_requests_total', {**labels, 'status': status_code},
+                help_text='Requisições por rota e status')
+
+@app.after_request
+def record_request_metrics(response):
+    labels = {'route': request.endpoint or 'unknown', 'method': request.method}
+    if response.is_streamed:
+        # Página em fluxo (render_results_page): as etapas da comparação rodam depois daqui,
+        # enquanto o servidor consome a resposta; perfil e latência se encerram no fechamento
+        profile, started = g.pop('profile', None), g.pop('request_started', None)
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile.id
+        
+        def finish_streamed_request():
+            if profile is not None:
+                finish_request_profile(profile)
+            if started is not None:
+                record_request_duration(started, labels, response.status_code)
+        response.call_on_close(finish_streamed_request)
+        return response
+    
+    if 'profile' in g:
+        profile_id = finish_request_profile()
+        if profile_id:
+            response.headers['X-Profile-Id'] = profile_id
+    
+    started = g.pop('request_started', None)
+    if started is not None:
+        record_request_duration(started, labels, response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas no formato de texto do Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiles', methods=['GET', 'POST'])
+def admin_profiles():
+    """Página de administração com os perfis gravados"""
+    if request.method == 'POST':
+        if request.form.get('token'):
+            if ADMIN_TOKEN and request.form.get('token') == ADMIN_TOKEN:
+                session['is_admin'] = True
+            else:
+                flash('Token de administrador inválido')
+        elif is_admin_request():
+            mode = request.form.get('profile_requests')
+            if mode in ('sampling', 'deterministic'):
+                session['profile_requests'] = mode
+            else:
+                session.pop('profile_requests', None)
+        return redirect(url_for('admin_profiles'))
+    
+    reports = []
+    if is_admin_request() and os.path.isdir(PROFILE_FOLDER):
+        for filename in sorted(os.listdir(PROFILE_FOLDER), reverse=True):
+            if filename.endswith('.json'):
+                report = load_profile_report(filename[:-5])
+                if report:
+                    reports.append({key: report[key] for key in
+                                    ('id', 'route', 'mode', 'created_at', 'duration_s', 'peak_memory_bytes')})
+        reports.sort(key=lambda report: report['created_at'], reverse=True)
+    
+    return render_template('admin_profiles.html',
+                           is_admin=is_admin_request(),
+                           admin_enabled=bool(ADMIN_TOKEN),
+                           profile_mode=session.get('profile_requests'),
+                           reports=reports)
+
+@app.route('/admin/profiles/<profile_id>')
+def admin_profile_detail(profile_id):
+    if not is_admin_request():
+        return redirect(url_for('admin_profiles'))
+    report = load_profile_report(profile_id)
+    if report is None:
+        flash('Perfil não encontrado')
+        return redirect(url_for('admin_profiles'))
+    return render_template('admin_profile.html', report=report, flame=build_flame_tree(report['stacks']))
+
+@app.route('/admin/profiles/<profile_id>/download')
+def admin_profile_download(profile_id):
+    """Baixa o .prof (cProfile) ou as pilhas colapsadas (compatíveis com flamegraph.pl/speedscope)"""
+    if not is_admin_request():
+        return redirect(url_for('admin_profiles'))
+    report = load_profile_report(profile_id)
+    if report is None:
+        return Response('Perfil não encontrado', status=404)
+    prof_path = os.path.join(PROFILE_FOLDER, f"{report['id']}.prof")
+    if report['mode'] == 'deterministic' and os.path.exists(prof_path):
+        return send_file(os.path.abspath(prof_path), as_attachment=True)
+    collapsed = '\n'.join(f'{stack} {count}' for stack, count in report['stacks'].items())
+    return Response(collapsed, mimetype='text/plain',
+                    headers={'Content-Disposition': f"attachment; filename={report['id']}.collapsed.txt"})
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html',
+                           direct_upload_limit=app.config['MAX_CONTENT_LENGTH'],
+                           max_upload_bytes=MAX_UPLOAD_BYTES,
+                           max_destination_files=MAX_DESTINATION_FILES)
 
-@app.route('/analyze', methods=['POST'])
-def analyze_files():
-    """Nova rota para análise inteligente de mapeamento"""
-    if 'file1' not in request.files or 'file2' not in request.files:
-        flash('Por favor, selecione ambos os arquivos')
-        return redirect(url_for('index'))
+@app.route('/uploads', methods=['POST'])
+def start_chunked_upload():
+    """Inicia um upload em partes; o cliente envia as partes com PUT /uploads/<id>"""
+    data = request.get_json(silent=True) or request.form
+    filename = data.get('filename', '')
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
     
-    file1 = request.files['file1']
-    file2 = request.files['file2']
+    if not allowed_file(filename):
+        return jsonify({'error': 'Tipo de arquivo não permitido'}), 400
+    if size <= 0:
+        return jsonify({'error': 'Tamanho do arquivo não informado'}), 400
+    if size > MAX_UPLOAD_BYTES:
+        return jsonify({'error': f'Arquivo maior que o limite de {MAX_UPLOAD_BYTES // 1048576} MB'}), 413
     
-    if file1.filename == '' or file2.filename == '':
-        flash('Por favor, selecione ambos os arquivos')
-        return redirect(url_for('index'))
+    expire_stale_uploads()
+    upload_id = uuid.uuid4().hex
+    path = os.path.join(UPLOAD_FOLDER, secure_filename(f"parcial_{upload_id}_{filename}"))
+    open(path, 'wb').close()
+    meta = {'id': upload_id, 'filename': filename, 'path': path, 'size': size, 'offset': 0,
+            'complete': False, 'sha256': None, 'rows': None, 'columns': None, 'parsed': False}
+    save_upload_meta(meta)
+    return jsonify({**public_upload_status(meta), 'chunk_size': UPLOAD_CHUNK_SIZE}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Quanto do upload o servidor já recebeu (para retomar após falha)"""
+    meta = load_upload_meta(upload_id)
+    if meta is None:
+        return jsonify({'error': 'Upload não encontrado'}), 404
+    if not meta['complete']:
+        meta['offset'] = os.path.getsize(meta['path'])
+    return jsonify(public_upload_status(meta))
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def receive_upload_chunk(upload_id):
+    """Recebe uma parte a partir de X-Upload-Offset, gravando em disco enquanto calcula hash e linhas"""
+    meta = load_upload_meta(upload_id)
+    if meta is None:
+        return jsonify({'error': 'Upload não encontrado'}), 404
+    if meta['complete']:
+        return jsonify(public_upload_status(meta))
+    try:
+        offset = int(request.headers.get('X-Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Cabeçalho X-Upload-Offset ausente'}), 400
     
-    if file1 and allowed_file(file1.filename) and file2 and allowed_file(file2.filename):
+    received = os.path.getsize(meta['path'])
+    if offset != received:
+        # O cliente deve retomar do ponto que o servidor realmente gravou
+        return jsonify({'error': 'Offset divergente', **public_upload_status({**meta, 'offset': received})}), 409
+    
+    state = get_upload_stream(meta, received)
+    with state['lock']:
+        if state['offset'] != offset:
+            # Outra requisição gravou esta mesma parte enquanto esperávamos
+            return jsonify({'error': 'Offset divergente', **public_upload_status({**meta, 'offset': state['offset']})}), 409
+        with stage_timer('upload', nbytes=0) as info:
+            with open(meta['path'], 'ab') as f:
+                while True:
+                    block = request.stream.read(UPLOAD_READ_BLOCK)
+                    if not block:
+                        break
+                    if state['offset'] + len(block) > meta['size']:
+                        return jsonify({'error': 'Parte ultrapassa o tamanho declarado'}), 400
+                    f.write(block)
+                    consume_upload_block(state, block)
+                    info['bytes'] += len(block)
+        
+        meta['offset'] = state['offset']
+        if meta['offset'] == meta['size']:
+            with stage_timer('upload_finalize', rows=0) as info:
+                finalize_upload(meta, state)
+                info['rows'] = meta['rows'] or 0
+        save_upload_meta(meta)
+    return jsonify(public_upload_status(meta))
+
+def discard_uploaded_files(*paths):
+    """Apaga os arquivos enviados quando a análise não chega à sessão"""
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+@app.route('/analyze', methods=['POST'])
+def analyze_files():
+    """Nova rota para análise inteligente de mapeamento"""
+    # Arquivos grandes chegam antes, em partes (/uploads); o formulário traz só os identificadores
+    if request.form.get('upload_id1') and request.form.get('upload_id2'):
+        uploaded = take_completed_uploads(request.form['upload_id1'], request.form['upload_id2'])
+        if uploaded is None:
+            flash('O envio dos arquivos não foi concluído. Por favor, tente novamente.')
+            return redirect(url_for('index'))
+        (file1_path, file1_name), (file2_path, file2_name) = uploaded
+    else:
+        if 'file1' not in request.files or 'file2' not in request.files:
+            flash('Por favor, selecione ambos os arquivos')
+            return redirect(url_for('index'))
+        
+        file1 = request.files['file1']
+        file2 = request.files['file2']
+        
+        if file1.filename == '' or file2.filename == '':
+            flash('Por favor, selecione ambos os arquivos')
+            return redirect(url_for('index'))
+        
+        if not (allowed_file(file1.filename) and allowed_file(file2.filename)):
+            flash('Tipos de arquivo não permitidos. Use apenas .xlsx, .xls, .csv, .csv.gz ou .zip')
+            return redirect(url_for('index'))
+        
         # Salvar arquivos temporariamente
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename1 = secure_filename(f"origem_{timestamp}_{file1.filename}")
@@ -890,26 +5258,42 @@ def analyze_files():
         
         file1.save(file1_path)
         file2.save(file2_path)
-        
-        # Carregar planilhas para análise
-        df1 = load_spreadsheet(file1_path)
-        df2 = load_spreadsheet(file2_path)
-        
-        if df1 is None or df2 is None:
-            flash('Erro ao carregar as planilhas')
-            return redirect(url_for('index'))
-        
-        # Fazer análise inteligente de mapeamento
-        mapping_result = find_intelligent_column_mapping(df1, df2)
-        
+        file1_name, file2_name = file1.filename, file2.filename
+    
+    # Carregar planilhas e fazer a análise inteligente de mapeamento dentro do orçamento de memória.
+    # Em qualquer falha os arquivos são apagados: os metadados do upload em partes já foram
+    # consumidos e nada mais os removeria
+    try:
+        # Arquivos grandes: cabeçalho e amostra bastam para sugerir o mapeamento
+        df1, df2 = load_analysis_frames('analyze', file1_path, file2_path)
+        mapping_result = find_intelligent_column_mapping(df1, df2) if df1 is not None and df2 is not None else None
+    except MemoryBudgetExceeded as e:
+        discard_uploaded_files(file1_path, file2_path)
+        flash(str(e))
+        return redirect(url_for('index'))
+    except Exception as e:
+        logger.exception("Erro na análise das planilhas: %s", e)
+        df1 = df2 = None
+    
+    if df1 is None or df2 is None:
+        discard_uploaded_files(file1_path, file2_path)
+        flash('Erro ao carregar as planilhas')
+        return redirect(url_for('index'))
+    
+    try:
         # Armazenar informações na sessão
+        clear_session_cache(session.get('cache_id'))
+        get_session_cache_id()
         session['file1_path'] = file1_path
         session['file2_path'] = file2_path
-        session['file1_name'] = file1.filename
-        session['file2_name'] = file2.filename
+        session['file1_name'] = file1_name
+        session['file2_name'] = file2_name
         session['column_mapping'] = mapping_result['mapping']
+        analysis = remember_mapping_analysis(session['cache_id'], file1_path, file2_path, df1, df2, mapping_result)
         
-        # Identificar campos-chave sugeridos
+        # Identificar campos-chave sugeridos. Sobre a amostra de um arquivo grande são provisórios:
+        # a comparação em fluxo confere a unicidade no arquivo inteiro, e o plano e o motor por
+        # hash escolhem as chaves de novo sobre o que leram
         if mapping_result['mapping']:
             key_cols1, key_cols2, key_details = identify_best_key_fields(
                 mapping_result['mapping'], df1, df2, min_fields=1, max_fields=5
@@ -917,39 +5301,134 @@ def analyze_files():
             session['suggested_keys'] = {
                 'cols1': key_cols1,
                 'cols2': key_cols2,
-                'details': key_details
+                'details': key_details,
+                'provisional': bool(df1.attrs.get('sampled') or df2.attrs.get('sampled'))
             }
         else:
-            session['suggested_keys'] = {'cols1': [], 'cols2': [], 'details': []}
+            session['suggested_keys'] = {'cols1': [], 'cols2': [], 'details': [], 'provisional': False}
         
-        # Preparar dados para a interface de mapeamento
+        # Esqueleto da interface de mapeamento: análise, amostras e candidatos de cada
+        # coluna ficam nos endpoints /mapping/... e só são buscados quando a linha é expandida
+        content1 = mapping_result['content_analysis']['origin']
+        content2 = mapping_result['content_analysis']['destination']
         mapping_data = {
+            'version': analysis['version'],
             'file1': {
                 'columns': list(df1.columns),
-                'sample_data': df1.head(3).to_dict('records'),
-                'total_rows': len(df1),
-                'content_analysis': mapping_result['content_analysis']['origin']
+                'total_rows': frame_total_rows(df1),
+                'rows_estimated': df1.attrs.get('sampled', False),
+                'types': {col: info['type'] for col, info in content1.items()}
             },
             'file2': {
                 'columns': list(df2.columns),
-                'sample_data': df2.head(3).to_dict('records'),
-                'total_rows': len(df2),
-                'content_analysis': mapping_result['content_analysis']['destination']
+                'total_rows': frame_total_rows(df2),
+                'rows_estimated': df2.attrs.get('sampled', False),
+                'types': {col: info['type'] for col, info in content2.items()}
             },
             'mapping': mapping_result['mapping'],
-            'mapping_details': mapping_result['mapping_details'],
+            'similarity': {col1: details['total_similarity']
+                           for col1, details in mapping_result['mapping_details'].items()},
             'unmapped_origin': mapping_result['unmapped_origin'],
             'unmapped_destination': mapping_result['unmapped_destination'],
-            'suggested_keys': session['suggested_keys']['details']
+            'suggested_keys': session['suggested_keys']['details'],
+            'suggested_keys_provisional': session['suggested_keys']['provisional']
         }
         
-        return render_template('mapping.html',
-                             mapping=mapping_data,
-                             file1_name=file1.filename,
-                             file2_name=file2.filename)
-    
-    flash('Tipos de arquivo não permitidos. Use apenas .xlsx, .xls ou .csv')
-    return redirect(url_for('index'))
+        response = make_response(render_template('mapping.html',
+                                                 mapping=mapping_data,
+                                                 file1_name=file1_name,
+                                                 file2_name=file2_name))
+        
+        # Enquanto o usuário revisa o mapeamento: leitura completa, chaves e linhas exclusivas
+        if PRECOMPUTE_ENABLED and mapping_result['mapping']:
+            response.call_on_close(functools.partial(start_session_precompute, session['cache_id'], file1_path, file2_path,
+                                                     mapping_result['mapping'], session['suggested_keys']['details']))
+        return response
+    except Exception as e:
+        logger.exception("Erro na análise das planilhas: %s", e)
+        for key in ('file1_path', 'file2_path', 'file1_name', 'file2_name', 'column_mapping', 'suggested_keys'):
+            session.pop(key, None)
+        discard_uploaded_files(file1_path, file2_path)
+        flash(f'Erro na análise das planilhas: {str(e)}')
+        return redirect(url_for('index'))
+
+
+def session_mapping_analysis():
+    """Análise de mapeamento da sessão atual, conferindo a versão pedida na URL"""
+    if 'file1_path' not in session or 'file2_path' not in session:
+        return None, (jsonify({'error': 'Sessão expirou'}), 404)
+    analysis = get_mapping_analysis(get_session_cache_id(), session['file1_path'], session['file2_path'])
+    if analysis is None:
+        return None, (jsonify({'error': 'Erro ao carregar as planilhas'}), 500)
+    if request.args.get('v') and request.args['v'] != analysis['version']:
+        return None, (jsonify({'error': 'Os arquivos da sessão mudaram; recarregue a página'}), 409)
+    return analysis, None
+
+@app.route('/mapping/<int:side>/columns/<int:position>')
+def mapping_column_details(side, position):
+    """Rota AJAX: análise de conteúdo de uma coluna (1 = origem, 2 = destino)"""
+    try:
+        analysis, error = session_mapping_analysis()
+        if error:
+            return error
+        columns = analysis['columns'].get(side)
+        if columns is None or not 0 <= position < len(columns):
+            return jsonify({'error': 'Coluna não encontrada'}), 404
+        info = analysis['content_analysis'][side][columns[position]]
+        return mapping_details_response({
+            'column': columns[position],
+            'type': info['type'],
+            'patterns': info['patterns'],
+            'stats': info.get('stats', {}),
+            'sample': [str(value) for value in info['sample']]
+        })
+    except MemoryBudgetExceeded as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.exception("Erro nos detalhes da coluna: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/mapping/<int:side>/sample')
+def mapping_sample(side):
+    """Rota AJAX: primeiras linhas da planilha para o preview da página de mapeamento"""
+    try:
+        analysis, error = session_mapping_analysis()
+        if error:
+            return error
+        if side not in analysis['columns']:
+            return jsonify({'error': 'Planilha não encontrada'}), 404
+        return mapping_details_response({
+            'columns': analysis['columns'][side],
+            'rows': [{col: str(value) for col, value in row.items()} for row in analysis['samples'][side]]
+        })
+    except MemoryBudgetExceeded as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.exception("Erro na amostra da planilha: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/mapping/candidates/<int:position>')
+def mapping_candidates(position):
+    """Rota AJAX: colunas do destino mais parecidas com uma coluna da origem"""
+    try:
+        analysis, error = session_mapping_analysis()
+        if error:
+            return error
+        if not 0 <= position < len(analysis['candidates']):
+            return jsonify({'error': 'Coluna não encontrada'}), 404
+        types2 = analysis['content_analysis'][2]
+        return mapping_details_response({
+            'column': analysis['columns'][1][position],
+            'candidates': [
+                {**candidate, 'type': types2[candidate['col2']]['type']}
+                for candidate in analysis['candidates'][position]
+            ]
+        })
+    except MemoryBudgetExceeded as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.exception("Erro nos candidatos de mapeamento: %s", e)
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/preview_with_mapping', methods=['POST'])
 def preview_with_mapping():
@@ -964,11 +5443,12 @@ def preview_with_mapping():
         confirmed_mapping = json.loads(confirmed_mapping_json)
         session['column_mapping'] = confirmed_mapping
         
-        print(f"[DEBUG] Mapeamento confirmado: {confirmed_mapping}")
+        logger.debug("Mapeamento confirmado: %s", confirmed_mapping)
         
         # Carregar planilhas para preview
-        df1 = load_spreadsheet(session['file1_path'])
-        df2 = load_spreadsheet(session['file2_path'])
+        with memory_admission('preview', session['file1_path'], session['file2_path']):
+            df1 = load_spreadsheet(session['file1_path'])
+            df2 = load_spreadsheet(session['file2_path'])
         
         if df1 is None or df2 is None:
             flash('Erro ao carregar as planilhas')
@@ -1013,41 +5493,106 @@ def quick_compare():
         flash('Sessão expirou. Por favor, faça upload dos arquivos novamente.')
         return redirect(url_for('index'))
     
+    cleanup = None
     try:
         # Obter mapeamento confirmado
         confirmed_mapping_json = request.form.get('confirmed_mapping', '{}')
         confirmed_mapping = json.loads(confirmed_mapping_json)
         
-        print(f"[DEBUG] Comparação rápida com mapeamento: {confirmed_mapping}")
+        logger.debug("Comparação rápida com mapeamento: %s", confirmed_mapping)
         
-        # Fazer comparação com mapeamento
-        results = compare_spreadsheets_with_mapping(
+        # Fazer comparação com mapeamento (executada por seções enquanto a página é enviada)
+        sections = after_session_precompute(get_session_cache_id(), iter_compare_spreadsheets_with_mapping(
             session['file1_path'], 
             session['file2_path'],
-            confirmed_mapping
-        )
+            confirmed_mapping,
+            key_fields=session.get('suggested_keys', {}).get('details'),
+            sorted_inputs=request.form.get('sorted_inputs') == '1'
+        ))
+        file1_name, file2_name = session['file1_name'], session['file2_name']
         
-        return render_template('results.html', 
-                             results=results,
-                             file1_name=session['file1_name'],
-                             file2_name=session['file2_name'],
-                             quick_mode=True)
+        # Limpar sessão; arquivos e caches só depois que a página termina
+        cleanup = session_comparison_cleanup()
+        return render_results_page(sections, cleanup,
+                                   file1_name=file1_name,
+                                   file2_name=file2_name,
+                                   quick_mode=True)
     except Exception as e:
         flash(f'Erro na comparação: {str(e)}')
+        (cleanup or session_comparison_cleanup())()
         return redirect(url_for('index'))
-    finally:
-        # Limpar arquivos temporários
-        if 'file1_path' in session and os.path.exists(session['file1_path']):
-            os.remove(session['file1_path'])
-        if 'file2_path' in session and os.path.exists(session['file2_path']):
-            os.remove(session['file2_path'])
-        # Limpar sessão
-        session.pop('file1_path', None)
-        session.pop('file2_path', None)
-        session.pop('file1_name', None)
-        session.pop('file2_name', None)
-        session.pop('column_mapping', None)
-        session.pop('suggested_keys', None)
+
+@app.route('/quick_estimate', methods=['POST'])
+def quick_estimate():
+    """Rota AJAX: estimativa aproximada das diferenças, mantendo a sessão para a comparação exata"""
+    if 'file1_path' not in session or 'file2_path' not in session:
+        return jsonify({'error': 'Sessão expirou'})
+    
+    try:
+        started = time.perf_counter()
+        confirmed_mapping = json.loads(request.form.get('confirmed_mapping') or '{}')
+        filters1 = json.loads(request.form.get('filters1') or '[]')
+        filters2 = json.loads(request.form.get('filters2') or '[]')
+        if not confirmed_mapping:
+            return jsonify({'error': 'Configure pelo menos um mapeamento de colunas'})
+        
+        result = estimate_comparison(session['file1_path'], session['file2_path'],
+                                     confirmed_mapping, filters1, filters2,
+                                     key_fields=session.get('suggested_keys', {}).get('details'))
+        if 'error' in result:
+            return jsonify(result)
+        
+        result['success'] = True
+        result['filters_applied'] = len(filters1) + len(filters2)
+        result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return jsonify(result)
+    
+    except MemoryBudgetExceeded as e:
+        return jsonify({'error': str(e)})
+    except Exception as e:
+        logger.exception("Erro na estimativa: %s", e)
+        return jsonify({'error': str(e)})
+
+@app.route('/comparison_plan', methods=['POST'])
+def comparison_plan():
+    """Rota AJAX: plano da comparação configurada (dry-run), sem executá-la nem encerrar a sessão"""
+    if 'file1_path' not in session or 'file2_path' not in session:
+        return jsonify({'error': 'Sessão expirou'})
+    
+    try:
+        started = time.perf_counter()
+        confirmed_mapping = json.loads(request.form.get('confirmed_mapping') or '{}')
+        if not confirmed_mapping:
+            return jsonify({'error': 'Configure pelo menos um mapeamento de colunas'})
+        
+        plan = plan_comparison(
+            session['file1_path'],
+            session['file2_path'],
+            confirmed_mapping,
+            json.loads(request.form.get('filters1') or '[]'),
+            json.loads(request.form.get('filters2') or '[]'),
+            json.loads(request.form.get('total_columns') or '[]'),
+            json.loads(request.form.get('group_columns') or '[]'),
+            key_fields=session.get('suggested_keys', {}).get('details'),
+            sorted_inputs=request.form.get('sorted_inputs') == '1',
+            cache_id=get_session_cache_id(),
+            provisional_keys=session.get('suggested_keys', {}).get('provisional', False)
+        )
+        plan['success'] = True
+        plan['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return jsonify(plan)
+    
+    except MemoryBudgetExceeded as e:
+        return jsonify({'error': str(e)})
+    except Exception as e:
+        logger.exception("Erro no plano da comparação: %s", e)
+        return jsonify({'error': str(e)})
+
+@app.route('/precompute/cancel', methods=['POST'])
+def cancel_precompute():
+    """A página de mapeamento foi fechada sem comparar (navigator.sendBeacon): o pré-cálculo para"""
+    cancel_session_precompute(session.get('cache_id'))
+    return '', 204
 
 @app.route('/compare_with_filters_and_mapping', methods=['POST'])
 def compare_with_filters_and_mapping():
@@ -1056,87 +5601,127 @@ def compare_with_filters_and_mapping():
         flash('Sessão expirou. Por favor, faça upload dos arquivos novamente.')
         return redirect(url_for('index'))
     
+    cleanup = None
     try:
         # Obter mapeamento confirmado
         confirmed_mapping_json = request.form.get('confirmed_mapping', '{}')
-        print(f"[DEBUG] Mapeamento JSON recebido: '{confirmed_mapping_json}'")
+        logger.debug("Mapeamento JSON recebido: '%s'", confirmed_mapping_json)
         
         try:
             confirmed_mapping = json.loads(confirmed_mapping_json) if confirmed_mapping_json else {}
         except json.JSONDecodeError as e:
-            print(f"[ERROR] Erro ao fazer parse do mapeamento: {e}")
+            logger.error("Erro ao fazer parse do mapeamento: %s", e)
             confirmed_mapping = {}
         
         # Obter filtros
         filters1_raw = request.form.get('filters1', '[]')
         filters2_raw = request.form.get('filters2', '[]')
-        print(f"[DEBUG] Filtros1 JSON recebido: '{filters1_raw}'")
-        print(f"[DEBUG] Filtros2 JSON recebido: '{filters2_raw}'")
+        logger.debug("Filtros1 JSON recebido: '%s'", filters1_raw)
+        logger.debug("Filtros2 JSON recebido: '%s'", filters2_raw)
         
         try:
             filters1 = json.loads(filters1_raw) if filters1_raw else []
         except json.JSONDecodeError as e:
-            print(f"[ERROR] Erro ao fazer parse dos filtros1: {e}")
+            logger.error("Erro ao fazer parse dos filtros1: %s", e)
             filters1 = []
             
         try:
             filters2 = json.loads(filters2_raw) if filters2_raw else []
         except json.JSONDecodeError as e:
-            print(f"[ERROR] Erro ao fazer parse dos filtros2: {e}")
+            logger.error("Erro ao fazer parse dos filtros2: %s", e)
             filters2 = []
         
         # Obter totalizadores
         total_columns_raw = request.form.get('total_columns', '[]')
-        print(f"[DEBUG] Totalizadores JSON recebido: '{total_columns_raw}'")
+        logger.debug("Totalizadores JSON recebido: '%s'", total_columns_raw)
         
         try:
             total_columns = json.loads(total_columns_raw) if total_columns_raw else []
         except json.JSONDecodeError as e:
-            print(f"[ERROR] Erro ao fazer parse dos totalizadores: {e}")
+            logger.error("Erro ao fazer parse dos totalizadores: %s", e)
             total_columns = []
         
-        print(f"[DEBUG] Comparação completa:")
-        print(f"[DEBUG] Mapeamento: {len(confirmed_mapping)} correspondências")
-        print(f"[DEBUG] Filtros ORIGEM: {len(filters1)} filtros")
-        print(f"[DEBUG] Filtros DESTINO: {len(filters2)} filtros")
-        print(f"[DEBUG] Totalizadores: {len(total_columns)} campos")
+        # Obter colunas de agrupamento para reconciliação por dimensão
+        group_columns_raw = request.form.get('group_columns', '[]')
+        try:
+            group_columns = json.loads(group_columns_raw) if group_columns_raw else []
+        except json.JSONDecodeError as e:
+            logger.error("Erro ao fazer parse das colunas de agrupamento: %s", e)
+            group_columns = []
+        
+        logger.debug("Comparação completa:")
+        logger.debug("Mapeamento: %s correspondências", len(confirmed_mapping))
+        logger.debug("Filtros ORIGEM: %s filtros", len(filters1))
+        logger.debug("Filtros DESTINO: %s filtros", len(filters2))
+        logger.debug("Totalizadores: %s campos", len(total_columns))
+        logger.debug("Agrupamento: %s", group_columns)
         
-        # Fazer comparação completa
-        results = compare_spreadsheets_with_mapping(
+        # Fazer comparação completa (executada por seções enquanto a página é enviada)
+        sections = after_session_precompute(get_session_cache_id(), iter_compare_spreadsheets_with_mapping(
             session['file1_path'], 
             session['file2_path'],
             confirmed_mapping,
             filters1,
             filters2,
-            total_columns
-        )
+            total_columns,
+            group_columns,
+            key_fields=session.get('suggested_keys', {}).get('details'),
+            sorted_inputs=request.form.get('sorted_inputs') == '1'
+        ))
+        file1_name, file2_name = session['file1_name'], session['file2_name']
         
-        return render_template('results.html', 
-                             results=results,
-                             file1_name=session['file1_name'],
-                             file2_name=session['file2_name'],
-                             advanced_mode=True)
+        # Limpar sessão; arquivos e caches só depois que a página termina
+        cleanup = session_comparison_cleanup()
+        return render_results_page(sections, cleanup,
+                                   file1_name=file1_name,
+                                   file2_name=file2_name,
+                                   advanced_mode=True)
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        print(f"[DEBUG] Erro na comparação completa: {str(e)}")
-        print(f"[DEBUG] Traceback completo:")
-        print(error_traceback)
+        logger.exception("Erro na comparação completa: %s", e)
         flash(f'Erro na comparação: {str(e)}')
+        (cleanup or session_comparison_cleanup())()
+        return redirect(url_for('index'))
+
+@app.route('/compare_many', methods=['POST'])
+def compare_many():
+    """Uma origem contra vários destinos, com a cobertura consolidada da origem"""
+    file1 = request.files.get('file1')
+    files2 = [f for f in request.files.getlist('files2') if f.filename]
+    if file1 is None or file1.filename == '' or not files2:
+        flash('Por favor, selecione a origem e pelo menos um destino')
+        return redirect(url_for('index'))
+    if len(files2) > MAX_DESTINATION_FILES:
+        flash(f'Envie no máximo {MAX_DESTINATION_FILES} arquivos de destino')
+        return redirect(url_for('index'))
+    if not all(allowed_file(f.filename) for f in [file1] + files2):
+        flash('Tipos de arquivo não permitidos. Use apenas .xlsx, .xls, .csv, .csv.gz ou .zip')
+        return redirect(url_for('index'))
+    
+    try:
+        confirmed_mapping = json.loads(request.form.get('confirmed_mapping') or '{}')
+    except json.JSONDecodeError:
+        confirmed_mapping = {}
+    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    file1_path = os.path.join(UPLOAD_FOLDER, secure_filename(f"origem_{timestamp}_{file1.filename}"))
+    file1.save(file1_path)
+    destinations = []
+    for number, file2 in enumerate(files2):
+        path = os.path.join(UPLOAD_FOLDER, secure_filename(f"destino_{timestamp}_{number}_{file2.filename}"))
+        file2.save(path)
+        destinations.append((path, file2.filename))
+    
+    try:
+        results = compare_origin_with_destinations(file1_path, destinations, confirmed_mapping or None)
+    except MemoryBudgetExceeded as e:
+        flash(str(e))
         return redirect(url_for('index'))
     finally:
-        # Limpar arquivos temporários
-        if 'file1_path' in session and os.path.exists(session['file1_path']):
-            os.remove(session['file1_path'])
-        if 'file2_path' in session and os.path.exists(session['file2_path']):
-            os.remove(session['file2_path'])
-        # Limpar sessão
-        session.pop('file1_path', None)
-        session.pop('file2_path', None)
-        session.pop('file1_name', None)
-        session.pop('file2_name', None)
-        session.pop('column_mapping', None)
-        session.pop('suggested_keys', None)
+        for path in [file1_path] + [path for path, _ in destinations]:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    return render_template('results_many.html', results=results, file1_name=file1.filename)
 
 @app.route('/preview_filters', methods=['POST'])
 def preview_filters():
@@ -1145,55 +5730,60 @@ def preview_filters():
         return jsonify({'error': 'Sessão expirou'})
     
     try:
+        started = time.perf_counter()
+        
         # Obter parâmetros
         planilha_num = int(request.form.get('planilha_num', 1))
         filters_raw = request.form.get('filters', '[]')
         filters = json.loads(filters_raw)
         
-        # Carregar planilha apropriada
         file_path = session['file1_path'] if planilha_num == 1 else session['file2_path']
-        df = load_spreadsheet(file_path)
+        state, ticket = get_filter_preview_state(get_session_cache_id(), planilha_num, file_path)
         
-        if df is None:
-            return jsonify({'error': 'Erro ao carregar planilha'})
+        with state['lock']:
+            if state['latest_ticket'] != ticket:
+                return jsonify({'cancelled': True})
+            
+            # Carregar a planilha apenas na primeira vez
+            if state['df'] is None:
+                with memory_admission('preview', file_path):
+                    df = load_spreadsheet(file_path)
+                if df is None:
+                    return jsonify({'error': 'Erro ao carregar planilha'})
+                state['df'] = df
+            df = state['df']
+            
+            with stage_timer('filter', rows=len(df)):
+                mask = compute_incremental_filter_mask(state, filters, ticket)
         
-        # Aplicar filtros
         original_count = len(df)
-        print(f"[DEBUG] Preview - DF original: {type(df)}, {original_count} linhas")
-        
-        if filters:
-            print(f"[DEBUG] Preview - Aplicando {len(filters)} filtros...")
-            df_filtered = apply_filters(df, filters)
-            print(f"[DEBUG] Preview - DF filtrado: {type(df_filtered)}")
-        else:
-            df_filtered = df
-        
-        # Verificar se df_filtered é válido
-        if not isinstance(df_filtered, pd.DataFrame):
-            print(f"[ERROR] Preview - df_filtered não é DataFrame: {type(df_filtered)}")
-            return jsonify({'error': f'Erro interno: resultado dos filtros é {type(df_filtered)}'})
+        filtered_count = original_count if mask is None else int(mask.sum())
+        logger.debug("Preview - %s de %s linhas", filtered_count, original_count)
         
-        filtered_count = len(df_filtered)
-        print(f"[DEBUG] Preview - Contagem final: {filtered_count} linhas")
-        
-        # Preparar preview (primeiras 5 linhas)
+        # Preparar preview (primeiras 5 linhas) sem materializar o DataFrame filtrado
         preview_data = []
+        display_cols = list(df.columns)[:6]
         if filtered_count > 0:
-            # Limitar colunas para preview (primeiras 6 colunas)
-            display_cols = list(df_filtered.columns)[:6]
-            preview_data = df_filtered[display_cols].head(5).fillna('VAZIO').to_dict('records')
+            positions = np.arange(min(5, original_count)) if mask is None else np.flatnonzero(mask)[:5]
+            preview_data = df.iloc[positions][display_cols].astype(object).fillna('VAZIO').to_dict('records')
         
         return jsonify({
             'success': True,
             'original_count': original_count,
             'filtered_count': filtered_count,
             'preview_data': preview_data,
-            'columns': list(df_filtered.columns)[:6] if filtered_count > 0 else [],
-            'filters_applied': len(filters)
+            'columns': display_cols if filtered_count > 0 else [],
+            'filters_applied': len(filters),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+            'indexes': describe_value_indexes(state['indexes'])
         })
-        
+    
+    except PreviewCancelled:
+        return jsonify({'cancelled': True})
+    except MemoryBudgetExceeded as e:
+        return jsonify({'error': str(e)})
     except Exception as e:
-        print(f"[DEBUG] Erro no preview de filtros: {str(e)}")
+        logger.exception("Erro no preview de filtros: %s", e)
         return jsonify({'error': str(e)})
 
 @app.route('/preview', methods=['POST'])
@@ -1222,14 +5812,21 @@ def preview_files():
         file2.save(file2_path)
         
         # Carregar planilhas para preview
-        df1 = load_spreadsheet(file1_path)
-        df2 = load_spreadsheet(file2_path)
+        try:
+            df1, df2 = load_analysis_frames('preview', file1_path, file2_path)
+        except MemoryBudgetExceeded as e:
+            discard_uploaded_files(file1_path, file2_path)
+            flash(str(e))
+            return redirect(url_for('index'))
         
         if df1 is None or df2 is None:
+            discard_uploaded_files(file1_path, file2_path)
             flash('Erro ao carregar as planilhas')
             return redirect(url_for('index'))
         
         # Armazenar caminhos na sessão
+        clear_session_cache(session.get('cache_id'))
+        get_session_cache_id()
         session['file1_path'] = file1_path
         session['file2_path'] = file2_path
         session['file1_name'] = file1.filename
@@ -1245,13 +5842,15 @@ def preview_files():
                 'columns': list(df1.columns),
                 'numeric_columns': numeric_columns1,
                 'sample_data': df1.head().to_dict('records'),
-                'total_rows': len(df1)
+                'total_rows': frame_total_rows(df1),
+                'rows_estimated': df1.attrs.get('sampled', False)
             },
             'file2': {
                 'columns': list(df2.columns),
                 'numeric_columns': numeric_columns2,
                 'sample_data': df2.head().to_dict('records'),
-                'total_rows': len(df2)
+                'total_rows': frame_total_rows(df2),
+                'rows_estimated': df2.attrs.get('sampled', False)
             }
         }
         
@@ -1260,7 +5859,7 @@ def preview_files():
                              file1_name=file1.filename,
                              file2_name=file2.filename)
     
-    flash('Tipos de arquivo não permitidos. Use apenas .xlsx, .xls ou .csv')
+    flash('Tipos de arquivo não permitidos. Use apenas .xlsx, .xls, .csv, .csv.gz ou .zip')
     return redirect(url_for('index'))
 
 @app.route('/compare', methods=['POST'])
@@ -1278,17 +5877,17 @@ def compare_with_filters():
         selected_columns = request.form.getlist('selected_columns')
         total_columns = request.form.getlist('total_columns')
         
-        print(f"[DEBUG] Filtros1 recebidos: {filters1}")
-        print(f"[DEBUG] Filtros2 recebidos: {filters2}")
-        print(f"[DEBUG] Colunas selecionadas: {selected_columns}")
-        print(f"[DEBUG] Colunas para totalizar: {total_columns}")
+        logger.debug("Filtros1 recebidos: %s", filters1)
+        logger.debug("Filtros2 recebidos: %s", filters2)
+        logger.debug("Colunas selecionadas: %s", selected_columns)
+        logger.debug("Colunas para totalizar: %s", total_columns)
         
         # Verificar se há mapeamento de colunas na sessão
         column_mapping = session.get('column_mapping', {})
         
         # Usar função apropriada baseada na existência de mapeamento
         if column_mapping:
-            print(f"[DEBUG] Usando mapeamento de colunas da sessão: {column_mapping}")
+            logger.debug("Usando mapeamento de colunas da sessão: %s", column_mapping)
             results = compare_spreadsheets_with_mapping(
                 session['file1_path'], 
                 session['file2_path'],
@@ -1298,7 +5897,7 @@ def compare_with_filters():
                 total_columns if total_columns else None
             )
         else:
-            print(f"[DEBUG] Usando comparação tradicional")
+            logger.debug("Usando comparação tradicional")
             results = compare_spreadsheets(
                 session['file1_path'], 
                 session['file2_path'],
@@ -1322,6 +5921,7 @@ def compare_with_filters():
         if 'file2_path' in session and os.path.exists(session['file2_path']):
             os.remove(session['file2_path'])
         # Limpar sessão
+        clear_session_cache(session.get('cache_id'))
         session.pop('file1_path', None)
         session.pop('file2_path', None)
         session.pop('file1_name', None)
@@ -1347,20 +5947,70 @@ def upload_files():
         file1_path = os.path.join(UPLOAD_FOLDER, filename1)
         file2_path = os.path.join(UPLOAD_FOLDER, filename2)
         
-        file1.save(file1_path)
-        file2.save(file2_path)
-        
-        results = compare_spreadsheets(file1_path, file2_path)
-        
-        # Limpar arquivos temporários
-        os.remove(file1_path)
-        os.remove(file2_path)
+        try:
+            file1.save(file1_path)
+            file2.save(file2_path)
+            results = compare_spreadsheets(file1_path, file2_path)
+        except MemoryBudgetExceeded as e:
+            flash(str(e))
+            return redirect(url_for('index'))
+        finally:
+            # Limpar arquivos temporários, também quando a comparação falha
+            for path in (file1_path, file2_path):
+                if os.path.exists(path):
+                    os.remove(path)
         
         return render_template('results.html', results=results, 
                              file1_name=file1.filename, file2_name=file2.filename)
     
-    flash('Tipos de arquivo não permitidos. Use apenas .xlsx, .xls ou .csv')
+    flash('Tipos de arquivo não permitidos. Use apenas .xlsx, .xls, .csv, .csv.gz ou .zip')
     return redirect(request.url)
 
+def preload_for_fork():
+    """Carrega o que é pesado e somente leitura antes do fork dos workers.
+    
+    Módulos importados no processo mestre ficam em páginas compartilhadas
+    (copy-on-write) entre os workers; gc.freeze() tira esses objetos das
+    coletas para que o GC não escreva neles e force a cópia das páginas.
+    """
+    import openpyxl  # noqa: F401
+    import xlrd  # noqa: F401
+    import tracemalloc  # noqa: F401
+    import cProfile  # noqa: F401
+    import pstats  # noqa: F401
+    
+    # A primeira leitura e o primeiro groupby importam módulos internos do pandas sob demanda
+    warmup = pd.read_csv(io.StringIO('a,b\n1,x\n2,y\n'))
+    warmup, _ = compact_dataframe(warmup)
+    warmup.groupby('b', observed=True)['a'].agg(['sum', 'count'])
+    # Templates compilados uma vez no mestre, em vez de uma vez por worker
+    for template in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template)
+    
+    private_cache_directory(DATASET_CACHE_FOLDER)
+    prune_dataset_cache()
+    gc.collect()
+    gc.freeze()
+
+def create_app(config=None, preload=True):
+    """Aplicação configurada para servidores WSGI de produção (ver wsgi.py e gunicorn.conf.py).
+    
+    Não é uma fábrica de aplicações: não cria uma instância nova, e sim altera e devolve o
+    `app` global do módulo (as rotas e os caches são do módulo). Chamar de novo altera a
+    mesma instância, e não dá para ter duas configurações no mesmo processo.
+    
+    Sem SECRET_KEY (no ambiente ou em `config`) a chamada falha: a chave de desenvolvimento
+    fixa no código deixaria qualquer um assinar cookies de sessão.
+    """
+    secret_key = (config or {}).get('SECRET_KEY') or os.environ.get('SECRET_KEY')
+    if not secret_key:
+        raise RuntimeError('Defina SECRET_KEY no ambiente antes de iniciar o servidor de produção.')
+    app.secret_key = secret_key
+    if config:
+        app.config.update(config)
+    if preload:
+        preload_for_fork()
+    return app
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
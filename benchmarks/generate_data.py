@@ -0,0 +1,221 @@
+"""Gerador de pares sintéticos de planilhas (origem/destino) para benchmarks.
+
+Exemplos:
+    python benchmarks/generate_data.py --preset ours
+    python benchmarks/generate_data.py --rows1 1000000 --rows2 50000 --format csv
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Formatos pré-definidos: (linhas origem, colunas origem, linhas destino, colunas destino, vendedor)
+PRESETS = {
+    'ours': (25000, 56, 174, 68, 281),
+    'medium': (100000, 56, 20000, 68, None),
+    'large': (1000000, 56, 100000, 68, None),
+}
+
+SELLER_CODE = 281
+
+# Colunas principais da origem e o nome usado no destino quando a coluna é "renomeada"
+CORE_COLUMNS = {
+    'loja': 'COD_LOJA',
+    'nf': 'NUMERO_NF',
+    'serie': 'SERIE_NF',
+    'cod_prod': 'CODIGO_PRODUTO',
+    'cod_vendedor': 'CODIGO_VENDEDOR',
+    'cod_parceiro': 'CODIGO_PARCEIRO',
+    'nome_vendedor': 'VENDEDOR',
+    'nome_loja': 'DESCRICAO_LOJA',
+    'descricao': 'DESCR_PRODUTO',
+    'data_emissao': 'DT_EMISSAO',
+    'quantidade': 'QTD',
+    'valor_unitario': 'PRECO_UNITARIO',
+    'total_produto': 'VALOR_TOTAL_PRODUTO',
+    'custo_total_medio': 'CUSTO_MEDIO_TOTAL',
+    'custo_total_tabela': 'CUSTO_TABELA_TOTAL',
+    'valor_pago': 'VLR_PAGO',
+}
+
+KEY_COLUMNS = ['loja', 'nf', 'serie', 'cod_prod']
+
+
+def build_origin(rows, cols, rng):
+    """Monta a planilha origem com chave (loja, nf, serie, cod_prod) única"""
+    sellers = rng.integers(200, 400, rows)
+    sellers[rng.random(rows) < 0.01] = SELLER_CODE  # garantir o vendedor usado nos filtros
+    stores = rng.integers(1, 31, rows)
+    products = rng.integers(1000, 9000, rows)
+    quantity = rng.integers(1, 50, rows)
+    unit_price = np.round(rng.gamma(2.0, 35.0, rows), 2)
+    total = np.round(quantity * unit_price, 2)
+    average_cost = np.round(total * rng.uniform(0.5, 0.9, rows), 4)
+
+    data = {
+        'loja': stores,
+        'nf': np.arange(100000, 100000 + rows),
+        'serie': rng.integers(1, 4, rows),
+        'cod_prod': products,
+        'cod_vendedor': sellers,
+        'cod_parceiro': rng.integers(1, max(2, rows // 20), rows),
+        'nome_vendedor': np.char.add('VENDEDOR ', sellers.astype(str)),
+        'nome_loja': np.char.add('LOJA ', stores.astype(str)),
+        'descricao': np.char.add('PRODUTO ', products.astype(str)),
+        'data_emissao': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D'),
+        'quantidade': quantity,
+        'valor_unitario': unit_price,
+        'total_produto': total,
+        'custo_total_medio': average_cost,
+        'custo_total_tabela': np.round(average_cost * 1.1, 4),
+        'valor_pago': np.round(total * rng.choice([1.0, 0.95, 0.9], rows), 2),
+    }
+
+    # Colunas de preenchimento até a largura pedida, alternando tipos
+    for i in range(max(0, cols - len(data))):
+        kind = i % 3
+        if kind == 0:
+            data[f'campo_extra_{i}'] = rng.integers(0, 1000, rows)
+        elif kind == 1:
+            data[f'campo_extra_{i}'] = np.round(rng.random(rows) * 100, 2)
+        else:
+            data[f'campo_extra_{i}'] = rng.choice(['A', 'B', 'C', 'D', None], rows)
+
+    df = pd.DataFrame(data)
+    return df.iloc[:, :cols] if cols < len(df.columns) else df
+
+
+def build_destination(origin, rows, cols, rng, overlap, renamed, dirty, changed, seller=None):
+    """Monta o destino a partir da origem com sobreposição, renomeação e chaves sujas controladas"""
+    pool = origin[origin['cod_vendedor'] == seller] if seller is not None else origin
+    n_overlap = min(len(pool), int(round(rows * overlap)))
+    shared = pool.sample(n=n_overlap, random_state=int(rng.integers(0, 2**31))).copy()
+
+    # Linhas novas: mesma estrutura, notas fiscais que não existem na origem
+    n_new = rows - n_overlap
+    new_rows = build_origin(n_new, len(origin.columns), rng) if n_new > 0 else origin.iloc[:0].copy()
+    new_rows.columns = origin.columns
+    new_rows['nf'] = np.arange(len(new_rows)) + int(origin['nf'].max()) + 1
+    if seller is not None and n_new > 0:
+        new_rows['cod_vendedor'] = seller
+        new_rows['nome_vendedor'] = f'VENDEDOR {seller}'
+
+    dest = pd.concat([shared, new_rows], ignore_index=True)
+
+    # Valores alterados em parte das linhas compartilhadas
+    n_changed = int(round(n_overlap * changed))
+    if n_changed:
+        dest.loc[:n_changed - 1, 'total_produto'] = np.round(dest.loc[:n_changed - 1, 'total_produto'] * 1.05, 2)
+
+    # Chaves "sujas": espaços e zeros à esquerda, como em exportações de ERP
+    n_dirty = int(round(len(dest) * dirty))
+    if n_dirty:
+        dirty_rows = rng.choice(len(dest), n_dirty, replace=False)
+        nf_text = dest['nf'].astype(str)
+        nf_text.iloc[dirty_rows] = ' 00' + nf_text.iloc[dirty_rows] + ' '
+        dest['nf'] = nf_text
+
+    dest = dest.sample(frac=1.0, random_state=int(rng.integers(0, 2**31))).reset_index(drop=True)
+
+    # Renomear: tudo em maiúsculas e parte das colunas principais com sinônimos
+    columns = {}
+    renamed_core = set(rng.choice(list(CORE_COLUMNS), int(round(len(CORE_COLUMNS) * renamed)), replace=False))
+    for col in dest.columns:
+        columns[col] = CORE_COLUMNS[col] if col in renamed_core else col.upper()
+    dest = dest.rename(columns=columns)
+
+    # Colunas extras que só existem no destino
+    for i in range(max(0, cols - len(dest.columns))):
+        dest[f'EXTRA_DESTINO_{i}'] = rng.integers(0, 100, len(dest))
+
+    stats = {
+        'overlap_rows': n_overlap,
+        'new_rows': n_new,
+        'changed_rows': n_changed,
+        'dirty_rows': n_dirty,
+        'renamed_columns': {col: columns[col] for col in sorted(renamed_core)},
+    }
+    return dest, columns, stats
+
+
+def write_frame(df, path, fmt):
+    if fmt == 'xlsx':
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def generate_pair(output_dir, name, rows1, cols1, rows2, cols2, seller=None, overlap=0.9,
+                  renamed=0.25, dirty=0.02, changed=0.05, formats=('csv',), seed=42):
+    """Gera o par origem/destino e um manifesto JSON descrevendo o que foi gerado"""
+    rng = np.random.default_rng(seed)
+    origin = build_origin(rows1, cols1, rng)
+    destination, renames, stats = build_destination(origin, rows2, cols2, rng, overlap, renamed,
+                                                    dirty, changed, seller)
+
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    for fmt in formats:
+        if fmt == 'xlsx' and max(rows1, rows2) >= 1048576:
+            print(f"Ignorando xlsx para {name}: excede o limite de linhas do Excel")
+            continue
+        origin_path = os.path.join(output_dir, f'{name}_origem.{fmt}')
+        destination_path = os.path.join(output_dir, f'{name}_destino.{fmt}')
+        write_frame(origin, origin_path, fmt)
+        write_frame(destination, destination_path, fmt)
+        files[fmt] = {'origin': origin_path, 'destination': destination_path}
+
+    manifest = {
+        'name': name,
+        'seed': seed,
+        'shape': {'origin': [rows1, cols1], 'destination': [len(destination), len(destination.columns)]},
+        'params': {'overlap': overlap, 'renamed': renamed, 'dirty': dirty, 'changed': changed},
+        'seller': seller if seller is not None else SELLER_CODE,
+        'seller_column': {'origin': 'cod_vendedor', 'destination': renames['cod_vendedor']},
+        'key_columns': {'origin': KEY_COLUMNS, 'destination': [renames[col] for col in KEY_COLUMNS]},
+        'total_column': {'origin': 'total_produto', 'destination': renames['total_produto']},
+        'files': files,
+        **stats,
+    }
+    manifest_path = os.path.join(output_dir, f'{name}_manifest.json')
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    return manifest_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gera pares sintéticos de planilhas para benchmarks')
+    parser.add_argument('--preset', choices=sorted(PRESETS), help='Formato pré-definido')
+    parser.add_argument('--name', help='Nome do conjunto (padrão: nome do preset ou "custom")')
+    parser.add_argument('--rows1', type=int, default=25000)
+    parser.add_argument('--cols1', type=int, default=56)
+    parser.add_argument('--rows2', type=int, default=174)
+    parser.add_argument('--cols2', type=int, default=68)
+    parser.add_argument('--seller', type=int, help='Restringe o destino a um vendedor (como no export filtrado)')
+    parser.add_argument('--overlap', type=float, default=0.9, help='Fração do destino que existe na origem')
+    parser.add_argument('--renamed', type=float, default=0.25, help='Fração das colunas principais renomeadas')
+    parser.add_argument('--dirty', type=float, default=0.02, help='Fração de linhas do destino com chave suja')
+    parser.add_argument('--changed', type=float, default=0.05, help='Fração das linhas comuns com valor alterado')
+    parser.add_argument('--format', action='append', choices=['csv', 'csv.gz', 'xlsx'], help='Pode ser repetido')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'data'))
+    args = parser.parse_args()
+
+    if args.preset:
+        args.rows1, args.cols1, args.rows2, args.cols2, preset_seller = PRESETS[args.preset]
+        if args.seller is None:
+            args.seller = preset_seller
+
+    manifest = generate_pair(
+        args.output, args.name or args.preset or 'custom',
+        args.rows1, args.cols1, args.rows2, args.cols2,
+        seller=args.seller, overlap=args.overlap, renamed=args.renamed, dirty=args.dirty,
+        changed=args.changed, formats=tuple(args.format or ['csv']), seed=args.seed
+    )
+    print(manifest)
+
+
+if __name__ == '__main__':
+    main()
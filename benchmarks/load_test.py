@@ -0,0 +1,374 @@
+"""Teste de carga das rotas web com várias sessões simultâneas.
+
+Cada cenário é uma sessão de analista com um par gerado por generate_data.py:
+/analyze, depois /preview_filters N vezes com filtros diferentes e, no cenário
+flow, /compare_with_filters_and_mapping. A concorrência pode subir em degraus
+(--ramp); para cada degrau são medidos p50/p95/p99 por rota, vazão, taxa de erro
+e o pico de RSS do servidor (processo e filhos, lido em /proc).
+
+O servidor pode ser um já em execução (--url, e --server-pid para medir o RSS)
+ou um iniciado pelo próprio teste (--spawn app ou --spawn gunicorn).
+
+Exemplos:
+    python benchmarks/load_test.py benchmarks/data/ours_manifest.json --url http://127.0.0.1:5000
+    python benchmarks/load_test.py benchmarks/data/ours_manifest.json --scenario flow --spawn gunicorn \\
+        --ramp 1,2,4,8 --requests 16 --output carga.json
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlencode, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RSS_SAMPLE_INTERVAL = 0.1
+SERVER_START_TIMEOUT = 120
+
+
+def encode_multipart(files):
+    """Corpo multipart/form-data com os arquivos {campo: (nome, bytes)}"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for field, (filename, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8') + content + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class Client:
+    """Conexão HTTP que guarda o cookie de sessão entre as requisições de um fluxo"""
+
+    def __init__(self, base_url, recorder):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.cookie = None
+        self.recorder = recorder
+
+    def request(self, route, method, path, body=None, content_type=None):
+        """Executa a requisição e registra latência e resultado na rota"""
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=600)
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        started = time.perf_counter()
+        status, error = None, None
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            status = response.status
+            cookie = response.getheader('Set-Cookie')
+            if cookie:
+                self.cookie = cookie.split(';', 1)[0]
+            # Erros das rotas de formulário voltam como redirecionamento para a página inicial;
+            # os das rotas AJAX, como JSON com a chave "error"
+            if status >= 300:
+                error = f'HTTP {status}'
+            elif response.getheader('Content-Type', '').startswith('application/json'):
+                error = json.loads(data).get('error')
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            error = type(e).__name__
+        finally:
+            connection.close()
+        self.recorder.record(route, time.perf_counter() - started, error)
+        return status is not None and error is None
+
+    def post_form(self, route, path, fields):
+        return self.request(route, 'POST', path, urlencode(fields), 'application/x-www-form-urlencoded')
+
+
+class Recorder:
+    """Latências e erros por rota, compartilhados pelas threads de um degrau"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, elapsed, error):
+        with self.lock:
+            entry = self.routes.setdefault(route, {'latencies': [], 'errors': {}})
+            entry['latencies'].append(elapsed)
+            if error:
+                entry['errors'][error] = entry['errors'].get(error, 0) + 1
+
+
+def percentiles(values):
+    """p50, p95 e p99 (interpolação inclusiva; com uma amostra, ela mesma)"""
+    if len(values) == 1:
+        return {'p50': values[0], 'p95': values[0], 'p99': values[0]}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+def preview_filter_sets(manifest, count):
+    """Sequência de filtros do preview, como um analista refinando a seleção"""
+    seller_col = manifest['seller_column']['origin']
+    total_col = manifest['total_column']['origin']
+    seller = str(manifest['seller'])
+    options = [
+        [{'column': seller_col, 'operator': 'equals', 'value': seller}],
+        [{'column': seller_col, 'operator': 'equals', 'value': seller},
+         {'column': total_col, 'operator': 'greater_than', 'value': '100'}],
+        [{'column': seller_col, 'operator': 'in', 'value': f'{seller},{int(seller) + 1}'}],
+        [{'column': total_col, 'operator': 'less_than', 'value': '50'}],
+    ]
+    return [options[i % len(options)] for i in range(count)]
+
+
+def session_upload(files, fmt, number, distinct):
+    """Corpo do /analyze da sessão.
+    
+    Com distinct, cada sessão recebe um CSV com conteúdo diferente (linhas em branco
+    a mais no fim, que a leitura ignora): como analistas com arquivos próprios, sem
+    acertar o cache de resultados, que é indexado pelo hash do conteúdo.
+    """
+    origin, destination = files
+    if distinct and fmt == 'csv':
+        origin += b'\n' * (number + 1)
+    return encode_multipart({'file1': (f'origem.{fmt}', origin), 'file2': (f'destino.{fmt}', destination)})
+
+
+def run_scenario(name, client, upload, manifest, previews):
+    """Executa uma sessão; devolve True se todas as requisições deram certo"""
+    body, content_type = upload
+    ok = client.request('analyze', 'POST', '/analyze', body, content_type)
+    if name != 'flow' or not ok:
+        return ok
+
+    for filters in preview_filter_sets(manifest, previews):
+        ok &= client.post_form('preview_filters', '/preview_filters', {
+            'planilha_num': 1, 'filters': json.dumps(filters)
+        })
+
+    origin, destination = manifest['key_columns']['origin'], manifest['key_columns']['destination']
+    mapping = dict(zip(origin, destination))
+    mapping[manifest['seller_column']['origin']] = manifest['seller_column']['destination']
+    mapping[manifest['total_column']['origin']] = manifest['total_column']['destination']
+    ok &= client.post_form('compare', '/compare_with_filters_and_mapping', {
+        'confirmed_mapping': json.dumps(mapping),
+        'filters1': json.dumps(preview_filter_sets(manifest, 1)[0]),
+        'total_columns': json.dumps([manifest['total_column']['origin']])
+    })
+    return ok
+
+
+def process_tree(pid):
+    """pid e todos os descendentes (workers do gunicorn), pela tabela de processos do /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # O nome do processo vem entre parênteses e pode conter espaços
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def tree_rss_bytes(pid):
+    """Soma do VmRSS do processo e dos filhos (páginas compartilhadas contam em cada um)"""
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """Pico do RSS do servidor enquanto um degrau roda"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.pid is None or not os.path.exists(f'/proc/{self.pid}'):
+            return self
+        self.peak = tree_rss_bytes(self.pid)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, tree_rss_bytes(self.pid))
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+        return self.peak
+
+
+def spawn_server(kind, url):
+    """Inicia o servidor local (desenvolvimento ou gunicorn) e espera ele responder"""
+    parsed = urlparse(url)
+    port = parsed.port or 80
+    env = dict(os.environ, BIND=f'{parsed.hostname}:{port}')
+    if kind == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application']
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--host', parsed.hostname,
+                   '--port', str(port), '--no-reload', '--no-debugger', '--with-threads']
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'O servidor ({kind}) terminou ao iniciar, código {server.returncode}')
+        try:
+            connection = http.client.HTTPConnection(parsed.hostname, port, timeout=2)
+            connection.request('GET', '/metrics')
+            connection.getresponse().read()
+            connection.close()
+            return server
+        except OSError:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f'O servidor ({kind}) não respondeu em {SERVER_START_TIMEOUT}s')
+
+
+def run_level(args, concurrency, files, manifest, server_pid, first_session):
+    """Roda args.requests cenários com `concurrency` clientes e resume o degrau"""
+    recorder = Recorder()
+    lock = threading.Lock()
+    remaining = iter(range(first_session, first_session + args.requests))
+    scenarios = {'ok': 0, 'failed': 0}
+
+    def worker():
+        while True:
+            with lock:
+                number = next(remaining, None)
+            if number is None:
+                return
+            upload = session_upload(files, args.format, number, not args.same_files)
+            client = Client(args.url, recorder)
+            ok = run_scenario(args.scenario, client, upload, manifest, args.previews)
+            with lock:
+                scenarios['ok' if ok else 'failed'] += 1
+
+    sampler = RssSampler(server_pid).start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    peak_rss = sampler.stop()
+
+    routes = {}
+    for route, entry in recorder.routes.items():
+        errors = sum(entry['errors'].values())
+        routes[route] = {
+            'requests': len(entry['latencies']),
+            **{name: round(value, 4) for name, value in percentiles(entry['latencies']).items()},
+            'max': round(max(entry['latencies']), 4),
+            'errors': errors,
+            'error_rate': errors / len(entry['latencies']),
+            'error_kinds': entry['errors'],
+        }
+    requests = sum(route['requests'] for route in routes.values())
+    errors = sum(route['errors'] for route in routes.values())
+    return {
+        'concurrency': concurrency,
+        'scenarios': scenarios,
+        'wall_s': round(wall, 3),
+        'scenarios_per_s': (scenarios['ok'] + scenarios['failed']) / wall,
+        'requests_per_s': requests / wall,
+        'requests': requests,
+        'errors': errors,
+        'error_rate': errors / requests if requests else 0.0,
+        'peak_rss_bytes': peak_rss,
+        'routes': routes,
+    }
+
+
+def print_level(level):
+    rss = f"{level['peak_rss_bytes'] / 1048576:.0f} MB" if level['peak_rss_bytes'] else 'não medido'
+    print(f"\nConcorrência {level['concurrency']}: {level['scenarios']['ok'] + level['scenarios']['failed']} "
+          f"cenários em {level['wall_s']:.1f}s")
+    print(f"  vazão:     {level['scenarios_per_s']:.2f} cenários/s, {level['requests_per_s']:.2f} requisições/s")
+    print(f"  erros:     {level['errors']} de {level['requests']} requisições ({level['error_rate']:.1%})")
+    print(f"  pico RSS:  {rss}")
+    print(f"  {'rota':18s} {'n':>5s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'erros':>7s}")
+    for route, data in level['routes'].items():
+        print(f"  {route:18s} {data['requests']:5d} {data['p50']:8.3f}s {data['p95']:8.3f}s "
+              f"{data['p99']:8.3f}s {data['error_rate']:7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga com sessões concorrentes')
+    parser.add_argument('manifest', help='Manifesto gerado por generate_data.py')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--scenario', default='analyze', choices=['analyze', 'flow'])
+    parser.add_argument('--format', default='csv', choices=['csv', 'csv.gz', 'xlsx'])
+    parser.add_argument('--previews', type=int, default=3, help='Previews de filtros por sessão (cenário flow)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--ramp', help='Degraus de concorrência separados por vírgula (ex.: 1,2,4,8)')
+    parser.add_argument('--requests', type=int, default=20, help='Cenários executados em cada degrau')
+    parser.add_argument('--same-files', action='store_true',
+                        help='Todas as sessões enviam o mesmo conteúdo (mede os caches de resultado)')
+    parser.add_argument('--spawn', choices=['app', 'gunicorn'], help='Iniciar um servidor local para o teste')
+    parser.add_argument('--server-pid', type=int, help='PID do servidor já em execução, para medir o RSS')
+    parser.add_argument('--output', help='Grava o resultado em JSON')
+    args = parser.parse_args()
+
+    with open(args.manifest, encoding='utf-8') as f:
+        manifest = json.load(f)
+    files = manifest['files'][args.format]
+    with open(files['origin'], 'rb') as f1, open(files['destination'], 'rb') as f2:
+        files = (f1.read(), f2.read())
+    levels = [int(value) for value in args.ramp.split(',')] if args.ramp else [args.concurrency]
+
+    server = spawn_server(args.spawn, args.url) if args.spawn else None
+    server_pid = server.pid if server else args.server_pid
+    results = {'scenario': args.scenario, 'format': args.format, 'previews': args.previews,
+               'same_files': args.same_files,
+               'requests_per_level': args.requests, 'server': args.spawn or args.url, 'levels': []}
+    try:
+        print(f"Cenário {args.scenario} ({manifest['name']}, {args.format}), {args.requests} execuções por degrau")
+        for number, concurrency in enumerate(levels):
+            level = run_level(args, concurrency, files, manifest, server_pid, number * args.requests)
+            results['levels'].append(level)
+            print_level(level)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados gravados em {args.output}")
+
+
+if __name__ == '__main__':
+    main()
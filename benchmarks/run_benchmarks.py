@@ -0,0 +1,195 @@
+"""Mede o tempo de cada etapa da comparação sobre os conjuntos gerados por generate_data.py.
+
+Exemplos:
+    python benchmarks/run_benchmarks.py benchmarks/data/ours_manifest.json
+    python benchmarks/run_benchmarks.py benchmarks/data/*_manifest.json --repeat 5 \\
+        --output resultados.json --compare resultados_anteriores.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pandas as pd  # noqa: E402
+
+import app  # noqa: E402
+
+
+def time_stage(func, repeat):
+    """Executa a etapa `repeat` vezes e devolve (último resultado, tempos em segundos)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return result, timings
+
+
+def summarize(timings, **extra):
+    return {
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+        'runs_s': timings,
+        **extra
+    }
+
+
+def benchmark_pair(manifest, fmt, repeat, cell_diff_max_rows):
+    """Mede as etapas do pipeline para um par origem/destino"""
+    files = manifest['files'][fmt]
+    stages = {}
+
+    (df1, df2), timings = time_stage(
+        lambda: (app.load_spreadsheet(files['origin']), app.load_spreadsheet(files['destination'])),
+        repeat
+    )
+    input_bytes = os.path.getsize(files['origin']) + os.path.getsize(files['destination'])
+    stages['load_spreadsheet'] = summarize(
+        timings, rows=len(df1) + len(df2), bytes=input_bytes,
+        mb_per_s=input_bytes / 1e6 / statistics.median(timings),
+        rows_per_s=(len(df1) + len(df2)) / statistics.median(timings),
+        csv_dialect=df1.attrs.get('csv_dialect')
+    )
+
+    mapping_result, timings = time_stage(lambda: app.find_intelligent_column_mapping(df1, df2), repeat)
+    mapping = mapping_result['mapping']
+    stages['find_intelligent_column_mapping'] = summarize(timings, mapped_columns=len(mapping))
+
+    keys, timings = time_stage(lambda: app.identify_best_key_fields(mapping, df1, df2), repeat)
+    stages['identify_best_key_fields'] = summarize(timings, key_columns=keys[0])
+
+    seller_col1 = manifest['seller_column']['origin']
+    seller_col2 = mapping.get(seller_col1, manifest['seller_column']['destination'])
+    filters1 = [{'column': seller_col1, 'operator': 'equals', 'value': str(manifest['seller'])}]
+    filters2 = [{'column': seller_col2, 'operator': 'equals', 'value': str(manifest['seller'])}]
+    (filtered1, filtered2), timings = time_stage(
+        lambda: (app.apply_filters(df1, filters1), app.apply_filters(df2, filters2)), repeat
+    )
+    stages['apply_filters'] = summarize(timings, rows_in=len(df1) + len(df2),
+                                        rows_out=len(filtered1) + len(filtered2))
+
+    unique, timings = time_stage(
+        lambda: app.find_unique_rows_by_intelligent_keys(df1, df2, mapping), repeat
+    )
+    stages['find_unique_rows_by_intelligent_keys'] = summarize(
+        timings, only_in_origin=len(unique[0]), only_in_destination=len(unique[1])
+    )
+
+    # Diferença célula a célula nas colunas mapeadas, com o destino renomeado para os nomes da origem
+    mapped1 = list(mapping)
+    diff_rows = min(len(df1), len(df2), cell_diff_max_rows)
+    left = df1[mapped1].head(diff_rows)
+    right = df2[[mapping[col] for col in mapped1]].head(diff_rows).set_axis(mapped1, axis=1)
+    differences, timings = time_stage(lambda: app.find_cell_differences(left, right), repeat)
+    stages['cell_diff'] = summarize(timings, rows=diff_rows, columns=len(mapped1), differences=len(differences))
+
+    total_col1 = manifest['total_column']['origin']
+    total_cols1 = [col for col in mapped1 if pd.api.types.is_numeric_dtype(df1[col])]
+    total_cols2 = [mapping[col] for col in total_cols1]
+    _, timings = time_stage(
+        lambda: (app.calculate_totals(df1, total_cols1), app.calculate_totals(df2, total_cols2)), repeat
+    )
+    stages['calculate_totals'] = summarize(timings, columns=len(total_cols1), includes=total_col1 in total_cols1)
+
+    return {
+        'shape': {'origin': list(df1.shape), 'destination': list(df2.shape)},
+        'stages': stages,
+        'total_median_s': sum(stage['median_s'] for stage in stages.values())
+    }
+
+
+def compare_runs(current, previous):
+    """Mostra a variação do tempo mediano de cada etapa em relação a uma execução anterior"""
+    for dataset, result in current['datasets'].items():
+        before = previous.get('datasets', {}).get(dataset)
+        if not before:
+            continue
+        print(f"\n{dataset}")
+        for stage, data in result['stages'].items():
+            old = before['stages'].get(stage)
+            if not old:
+                continue
+            change = (data['median_s'] - old['median_s']) / old['median_s'] * 100 if old['median_s'] else 0.0
+            print(f"  {stage:40s} {old['median_s']:9.4f}s -> {data['median_s']:9.4f}s ({change:+.1f}%)")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark das etapas de comparação')
+    parser.add_argument('manifests', nargs='+', help='Manifestos gerados por generate_data.py')
+    parser.add_argument('--format', default='csv', choices=['csv', 'csv.gz', 'xlsx'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cell-diff-max-rows', type=int, default=500,
+                        help='Limite de linhas na diferença célula a célula')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparação')
+    parser.add_argument('--verbose', action='store_true', help='Mostrar os logs de depuração do app')
+    parser.add_argument('--csv-engine', choices=['c', 'pyarrow'], help='Força o parser de CSV (padrão: pyarrow se instalado)')
+    parser.add_argument('--dataset-cache', action='store_true',
+                        help='Usar o cache de planilhas carregadas (por padrão mede a leitura do arquivo)')
+    args = parser.parse_args()
+    
+    logging.getLogger('check_planilhas').setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    app.DATASET_CACHE_ENABLED = args.dataset_cache
+    if args.csv_engine:
+        app.CSV_ENGINE = args.csv_engine
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'format': args.format,
+            'dataset_cache': args.dataset_cache,
+            'csv_engine': app.CSV_ENGINE,
+            'pyarrow': app.pyarrow.__version__ if app.pyarrow is not None else None,
+        },
+        'datasets': {}
+    }
+
+    for manifest_path in args.manifests:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if args.format not in manifest['files']:
+            print(f"{manifest['name']}: formato {args.format} não gerado, ignorando")
+            continue
+        print(f"Medindo {manifest['name']} ({args.format})...")
+        result = benchmark_pair(manifest, args.format, args.repeat, args.cell_diff_max_rows)
+        results['datasets'][f"{manifest['name']}.{args.format}"] = result
+        for stage, data in result['stages'].items():
+            throughput = ''
+            if 'mb_per_s' in data:
+                throughput = f"  ({data['mb_per_s']:.1f} MB/s, {data['rows_per_s']:,.0f} linhas/s)"
+            print(f"  {stage:40s} {data['median_s']:9.4f}s{throughput}")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+    print(f"Resultados gravados em {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare_runs(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
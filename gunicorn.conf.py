@@ -0,0 +1,26 @@
+"""Configuração do gunicorn: workers pré-forkados a partir de um mestre já aquecido.
+
+Variáveis de ambiente: BIND, WEB_CONCURRENCY (workers), THREADS (por worker),
+MEMORY_BUDGET_MB (dividido entre os workers) e DATASET_CACHE_DIR.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# As comparações são limitadas por CPU; poucas threads por worker só cobrem E/S de upload
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 2))
+# Importar o app no mestre (pandas, openpyxl, templates) antes do fork: os workers compartilham as páginas
+preload_app = True
+timeout = 300
+# Reciclar workers devolve ao sistema a memória fragmentada pelas comparações grandes
+max_requests = 200
+max_requests_jitter = 50
+
+
+def post_fork(server, worker):
+    # Cada worker tem seu próprio controle de admissão: dividir o orçamento global entre eles
+    import app
+    if app.MEMORY_BUDGET_BYTES:
+        app.memory_budget.resize(app.MEMORY_BUDGET_BYTES // server.cfg.workers)
@@ -0,0 +1,7 @@
+"""Ponto de entrada WSGI para produção.
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+"""
+from app import create_app
+
+application = create_app()